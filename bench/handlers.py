@@ -0,0 +1,256 @@
+"""
+Бенчмарк хендлеров: прогоняет сценарии пользователей через настоящие хендлеры
+bot.py на временной БД. Сеть не трогается — send/edit/answer бота подменены
+записью вызовов.
+
+    python bench/handlers.py [--users 300] [--repeat 3] [--save-baseline] [--baseline PATH]
+
+Сценарии: регистрация, анкета IQ с вводом балла, цель (добавить → выполнить →
+отменить), журнал (запись → история → открыть запись). По каждому шагу —
+пропускная способность и p50/p99 (лучшие из --repeat повторов после
+прогрева). С --save-baseline результат сохраняется в
+baseline; без него — сравнивается с сохранённым, и при росте p50/p99 выше
+допуска скрипт завершается с кодом 1. Baseline снимается на той же машине,
+что и проверка: абсолютные цифры между машинами не сравнимы.
+
+Переменные окружения бота действуют как обычно (например, DB_WRITE_BEHIND=1).
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.chdir(tempfile.mkdtemp(prefix="risehunt-bench-"))   # лог и БД бота — во временной папке
+
+import bot  # noqa: E402
+from telebot import types  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(ROOT, "bench", "baseline_handlers.json")
+
+
+class StubTransport:
+    """Вместо запросов к Bot API записывает, какие методы вызывались."""
+    METHODS = ("send_message", "reply_to", "edit_message_text", "answer_callback_query")
+
+    class _Sent:
+        message_id = 1
+
+    def __init__(self):
+        self.calls: dict[str, int] = {m: 0 for m in self.METHODS}
+        self.errors: list[str] = []
+
+    def install(self, target) -> None:
+        for name in self.METHODS:
+            setattr(target, name, self._recorder(name))
+
+    def _recorder(self, name: str):
+        def record(*args, **kwargs):
+            self.calls[name] += 1
+            # callback_handler глотает исключения и отвечает текстом ошибки
+            if name == "answer_callback_query" and len(args) > 1 and "ошибка" in str(args[1]):
+                self.errors.append(str(args[1]))
+            return self._Sent()
+        return record
+
+
+def message(uid: int, text: str) -> types.Message:
+    return types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"},
+    })
+
+
+def callback(uid: int, data: str) -> types.CallbackQuery:
+    return types.CallbackQuery.de_json({
+        "id": "1", "chat_instance": "bench", "data": data,
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"},
+        "message": {"message_id": 5, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "x"},
+    })
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    def step(self, label: str, fn, *args) -> None:
+        start = time.perf_counter()
+        fn(*args)
+        self.samples.setdefault(label, []).append(time.perf_counter() - start)
+
+    def cb(self, label: str, uid: int, data: str) -> None:
+        self.step(f"cb:{label}", bot.callback_handler, callback(uid, data))
+
+    def text(self, label: str, uid: int, text: str) -> None:
+        self.step(f"text:{label}", bot.handle_text, message(uid, text))
+
+
+# ── Сценарии ──────────────────────────────────────────────────────────────────
+def journey_registration(r: Recorder, uid: int) -> None:
+    r.step("cmd:start", bot.cmd_start, message(uid, "/start"))
+    r.text("reg_name", uid, f"Bench {uid}")
+    r.text("reg_age", uid, "30")
+    r.cb("reg_gender", uid, bot.cb_data("reg_gender", "М"))
+    r.text("reg_tg", uid, "@bench")
+    r.cb("reg_action_goals", uid, "reg_action_goals")
+    r.text("reg_week_goals", uid, "Пробежать 10 км")
+    r.text("reg_week_goals", uid, "Прочитать книгу")
+    r.cb("reg_goals_done", uid, "reg_goals_done")
+
+
+def journey_test(r: Recorder, uid: int) -> None:
+    r.cb("tests_menu", uid, "tests_menu")
+    r.cb("test_open", uid, "test_IQ")
+    r.text("test_input", uid, "130")
+
+
+def journey_goals(r: Recorder, uid: int) -> None:
+    r.cb("goals", uid, "goals")
+    r.cb("goal_add", uid, bot.cb_data("goal_add", "day"))
+    r.cb("goal_dir", uid, bot.cb_data("goal_dir", "day", "IQ"))
+    r.text("goal_add", uid, "Прочитать главу")
+    gid = bot.get_goals(str(uid), "day")[-1]["id"]
+    r.cb("goal_manage", uid, bot.cb_data("goal_manage", gid, "day"))
+    r.cb("goal_done", uid, bot.cb_data("goal_done", gid, "day"))
+    r.cb("goal_undo", uid, bot.cb_data("goal_undo", gid, "day"))
+
+
+def journey_journal(r: Recorder, uid: int) -> None:
+    r.cb("journal", uid, "journal")
+    r.cb("journal_emotions", uid, "journal_emotions")
+    r.text("emotions", uid, "Спокойный день, много успел")
+    r.cb("journal_reflection", uid, "journal_reflection")
+    r.text("reflection", uid, "Понял, что утро — лучшее время для спорта")
+    r.cb("journal_history", uid, "journal_history")
+    entries, _ = bot.get_journal_page(str(uid))
+    r.cb("jentry", uid, bot.cb_data("jentry", entries[0]["id"]))
+
+
+JOURNEYS = (journey_registration, journey_test, journey_goals, journey_journal)
+
+
+# ── Отчёт и baseline ──────────────────────────────────────────────────────────
+def percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(samples: dict[str, list[float]]) -> dict[str, dict]:
+    result = {}
+    for label, values in samples.items():
+        values = sorted(values)
+        result[label] = {
+            "n":      len(values),
+            "ops":    round(len(values) / sum(values), 1),
+            "p50_us": round(percentile(values, 0.50) * 1e6, 1),
+            "p99_us": round(percentile(values, 0.99) * 1e6, 1),
+        }
+    return result
+
+
+def best_of(runs: list[dict[str, dict]]) -> dict[str, dict]:
+    """Лучший результат по каждому шагу среди повторов — отсекает разовые паузы (GC, checkpoint WAL)."""
+    result = {}
+    for label in runs[0]:
+        stats = [run[label] for run in runs]
+        result[label] = {
+            "n":      sum(s["n"] for s in stats),
+            "ops":    max(s["ops"] for s in stats),
+            "p50_us": min(s["p50_us"] for s in stats),
+            "p99_us": min(s["p99_us"] for s in stats),
+        }
+    return result
+
+
+def run_users(first_uid: int, users: int) -> dict[str, list[float]]:
+    recorder = Recorder()
+    for uid in range(first_uid, first_uid + users):
+        for journey in JOURNEYS:
+            journey(recorder, uid)
+    return recorder.samples
+
+
+def compare(current: dict, baseline: dict, tol_p50: float, tol_p99: float) -> list[str]:
+    failures = []
+    for label, base in baseline["routes"].items():
+        cur = current.get(label)
+        if cur is None:
+            failures.append(f"{label}: шаг пропал из прогона")
+            continue
+        for key, tol in (("p50_us", tol_p50), ("p99_us", tol_p99)):
+            limit = base[key] * (1 + tol)
+            if cur[key] > limit:
+                failures.append(f"{label}: {key} {cur[key]:.0f} > {limit:.0f} (baseline {base[key]:.0f})")
+    return failures
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=300, help="сколько пользователей проходят все сценарии за повтор")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--warmup", type=int, default=50, help="пользователей для прогрева (не учитываются)")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="допустимый рост p50 (доля)")
+    ap.add_argument("--p99-tolerance", type=float, default=1.0, help="допустимый рост p99 (доля)")
+    args = ap.parse_args()
+
+    transport = StubTransport()
+    transport.install(bot.bot)
+    bot.init_db()
+    if bot.DB_WRITE_BEHIND:
+        bot.write_queue.start()
+
+    run_users(1_000, args.warmup)
+    runs    = []
+    started = time.perf_counter()
+    for i in range(args.repeat):
+        runs.append(summarize(run_users(10_000 + i * args.users, args.users)))
+    elapsed = time.perf_counter() - started
+    if bot.DB_WRITE_BEHIND:
+        bot.write_queue.stop()
+
+    if transport.errors:
+        print(f"Хендлеры упали {len(transport.errors)} раз: {transport.errors[0]}")
+        return 1
+
+    summary = best_of(runs)
+    total   = sum(s["n"] for s in summary.values())
+    print(f"{args.repeat} × {args.users} пользователей, {total} апдейтов за {elapsed:.2f} с "
+          f"({total / elapsed:.0f}/с); по шагам — лучший из повторов")
+    print(f"{'шаг':<24} {'n':>6} {'оп/с':>9} {'p50, мкс':>10} {'p99, мкс':>10}")
+    for label, s in summary.items():
+        print(f"{label:<24} {s['n']:>6} {s['ops']:>9.0f} {s['p50_us']:>10.0f} {s['p99_us']:>10.0f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python":  platform.python_version(),
+                "machine": platform.machine(),
+                "users":   args.users,
+                "repeat":  args.repeat,
+                "routes":  summary,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"Baseline сохранён: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Baseline нет — сохраните его флагом --save-baseline")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    failures = compare(summary, baseline, args.tolerance, args.p99_tolerance)
+    for line in failures:
+        print("РЕГРЕССИЯ", line)
+    if not failures:
+        print("Регрессий относительно baseline нет")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
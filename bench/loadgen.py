@@ -0,0 +1,426 @@
+"""
+Нагрузочный стенд: поддельный Bot API + генератор пользователей + настоящий
+процесс bot.py (infinity_polling или webhook) — видны эффекты поллинга, HTTP
+и потоков, которых нет в bench/handlers.py.
+
+    python bench/loadgen.py [--mode polling|webhook] [--users 1000] [--duration 30]
+                            [--think-ms 1000] [--latency-ms 20] [--rate-429 0.01]
+                            [--bot-env DISPATCH_SHARDS=8 --bot-env SEND_QUEUE=1 ...]
+
+Поддельный Bot API отвечает на getUpdates (long polling), sendMessage,
+editMessageText и answerCallbackQuery с задержкой --latency-ms ± --jitter-ms,
+с вероятностью --rate-429 отвечает 429 с retry_after. Бот запускается во
+временной папке с TELEGRAM_API_URL, указывающим на стенд.
+
+Каждый пользователь — замкнутый цикл: шлёт апдейт (кнопка меню или /start),
+ждёт первого ответа бота в свой чат, «думает» (экспоненциально, среднее
+--think-ms) и шлёт следующий. Задержка от публикации апдейта до первого ответа —
+end-to-end латентность. Нет ответа за --timeout — ошибка; ответ на callback с
+текстом ошибки — тоже. Первые --warmup секунд в статистику не входят.
+"""
+import argparse
+import email.parser
+import email.policy
+import heapq
+import json
+import os
+import queue
+import random
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT     = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_PATH = os.path.join(ROOT, "bot.py")
+TOKEN    = "123456:LOADGEN"
+FIRST_UID = 1_000_000
+
+# (вес, тип, данные) — что «нажимают» пользователи
+ACTIONS = [
+    (3, "callback", "main_menu"),
+    (2, "callback", "profile"),
+    (2, "callback", "goals"),
+    (1, "callback", "goals_week"),
+    (1, "callback", "journal"),
+    (1, "callback", "journal_history"),
+    (1, "callback", "tests_menu"),
+    (1, "callback", "leaderboard"),
+    (1, "message",  "/start"),
+]
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ── Поддельный Bot API ────────────────────────────────────────────────────────
+class FakeBotAPI:
+    # Настоящий Telegram держит getUpdates до timeout (у TeleBot — 20 с); здесь не
+    # дольше секунды, чтобы бот быстро останавливался. На нагрузку не влияет:
+    # при потоке апдейтов ответ уходит сразу.
+    MAX_POLL_WAIT = 1.0
+
+    def __init__(self, latency: float, jitter: float, rate_429: float, on_response):
+        self.latency     = latency
+        self.jitter      = jitter
+        self.rate_429    = rate_429
+        self.on_response = on_response
+        self.polled      = threading.Event()
+        self._updates: list[dict] = []
+        self._next_id    = 1
+        self._cond       = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.injected_429 = 0
+        self._msg_ids    = iter(range(1, 1 << 62))
+
+    def push(self, update: dict) -> None:
+        with self._cond:
+            update["update_id"] = self._next_id
+            self._next_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def _count(self, method: str) -> None:
+        with self._stats_lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def _delay(self) -> None:
+        d = self.latency + random.uniform(-self.jitter, self.jitter)
+        if d > 0:
+            time.sleep(d)
+
+    def handle(self, method: str, params: dict) -> tuple[int, dict]:
+        self._count(method)
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Load", "username": "load_bot"}}
+        if method not in ("sendMessage", "editMessageText", "answerCallbackQuery"):
+            return 200, {"ok": True, "result": True}
+
+        self._delay()
+        if self.rate_429 and random.random() < self.rate_429:
+            with self._stats_lock:
+                self.injected_429 += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+
+        text = params.get("text", "")
+        if method == "answerCallbackQuery":
+            # id колбэка — "<chat_id>:<n>", см. LoadGenerator.make_update
+            chat_id = int(params.get("callback_query_id", "0:0").split(":")[0])
+            self.on_response(chat_id, "ошибка" in text)
+            return 200, {"ok": True, "result": True}
+        chat_id = int(params.get("chat_id", 0))
+        self.on_response(chat_id, False)
+        return 200, {"ok": True, "result": {
+            "message_id": next(self._msg_ids), "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+        }}
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        self.polled.set()
+        offset  = int(params.get("offset", 0) or 0)
+        limit   = int(params.get("limit", 100) or 100)
+        timeout = min(float(params.get("timeout", 0) or 0), self.MAX_POLL_WAIT)
+        with self._cond:
+            if offset < 0:       # skip_pending: подтверждаем всё накопленное
+                self._updates.clear()
+                return []
+            if offset:
+                self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                self._cond.wait(timeout)
+            return self._updates[:limit]
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят разными write — без этого keep-alive ловит
+            # задержку Nagle + delayed ACK (~40 мс на каждый запрос)
+            disable_nagle_algorithm = True
+
+            def _params(self) -> dict:
+                url    = urllib.parse.urlsplit(self.path)
+                params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                if not length:
+                    return params
+                body  = self.rfile.read(length)
+                ctype = self.headers.get("Content-Type", "")
+                if ctype.startswith("application/json"):
+                    params.update(json.loads(body))
+                elif ctype.startswith("multipart/form-data"):
+                    msg = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+                        f"Content-Type: {ctype}\r\n\r\n".encode() + body)
+                    for part in msg.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        if name:
+                            params[name] = part.get_content()
+                else:
+                    params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+                return params
+
+            def _serve(self):
+                method = urllib.parse.urlsplit(self.path).path.rsplit("/", 1)[-1]
+                status, payload = api.handle(method, self._params())
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, fmt, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # Бот закрывает keep-alive соединения при остановке — это не ошибка стенда
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        server = Server(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="fake-api", daemon=True).start()
+        return server
+
+
+# ── Генератор нагрузки ────────────────────────────────────────────────────────
+class LoadGenerator:
+    def __init__(self, users: int, think: float, timeout: float, deliver):
+        self.users   = users
+        self.think   = think
+        self.timeout = timeout
+        self.deliver = deliver
+        self._lock   = threading.Lock()
+        self._ready: list[tuple[float, int]] = []
+        self._outstanding: dict[int, float] = {}
+        self._seq    = 0
+        self.measure_from = 0.0
+        self.sent = self.completed = self.timeouts = self.error_answers = 0
+        self.rejected = self.conn_errors = 0
+        self.latencies: list[float] = []
+        self._weights = [w for w, _, _ in ACTIONS]
+
+    def make_update(self, uid: int) -> dict:
+        _, kind, data = random.choices(ACTIONS, self._weights)[0]
+        self._seq += 1
+        user = {"id": uid, "is_bot": False, "first_name": f"U{uid}"}
+        chat = {"id": uid, "type": "private"}
+        if kind == "message":
+            return {"message": {
+                "message_id": self._seq, "date": int(time.time()), "chat": chat, "from": user, "text": data,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(data)}],
+            }}
+        return {"callback_query": {
+            "id": f"{uid}:{self._seq}", "from": user, "chat_instance": "load", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "…"},
+        }}
+
+    def on_response(self, uid: int, error: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            sent = self._outstanding.pop(uid, None)
+            if sent is None:
+                return                  # второй ответ на тот же апдейт (level-up и т.п.)
+            if sent >= self.measure_from:
+                self.completed += 1
+                self.latencies.append(now - sent)
+                if error:
+                    self.error_answers += 1
+            heapq.heappush(self._ready, (now + random.expovariate(1 / self.think), uid))
+
+    def on_rejected(self, uid: int, refused: bool) -> None:
+        # webhook не принял апдейт: ответ не 200 (refused=False) или соединение
+        # не установилось/сброшено (refused=True); пользователь попробует позже
+        with self._lock:
+            sent = self._outstanding.pop(uid, None)
+            if sent is None:
+                return
+            if sent >= self.measure_from:
+                if refused:
+                    self.conn_errors += 1
+                else:
+                    self.rejected += 1
+            heapq.heappush(self._ready, (time.monotonic() + self.think, uid))
+
+    def run(self, duration: float, warmup: float) -> float:
+        start = time.monotonic()
+        self.measure_from = start + warmup
+        stop  = self.measure_from + duration
+        with self._lock:
+            for i in range(self.users):
+                heapq.heappush(self._ready, (start + random.uniform(0, self.think), FIRST_UID + i))
+        next_sweep = start
+        while (now := time.monotonic()) < stop:
+            batch = []
+            with self._lock:
+                while self._ready and self._ready[0][0] <= now:
+                    _, uid = heapq.heappop(self._ready)
+                    self._outstanding[uid] = now
+                    batch.append(uid)
+                if now >= next_sweep:
+                    for uid, sent in list(self._outstanding.items()):
+                        if now - sent > self.timeout:
+                            del self._outstanding[uid]
+                            if sent >= self.measure_from:
+                                self.timeouts += 1
+                            heapq.heappush(self._ready, (now + self.think, uid))
+                    next_sweep = now + 0.5
+                wake = self._ready[0][0] if self._ready else now + 0.01
+            for uid in batch:
+                if now >= self.measure_from:
+                    self.sent += 1
+                self.deliver(uid, self.make_update(uid))
+            time.sleep(max(0.0, min(wake - time.monotonic(), 0.01)))
+        return time.monotonic() - self.measure_from
+
+
+class WebhookSender:
+    """Пул потоков, отправляющих апдейты POST-ом в webhook бота, как это делает Telegram."""
+    def __init__(self, url: str, secret: str, threads: int, on_rejected):
+        self.url, self.secret, self.on_rejected = url, secret, on_rejected
+        self._q: queue.Queue = queue.Queue()
+        self._next_id = 1
+        for i in range(threads):
+            threading.Thread(target=self._run, name=f"webhook-{i}", daemon=True).start()
+
+    def deliver(self, uid: int, update: dict) -> None:
+        update["update_id"] = self._next_id
+        self._next_id += 1
+        self._q.put((uid, update))
+
+    def _run(self) -> None:
+        while True:
+            uid, update = self._q.get()
+            req = urllib.request.Request(self.url, data=json.dumps(update).encode(), headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": self.secret,
+            })
+            try:
+                with urllib.request.urlopen(req, timeout=10) as resp:
+                    if resp.status != 200:
+                        self.on_rejected(uid, refused=False)
+            except urllib.error.HTTPError:
+                self.on_rejected(uid, refused=False)
+            except (urllib.error.URLError, OSError):
+                self.on_rejected(uid, refused=True)
+
+
+# ── Запуск ────────────────────────────────────────────────────────────────────
+def start_bot(workdir: str, env: dict) -> subprocess.Popen:
+    log = open(os.path.join(workdir, "stdout.log"), "wb")
+    return subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_port(port: int, deadline: float) -> bool:
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    ap.add_argument("--threads", type=int, default=None, help="BOT_THREADS бота в режиме polling")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--duration", type=float, default=30.0, help="секунд измерения (после прогрева)")
+    ap.add_argument("--warmup", type=float, default=3.0)
+    ap.add_argument("--think-ms", type=float, default=1000.0)
+    ap.add_argument("--timeout", type=float, default=10.0, help="сколько ждать ответа бота, с")
+    ap.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа Bot API на send/edit/answer")
+    ap.add_argument("--jitter-ms", type=float, default=5.0)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--webhook-threads", type=int, default=32)
+    ap.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE",
+                    help="доп. переменные окружения бота (можно несколько раз)")
+    args = ap.parse_args()
+
+    gen = LoadGenerator(args.users, args.think_ms / 1000, args.timeout, deliver=None)
+    api = FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, gen.on_response)
+    api_port = free_port()
+    server   = api.serve(api_port)
+
+    workdir = tempfile.mkdtemp(prefix="risehunt-load-")
+    env = dict(os.environ, BOT_TOKEN=TOKEN, TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}")
+    env.update(kv.split("=", 1) for kv in args.bot_env)
+    if args.mode == "webhook":
+        hook_port = free_port()
+        secret    = secrets.token_hex(16)
+        env.update(BOT_RUNTIME="webhook", WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(hook_port),
+                   WEBHOOK_SECRET=secret, WEBHOOK_URL="")
+        sender = WebhookSender(f"http://127.0.0.1:{hook_port}/webhook", secret, args.webhook_threads,
+                               gen.on_rejected)
+        gen.deliver = sender.deliver
+    else:
+        env["BOT_RUNTIME"] = "sync"
+        if args.threads is not None:
+            env["BOT_THREADS"] = str(args.threads)
+        gen.deliver = lambda uid, update: api.push(update)
+
+    proc = start_bot(workdir, env)
+    try:
+        deadline = time.monotonic() + 30
+        ready = (wait_port(hook_port, deadline) if args.mode == "webhook"
+                 else api.polled.wait(max(0.0, deadline - time.monotonic())))
+        if not ready or proc.poll() is not None:
+            print(f"Бот не поднялся, см. {workdir}/stdout.log")
+            return 1
+        print(f"Бот запущен ({args.mode}, {env['BOT_RUNTIME']}), папка {workdir}")
+        elapsed = gen.run(args.duration, args.warmup)
+        time.sleep(min(args.timeout, 2.0))      # дождаться ответов на последние апдейты
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        server.shutdown()
+
+    lat    = sorted(gen.latencies)
+    errors = gen.timeouts + gen.error_answers + gen.rejected + gen.conn_errors
+    print(f"\n{args.users} пользователей, think {args.think_ms:.0f} мс, Bot API {args.latency_ms:.0f}±"
+          f"{args.jitter_ms:.0f} мс, 429: {args.rate_429:.1%}, окно {elapsed:.1f} с")
+    print(f"отправлено апдейтов    {gen.sent}")
+    print(f"получено ответов       {gen.completed}  ({gen.completed / elapsed:.0f} апдейтов/с)")
+    print("латентность, мс        "
+          + "  ".join(f"{name} {percentile(lat, q) * 1000:.0f}"
+                      for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))))
+    print(f"ошибки                 {errors} ({errors / max(gen.sent, 1):.2%}): таймаут {gen.timeouts}, "
+          f"ответ с ошибкой {gen.error_answers}, webhook отклонил {gen.rejected}, "
+          f"соединение не принято {gen.conn_errors}")
+    print(f"Bot API                429 выдано {api.injected_429}; запросы: "
+          + ", ".join(f"{k} {v}" for k, v in sorted(api.requests.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Микробенчмарк маршрутизации callback_data: стоимость выбора хендлера
+на каждый маршрут — старая цепочка if/elif против CallbackRouter.
+
+    python bench/router.py [--number 200000]
+
+Меряется только выбор ветки (и разбор аргументов), сами хендлеры не вызываются.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.chdir(tempfile.mkdtemp(prefix="risehunt-bench-"))   # лог и БД бота — во временной папке
+
+import bot  # noqa: E402
+
+
+def legacy_route(data: str):
+    """Цепочка условий из прежнего callback_handler — в том же порядке, с тем же разбором."""
+    if data == "main_menu":
+        return "main_menu", ()
+    elif data == "profile":
+        return "profile", ()
+    elif data == "edit_name":
+        return "edit_name", ()
+    elif data == "reg_age_skip":
+        return "reg_age_skip", ()
+    elif data.startswith("reg_gender_"):
+        return "reg_gender", (data[len("reg_gender_"):],)
+    elif data == "reg_tg_skip":
+        return "reg_tg_skip", ()
+    elif data == "reg_action_goals":
+        return "reg_action_goals", ()
+    elif data == "reg_goals_done":
+        return "reg_goals_done", ()
+    elif data == "reg_action_workout":
+        return "reg_action_workout", ()
+    elif data == "tests_menu":
+        return "tests_menu", ()
+    elif data == "test_PV":
+        return "test_PV", ()
+    elif data.startswith("pv_cat_"):
+        return "pv_cat", (data[7:],)
+    elif data in bot.TESTS_CONFIG:
+        return "test", (data,)
+    elif data == "journal":
+        return "journal", ()
+    elif data == "journal_emotions":
+        return "journal_emotions", ()
+    elif data == "journal_reflection":
+        return "journal_reflection", ()
+    elif data == "journal_workout":
+        return "journal_workout", ()
+    elif data == "journal_history":
+        return "journal_history", ()
+    elif data.startswith("jentry_"):
+        return "jentry", (int(data[7:]),)
+    elif data.startswith("training_"):
+        return "training", (int(data.split("_")[1]),)
+    elif data in ("goals", "goals_day", "goals_week", "goals_month"):
+        return "goals", ("day" if data in ("goals", "goals_day") else data.split("_")[1],)
+    elif data.startswith("goal_add_"):
+        return "goal_add", (data[9:],)
+    elif data.startswith("goal_dir_"):
+        parts = data.split("_")
+        return "goal_dir", (parts[2], parts[3])
+    elif data.startswith("goal_manage_"):
+        parts = data.split("_")
+        return "goal_manage", (int(parts[2]), parts[3])
+    elif data.startswith("goal_done_"):
+        parts = data.split("_")
+        return "goal_done", (int(parts[2]), parts[3])
+    elif data.startswith("goal_undo_"):
+        parts = data.split("_")
+        return "goal_undo", (int(parts[2]), parts[3])
+    elif data.startswith("goal_del_"):
+        parts = data.split("_")
+        return "goal_del", (int(parts[2]), parts[3])
+    return None
+
+
+# (маршрут, старый callback_data, новый callback_data)
+SAMPLES = [
+    ("main_menu",       "main_menu",              "main_menu"),
+    ("profile",         "profile",                "profile"),
+    ("reg_gender",      "reg_gender_skip",        bot.cb_data("reg_gender", "skip")),
+    ("tests_menu",      "tests_menu",             "tests_menu"),
+    ("pv_cat",          "pv_cat_pv_novice",       bot.cb_data("pv_cat", "pv_novice")),
+    ("test_IQ",         "test_IQ",                "test_IQ"),
+    ("journal_history", "journal_history",        "journal_history"),
+    ("jentry",          "jentry_1234",            bot.cb_data("jentry", 1234)),
+    ("training",        "training_3",             bot.cb_data("training", 3)),
+    ("goals_week",      "goals_week",             "goals_week"),
+    ("goal_dir",        "goal_dir_week_EQ",       bot.cb_data("goal_dir", "week", "EQ")),
+    ("goal_manage",     "goal_manage_4321_week",  bot.cb_data("goal_manage", 4321, "week")),
+    ("goal_done",       "goal_done_4321_week",    bot.cb_data("goal_done", 4321, "week")),
+    ("goal_undo",       "goal_undo_4321_week",    bot.cb_data("goal_undo", 4321, "week")),
+    ("goal_del",        "goal_del_4321_week",     bot.cb_data("goal_del", 4321, "week")),
+]
+
+
+def ns_per_call(fn, arg, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=3)) / number * 1e9
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--number", type=int, default=200_000)
+    args = ap.parse_args()
+
+    resolve = bot.callbacks.resolve
+    print(f"{'маршрут':<16} {'if/elif, нс':>12} {'router v0, нс':>14} {'router v1, нс':>14}")
+    for name, old, new in SAMPLES:
+        assert legacy_route(old) is not None and resolve(old) is not None and resolve(new) is not None, name
+        before = ns_per_call(legacy_route, old, args.number)
+        v0     = ns_per_call(resolve, old, args.number)
+        v1     = ns_per_call(resolve, new, args.number)
+        print(f"{name:<16} {before:>12.0f} {v0:>14.0f} {v1:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,228 @@
 import os
+import sys
+import signal
+import atexit
 import sqlite3
 import logging
-from datetime import datetime
-from telebot import TeleBot
+import logging.handlers
+import threading
+import time
+import queue
+import re
+import heapq
+import bisect
+import json
+import hmac
+import hashlib
+import functools
+import itertools
+import contextlib
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import ClassVar
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 
 # ── Logging ───────────────────────────────────────────────────────────────────
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("risehunt.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+# .env читается до настройки логов: LOG_* тоже берутся оттуда
+load_dotenv()
+
+# Хендлеры только кладут запись в очередь, в файл и консоль пишет фоновый
+# QueueListener. Файл ротируется по размеру (LOG_ROTATE=size) или по времени
+# (LOG_ROTATE=time, граница LOG_WHEN). LOG_FORMAT=json — одна JSON-строка на
+# запись с полями user_id/route/kind/duration_ms, если они переданы в extra.
+# LOG_SAMPLE — доля INFO-событий хендлеров, которая попадает в лог:
+# "callback=0.1,callback:cb_goals=1,*=0.5" (сначала ищется kind:route, затем
+# kind, затем *; по умолчанию пишется всё). WARNING и выше не сэмплируются.
+LOG_FILE      = os.getenv("LOG_FILE", "risehunt.log")
+LOG_LEVEL     = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT    = os.getenv("LOG_FORMAT", "text")
+LOG_ROTATE    = os.getenv("LOG_ROTATE", "size")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_WHEN      = os.getenv("LOG_WHEN", "midnight")
+LOG_BACKUPS   = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_CONSOLE   = os.getenv("LOG_CONSOLE", "1") == "1"
+LOG_SAMPLE    = os.getenv("LOG_SAMPLE", "")
+
+LOG_FIELDS = ("user_id", "kind", "route", "duration_ms")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts":     self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level":  record.levelname,
+            "logger": record.name,
+            "msg":    record.getMessage(),
+        }
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogSampler(logging.Filter):
+    """Пропускает каждое N-е INFO-событие маршрута (N = 1/доля), остальные отбрасывает до очереди."""
+
+    def __init__(self, spec: str):
+        super().__init__()
+        self.rates: dict[str, float] = {}
+        for part in spec.split(","):
+            key, _, rate = part.partition("=")
+            if key.strip() and rate.strip():
+                self.rates[key.strip()] = float(rate)
+        self.counters: dict[str, itertools.count] = {}
+
+    def _every(self, kind: str, route: str) -> int:
+        rate = self.rates.get(f"{kind}:{route}", self.rates.get(kind, self.rates.get("*", 1.0)))
+        return round(1 / rate) if rate > 0 else 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = getattr(record, "route", None)
+        if route is None or record.levelno > logging.INFO or not self.rates:
+            return True
+        kind  = getattr(record, "kind", "")
+        every = self._every(kind, route)
+        if every <= 1:
+            return every == 1
+        counter = self.counters.get(f"{kind}:{route}")
+        if counter is None:
+            counter = self.counters.setdefault(f"{kind}:{route}", itertools.count())
+        return next(counter) % every == 0
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Как QueueHandler, но traceback остаётся в exc_text, а не вклеивается в
+    сообщение: JSON-формат кладёт его в отдельное поле.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg      = record.getMessage()
+        record.args     = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    if LOG_ROTATE == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    targets = [file_handler]
+    if LOG_CONSOLE:
+        targets.append(logging.StreamHandler())
+    for handler in targets:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogSampler(LOG_SAMPLE))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+
+    listener = logging.handlers.QueueListener(log_queue, *targets, respect_handler_level=True)
+    listener.start()
+    # stop() дописывает всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 log = logging.getLogger(__name__)
 
 # ── Config ────────────────────────────────────────────────────────────────────
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не найден в .env")
 
-bot = TeleBot(BOT_TOKEN)
+# sync    — штатный TeleBot с infinity_polling и его пулом из BOT_THREADS потоков;
+# webhook — встроенный HTTP-сервер принимает апдейты от Telegram (см. run_webhook)
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync")
+if BOT_RUNTIME in ("async", "async_pool"):
+    # Хендлеры синхронные (SQLite, Bot API), асинхронный приём перед тем же
+    # пулом потоков ничего не давал — число одновременных апдейтов задаёт BOT_THREADS
+    log.warning("BOT_RUNTIME=%s больше не поддерживается, используется sync", BOT_RUNTIME)
+    BOT_RUNTIME = "sync"
+if BOT_RUNTIME not in ("sync", "webhook"):
+    raise RuntimeError(f"Неизвестный BOT_RUNTIME: {BOT_RUNTIME}")
+# Потоки TeleBot для хендлеров в режиме sync без диспетчера (по умолчанию как в TeleBot)
+BOT_THREADS = int(os.getenv("BOT_THREADS", "2"))
+
+# Свой сервер Bot API: self-hosted telegram-bot-api или стенд из bench/loadgen.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+# Число шардов диспетчера (0 — выключен, апдейты обрабатывает пул TeleBot)
+DISPATCH_SHARDS = int(os.getenv("DISPATCH_SHARDS", "0"))
+
+# Telegram user_id администраторов через запятую (служебные команды)
+ADMIN_IDS = frozenset(x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
+
+
+# Приоритеты исходящих сообщений (см. Outbox)
+PRIO_INTERACTIVE = 0
+PRIO_BACKGROUND  = 1
+
+
+class RiseBot(TeleBot):
+    """
+    TeleBot с двумя точками расширения: при включённом диспетчере апдейты
+    раскладываются по шардам, при включённом outbox исходящие сообщения
+    уходят через очередь с лимитами (тогда send/edit возвращают None).
+    """
+    dispatcher = None
+    outbox     = None
+
+    def process_new_updates(self, updates):
+        count_updates(updates)
+        if self.dispatcher is None:
+            return super().process_new_updates(updates)
+        for upd in updates:
+            # offset следующего getUpdates берётся из last_update_id, а шард
+            # обработает апдейт позже — сдвигаем сразу, иначе апдейт придёт повторно
+            self.last_update_id = max(self.last_update_id, upd.update_id)
+            self.dispatcher.submit(update_user_id(upd), super().process_new_updates, [upd])
+
+    def send_message(self, chat_id, text, *args, priority: int = PRIO_INTERACTIVE, **kwargs):
+        if self.outbox is None:
+            return super().send_message(chat_id, text, *args, **kwargs)
+        self.outbox.submit(chat_id, priority, super().send_message, chat_id, text, *args, **kwargs)
+
+    def edit_message_text(self, text=None, chat_id=None, *args, priority: int = PRIO_INTERACTIVE,
+                          on_done=None, **kwargs):
+        if self.outbox is None:
+            try:
+                result = super().edit_message_text(text, chat_id, *args, **kwargs)
+            except Exception as e:
+                if on_done is not None:
+                    on_done(e)
+                raise
+            if on_done is not None:
+                on_done(None)
+            return result
+        self.outbox.submit(chat_id, priority, super().edit_message_text, text, chat_id, *args,
+                           on_done=on_done, **kwargs)
+
+
+bot = RiseBot(BOT_TOKEN, threaded=BOT_RUNTIME == "sync" and not DISPATCH_SHARDS, num_threads=BOT_THREADS)
 DB_FILE = "risehunt.db"
-user_states: dict[str, dict] = {}
 
 VALID_DIRECTIONS = {"PV", "IQ", "EQ", "SQ", "AQ", "XQ"}
 
@@ -248,139 +445,1297 @@ def pv_label(score: float) -> str:
     if score >= 3.0: return "💚 Низкая"
     return "⬇️ Критическая витальность"
 
+# ── Metrics ───────────────────────────────────────────────────────────────────
+# Метрики в текстовом формате Prometheus на METRICS_HOST:METRICS_PORT/metrics
+# (0 — выключено, тогда и замеры не делаются). Гистограммы латентности
+# хендлеров по маршруту/состоянию, запросов SQLite по типу, вызовов Bot API по
+# методу; счётчики ошибок API и входящих апдейтов; размер user_states.
+METRICS_PORT    = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST    = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_ENABLED = METRICS_PORT > 0
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS      = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"] + [
+            f"{self.name}{_fmt_labels(self.labels, k)} {v:g}" for k, v in items
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._series: dict[tuple, list] = {}     # labels -> [счётчики по корзинам..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._series.get(labels)
+            if row is None:
+                row = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, row in items:
+            total = 0
+            for le, n in zip((*self.buckets, "+Inf"), row):
+                total += n
+                le_label = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le_label)} {total}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {row[-1]:.6f}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {total}")
+        return out
+
+
+class Gauge:
+    """
+    Значение снимается в момент запроса /metrics. fn возвращает число или
+    {значения меток: число} (пустой dict — компонент выключен, значений нет).
+    kind="counter" — для накопительных счётчиков, которые компонент и так
+    ведёт у себя (stats()).
+    """
+    def __init__(self, name: str, doc: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.doc, self.fn, self.labels, self.kind = name, doc, fn, labels, kind
+
+    def render(self) -> list[str]:
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + [
+            f"{self.name}{_fmt_labels(self.labels, k)} {v:g}" for k, v in sorted(values.items())
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def counter(self, name: str, doc: str, labels: tuple = ()) -> Counter:
+        self.metrics.append(m := Counter(name, doc, labels))
+        return m
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        self.metrics.append(m := Histogram(name, doc, labels, buckets))
+        return m
+
+    def gauge(self, name: str, doc: str, fn, labels: tuple = (), kind: str = "gauge") -> Gauge:
+        self.metrics.append(m := Gauge(name, doc, fn, labels, kind))
+        return m
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            try:
+                lines.extend(m.render())
+            except Exception:
+                log.exception("Метрика %s не отрисовалась", m.name)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("risehunt_handler_seconds", "Время обработки апдейта хендлером",
+                                    ("kind", "route"))
+HANDLER_ERRORS  = metrics.counter("risehunt_handler_errors_total", "Исключения в хендлерах", ("kind", "route"))
+DB_SECONDS      = metrics.histogram("risehunt_db_query_seconds", "Время выполнения запроса SQLite",
+                                    ("op",), DB_BUCKETS)
+TG_SECONDS      = metrics.histogram("risehunt_tg_api_seconds", "Латентность вызовов Bot API", ("method",))
+TG_ERRORS       = metrics.counter("risehunt_tg_api_errors_total", "Ошибки вызовов Bot API", ("method", "code"))
+UPDATES_TOTAL   = metrics.counter("risehunt_updates_total", "Принятые апдейты", ("type",))
+
+
+@contextlib.contextmanager
+def observe_handler(kind: str, route: str, user_id: str | None = None):
+    """
+    Замер хендлера: метрики, пометка потока маршрутом для профилировщика и
+    INFO-событие с длительностью (его прореживает LOG_SAMPLE).
+    """
+    profiling = profiler.active
+    tid = threading.get_ident()
+    if profiling:
+        profiler.enter(tid, f"{kind}:{route}")
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if METRICS_ENABLED:
+            HANDLER_ERRORS.inc(kind, route)
+        raise
+    else:
+        if log.isEnabledFor(logging.INFO):
+            duration_ms = round((time.perf_counter() - start) * 1000, 2)
+            log.info("%s %s от %s: %.1f мс", kind, route, user_id, duration_ms, extra={
+                "user_id": user_id, "kind": kind, "route": route, "duration_ms": duration_ms})
+    finally:
+        if METRICS_ENABLED:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, kind, route)
+        if profiling:
+            profiler.leave(tid)
+
+
+def count_updates(updates) -> None:
+    if not METRICS_ENABLED:
+        return
+    for upd in updates:
+        UPDATES_TOTAL.inc("callback_query" if upd.callback_query else "message" if upd.message else "other")
+
+
+@functools.lru_cache(maxsize=512)
+def _sql_op(sql: str) -> str:
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "?"
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, замеряющее execute/executemany (без выборки строк и COMMIT)."""
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, _sql_op(sql))
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, _sql_op(sql))
+
+
+def _timed_tg_request(method, url, **kwargs):
+    # Подменяет отправку HTTP в apihelper: тот же requests-сеанс, плюс замеры
+    name  = url.rsplit("/", 1)[-1]
+    start = time.perf_counter()
+    try:
+        resp = apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception as e:
+        TG_ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        TG_SECONDS.observe(time.perf_counter() - start, name)
+    if resp.status_code != 200:
+        TG_ERRORS.inc(name, str(resp.status_code))
+    return resp
+
+
+if METRICS_ENABLED:
+    apihelper.CUSTOM_REQUEST_SENDER = _timed_tg_request
+
+
+def run_metrics_server():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Метрики: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
+
+
+# ── Profiler ──────────────────────────────────────────────────────────────────
+# Сэмплирующий профилировщик, включается на время: /prof от администратора
+# или SIGUSR1. Пока он выключен, хендлеры платят одной проверкой флага.
+# Во время окна observe_handler помечает поток маршрутом ("callback:cb_goals",
+# "text:reg_name"), а отдельный поток каждые PROFILE_INTERVAL_MS снимает стеки
+# только помеченных потоков — простаивающие воркеры в профиль не попадают.
+# Результат — collapsed stacks (flamegraph.pl, speedscope) в PROFILE_DIR.
+PROFILE_DIR         = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_SECONDS     = int(os.getenv("PROFILE_SECONDS", "30"))
+PROFILE_MAX_SECONDS = 300
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.active   = False
+        self._routes: dict[int, str] = {}
+        self._labels: dict = {}
+        self._lock    = threading.Lock()
+
+    def enter(self, tid: int, route: str) -> None:
+        self._routes[tid] = route
+
+    def leave(self, tid: int) -> None:
+        self._routes.pop(tid, None)
+
+    def start(self, seconds: float, on_done=None) -> bool:
+        """Запускает окно профилирования; False, если оно уже идёт."""
+        with self._lock:
+            if self.active:
+                return False
+            self.active = True
+        threading.Thread(target=self._run, args=(seconds, on_done), name="profiler", daemon=True).start()
+        return True
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self, seconds: float, on_done) -> None:
+        stacks: dict[str, int] = {}
+        deadline = time.monotonic() + seconds
+        samples  = 0
+        try:
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                for tid, route in list(self._routes.items()):
+                    frame = frames.get(tid)
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    if stack:
+                        stack.append(route)
+                        key = ";".join(reversed(stack))
+                        stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            self.active = False
+            self._routes.clear()
+        path = self._dump(stacks)
+        log.info("Профиль записан: %s (%s тиков, %s стеков)", path, samples, sum(stacks.values()))
+        if on_done:
+            try:
+                on_done(path, stacks)
+            except Exception:
+                log.exception("Ошибка при отправке результата профилирования")
+
+    @staticmethod
+    def _dump(stacks: dict[str, int]) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in sorted(stacks.items()):
+                f.write(f"{stack} {n}\n")
+        return path
+
+
+def profile_summary(stacks: dict[str, int], top: int = 8) -> list[tuple[str, int]]:
+    """Сэмплы по маршрутам (первый элемент стека), по убыванию."""
+    routes: dict[str, int] = {}
+    for stack, n in stacks.items():
+        route = stack.split(";", 1)[0]
+        routes[route] = routes.get(route, 0) + n
+    return sorted(routes.items(), key=lambda kv: -kv[1])[:top]
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+
 # ── Database ──────────────────────────────────────────────────────────────────
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_FILE)
+# Одно долгоживущее соединение на поток: открывается при первом обращении,
+# дальше переиспользуется вместе с кэшем подготовленных запросов.
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+DB_CACHE_SIZE_KB     = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_BUSY_TIMEOUT_MS   = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+_db_local = threading.local()
+_db_conns: dict[int, tuple[threading.Thread, sqlite3.Connection]] = {}
+_db_conns_lock = threading.Lock()
+
+
+def _open_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        check_same_thread=False,    # закрываем из главного потока при остановке
+        factory=TimedConnection if METRICS_ENABLED else sqlite3.Connection,
+    )
     conn.row_factory = sqlite3.Row
+    # Действует только на новый файл БД (до создания таблиц), иначе — no-op
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
 
-def init_db() -> None:
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        return conn
+    conn   = _open_conn()
+    thread = threading.current_thread()
+    with _db_conns_lock:
+        # Соединения завершившихся потоков больше никому не нужны
+        for ident, (t, c) in list(_db_conns.items()):
+            if not t.is_alive():
+                c.close()
+                del _db_conns[ident]
+        _db_conns[thread.ident] = (thread, conn)
+    _db_local.conn = conn
+    return conn
+
+
+def close_all_conns() -> None:
+    with _db_conns_lock:
+        for _, conn in _db_conns.values():
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _db_conns.clear()
+    _db_local.conn = None
+
+
+# ── Write-behind ──────────────────────────────────────────────────────────────
+# В режиме DB_WRITE_BEHIND=1 записи журнала, целей и баллов не коммитятся
+# прямо в хендлере, а уходят в очередь и сбрасываются пачками в одной
+# транзакции. Любое чтение данных пользователя сначала дожидается его
+# несохранённых записей, поэтому пользователь всегда видит свои изменения.
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+WB_BATCH_SIZE   = int(os.getenv("DB_WB_BATCH_SIZE", "64"))
+WB_FLUSH_MS     = int(os.getenv("DB_WB_FLUSH_MS", "50"))
+
+
+class WriteBehindQueue:
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self._items: list[tuple[str, str, tuple]] = []   # (user_id, sql, params)
+        self._pending: dict[str, int] = {}
+        self._cond     = threading.Condition()
+        self._urgent   = False
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+        self.batches   = 0
+        self.written   = 0
+
+    @property
+    def active(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stopping = False
+        self._thread   = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        log.info("Write-behind включён: batch=%s, flush=%.0f мс",
+                 self.batch_size, self.flush_interval * 1000)
+
+    def submit(self, user_id: str, sql: str, params: tuple) -> None:
+        with self._cond:
+            self._items.append((user_id, sql, params))
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+            if len(self._items) >= self.batch_size:
+                self._cond.notify_all()
+
+    def wait_user(self, user_id: str) -> None:
+        """Блокирует до тех пор, пока все записи пользователя не попадут в БД."""
+        with self._cond:
+            if not self._pending.get(user_id):
+                return
+            self._urgent = True
+            self._cond.notify_all()
+            while self._pending.get(user_id):
+                self._cond.wait()
+
+    def flush(self) -> None:
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            while self._items or self._pending:
+                self._cond.wait()
+
+    def stop(self) -> None:
+        if not self._thread:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        log.info("Write-behind остановлен: %s записей в %s пачках", self.written, self.batches)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                deadline = None
+                while not self._stopping and not self._urgent and len(self._items) < self.batch_size:
+                    if self._items and deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = self._items[:self.batch_size]
+                del self._items[:self.batch_size]
+                if not self._items:
+                    self._urgent = False
+                if not batch and self._stopping:
+                    return
+            if batch:
+                self._commit(batch)
+            with self._cond:
+                for user_id, _, _ in batch:
+                    left = self._pending[user_id] - 1
+                    if left:
+                        self._pending[user_id] = left
+                    else:
+                        del self._pending[user_id]
+                self._cond.notify_all()
+
+    def _commit(self, batch: list[tuple[str, str, tuple]]) -> None:
+        conn = get_conn()
+        try:
+            with conn:
+                for _, sql, params in batch:
+                    conn.execute(sql, params)
+        except sqlite3.Error:
+            # Пачка откатилась целиком — повторяем по одной, чтобы
+            # одна сломанная запись не утянула за собой остальные
+            log.exception("Ошибка групповой записи, повтор по одной (%s шт.)", len(batch))
+            for _, sql, params in batch:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                except sqlite3.Error:
+                    log.exception("Запись потеряна: %s %s", sql, params)
+        self.batches += 1
+        self.written += len(batch)
+
+
+write_queue = WriteBehindQueue(WB_BATCH_SIZE, WB_FLUSH_MS / 1000)
+metrics.gauge("risehunt_write_queue_pending", "Записи write-behind, ещё не попавшие в БД",
+              lambda: len(write_queue._items))
+metrics.gauge("risehunt_write_queue_batches_total", "Пачки, записанные write-behind",
+              lambda: write_queue.batches, kind="counter")
+metrics.gauge("risehunt_write_queue_written_total", "Записи, сохранённые write-behind",
+              lambda: write_queue.written, kind="counter")
+
+
+def _write(user_id: str, sql: str, params: tuple) -> None:
+    if write_queue.active:
+        write_queue.submit(user_id, sql, params)
+        return
     with get_conn() as conn:
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id     TEXT PRIMARY KEY,
-                PV          REAL    DEFAULT 5.0,
-                IQ          REAL    DEFAULT 5.0,
-                EQ          REAL    DEFAULT 5.0,
-                SQ          REAL    DEFAULT 5.0,
-                AQ          REAL    DEFAULT 5.0,
-                XQ          REAL    DEFAULT 5.0,
-                level       INTEGER DEFAULT 1,
-                name        TEXT    DEFAULT NULL,
-                age         INTEGER DEFAULT NULL,
-                gender      TEXT    DEFAULT NULL,
-                tg_username TEXT    DEFAULT NULL,
-                onboarded   INTEGER DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS journal (
-                id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id    TEXT NOT NULL,
-                type       TEXT NOT NULL,
-                content    TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            );
-            CREATE TABLE IF NOT EXISTS goals (
-                id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id    TEXT NOT NULL,
-                period     TEXT NOT NULL CHECK(period IN ('day','week','month')),
-                direction  TEXT NOT NULL DEFAULT 'PV',
-                title      TEXT NOT NULL,
-                done       INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            );
-        """)
-        for ddl in [
-            "ALTER TABLE users ADD COLUMN level INTEGER DEFAULT 1",
-            "ALTER TABLE users ADD COLUMN name TEXT DEFAULT NULL",
-            "ALTER TABLE users ADD COLUMN age INTEGER DEFAULT NULL",
-            "ALTER TABLE users ADD COLUMN gender TEXT DEFAULT NULL",
-            "ALTER TABLE users ADD COLUMN tg_username TEXT DEFAULT NULL",
-            "ALTER TABLE users ADD COLUMN onboarded INTEGER DEFAULT 0",
-            "ALTER TABLE goals ADD COLUMN direction TEXT NOT NULL DEFAULT 'PV'",
-        ]:
+        conn.execute(sql, params)
+
+
+def _read_barrier(user_id: str) -> None:
+    if write_queue.active:
+        write_queue.wait_user(user_id)
+
+
+# ── Migrations ────────────────────────────────────────────────────────────────
+# Схема версионируется через PRAGMA user_version: версия N означает, что
+# применены первые N шагов из MIGRATIONS. При старте выполняются только
+# недостающие шаги, каждый — в своей транзакции вместе с записью версии.
+# Новые изменения схемы — только новым шагом в конец списка.
+def _add_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    cols = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _m001_baseline(conn: sqlite3.Connection) -> None:
+    # Таблицы в том виде, в каком их создавал прежний init_db; для старых БД
+    # (user_version = 0) — догоняем колонки, добавленные позже
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id     TEXT PRIMARY KEY,
+            PV          REAL    DEFAULT 5.0,
+            IQ          REAL    DEFAULT 5.0,
+            EQ          REAL    DEFAULT 5.0,
+            SQ          REAL    DEFAULT 5.0,
+            AQ          REAL    DEFAULT 5.0,
+            XQ          REAL    DEFAULT 5.0,
+            level       INTEGER DEFAULT 1,
+            name        TEXT    DEFAULT NULL,
+            age         INTEGER DEFAULT NULL,
+            gender      TEXT    DEFAULT NULL,
+            tg_username TEXT    DEFAULT NULL,
+            onboarded   INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id    TEXT NOT NULL,
+            type       TEXT NOT NULL,
+            content    TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS goals (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id    TEXT NOT NULL,
+            period     TEXT NOT NULL CHECK(period IN ('day','week','month')),
+            direction  TEXT NOT NULL DEFAULT 'PV',
+            title      TEXT NOT NULL,
+            done       INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    _add_column(conn, "users", "level",       "INTEGER DEFAULT 1")
+    _add_column(conn, "users", "name",        "TEXT DEFAULT NULL")
+    _add_column(conn, "users", "age",         "INTEGER DEFAULT NULL")
+    _add_column(conn, "users", "gender",      "TEXT DEFAULT NULL")
+    _add_column(conn, "users", "tg_username", "TEXT DEFAULT NULL")
+    _add_column(conn, "users", "onboarded",   "INTEGER DEFAULT 0")
+    _add_column(conn, "goals", "direction",   "TEXT NOT NULL DEFAULT 'PV'")
+
+
+def _m002_user_states(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id    TEXT PRIMARY KEY,
+            state      TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _m003_hot_indexes(conn: sqlite3.Connection) -> None:
+    # История журнала: user_id + ORDER BY created_at (rowid в индексе даёт порядок по id)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_user_created ON journal(user_id, created_at)")
+    # get_goals: user_id + period + ORDER BY id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_goals_user_period ON goals(user_id, period, id)")
+
+
+def _m004_journal_preview(conn: sqlite3.Connection) -> None:
+    # Превью и время для списка записей считаются один раз при сохранении
+    _add_column(conn, "journal", "preview",    "TEXT NOT NULL DEFAULT ''")
+    _add_column(conn, "journal", "display_ts", "TEXT NOT NULL DEFAULT ''")
+    # То же, что journal_preview(), для уже сохранённых записей
+    conn.execute("""
+        UPDATE journal SET
+            preview = CASE
+                WHEN instr(content, char(10, 10)) > 0
+                THEN replace(substr(content, instr(content, char(10, 10)) + 2, ?), char(10), ' ')
+                ELSE substr(content, 1, ?)
+            END,
+            display_ts = substr(created_at, 1, 16)
+    """, (JOURNAL_PREVIEW_LEN, JOURNAL_PREVIEW_LEN))
+
+
+def _m005_journal_type_index(conn: sqlite3.Connection) -> None:
+    # Постраничная история с фильтром по типу: user_id + type + (created_at, id)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_journal_user_type_created ON journal(user_id, type, created_at)"
+    )
+
+
+# Текст для полнотекстового индекса: unicode61 не склеивает «ё» с «е», поэтому
+# нормализуем сами. Длина строки не меняется — позиции токенов для snippet()
+# совпадают с исходным journal.content.
+def _fts_text(expr: str) -> str:
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _m006_journal_fts(conn: sqlite3.Connection) -> None:
+    # FTS5 поверх journal (external content): текст не дублируется, индекс
+    # поддерживается триггерами — в т.ч. при удалении старых записей в prune_journal
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS journal_fts USING fts5(
+            content,
+            content='journal',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS journal_fts_ai AFTER INSERT ON journal BEGIN
+            INSERT INTO journal_fts(rowid, content) VALUES (new.id, {_fts_text("new.content")});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS journal_fts_ad AFTER DELETE ON journal BEGIN
+            INSERT INTO journal_fts(journal_fts, rowid, content)
+            VALUES ('delete', old.id, {_fts_text("old.content")});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS journal_fts_au AFTER UPDATE OF content ON journal BEGIN
+            INSERT INTO journal_fts(journal_fts, rowid, content)
+            VALUES ('delete', old.id, {_fts_text("old.content")});
+            INSERT INTO journal_fts(rowid, content) VALUES (new.id, {_fts_text("new.content")});
+        END
+    """)
+    conn.execute(f"INSERT INTO journal_fts(rowid, content) SELECT id, {_fts_text('content')} FROM journal")
+
+
+def _m007_goals_archive(conn: sqlite3.Connection) -> None:
+    # Каждая цель привязана к своему периоду (локальная дата начала дня/недели/месяца);
+    # закрытые периоды уезжают в goals_archive, итоги — в goal_period_stats
+    _add_column(conn, "users", "tz",           "TEXT DEFAULT NULL")
+    _add_column(conn, "goals", "period_start", "TEXT NOT NULL DEFAULT ''")
+    # Старым целям — период по created_at (UTC, точнее уже не восстановить)
+    conn.execute("""
+        UPDATE goals SET period_start = CASE period
+            WHEN 'day'   THEN date(created_at)
+            WHEN 'week'  THEN date(created_at, '-6 days', 'weekday 1')
+            WHEN 'month' THEN date(created_at, 'start of month')
+        END
+        WHERE period_start = ''
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS goals_archive (
+            id           INTEGER PRIMARY KEY,
+            user_id      TEXT NOT NULL,
+            period       TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            direction    TEXT NOT NULL,
+            title        TEXT NOT NULL,
+            done         INTEGER NOT NULL,
+            created_at   TIMESTAMP,
+            archived_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS goal_period_stats (
+            user_id      TEXT NOT NULL,
+            period       TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            total        INTEGER NOT NULL,
+            done         INTEGER NOT NULL,
+            PRIMARY KEY (user_id, period, period_start)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_goals_archive_user ON goals_archive(user_id, period, period_start)"
+    )
+    # rollover: поиск целей из закрытых периодов
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_goals_period_start ON goals(period, period_start)")
+
+
+def _m008_leaderboard(conn: sqlite3.Connection) -> None:
+    # Очки рейтингов: одна строка на (доска, пользователь), обновляется точечно
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            board   TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            score   REAL NOT NULL,
+            PRIMARY KEY (board, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.executemany(
+        "INSERT OR REPLACE INTO leaderboard (board, user_id, score) VALUES (?, ?, ?)",
+        (
+            (board, u["user_id"], score)
+            for u in conn.execute("SELECT * FROM users WHERE onboarded = 1").fetchall()
+            for board, score in board_scores(dict(u)).items()
+        ),
+    )
+
+
+def _m009_score_history(conn: sqlite3.Connection) -> None:
+    # Журнал изменений направлений (append-only) и свёртки по дням/неделям.
+    # Свёртки обновляются при каждом изменении, сырые события со временем удаляются
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS score_history (
+            id         INTEGER PRIMARY KEY,
+            user_id    TEXT NOT NULL,
+            direction  TEXT NOT NULL,
+            old_value  REAL NOT NULL,
+            value      REAL NOT NULL,
+            reason     TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_score_history_created ON score_history(created_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS score_rollup (
+            user_id      TEXT NOT NULL,
+            bucket       TEXT NOT NULL CHECK(bucket IN ('day','week')),
+            bucket_start TEXT NOT NULL,
+            direction    TEXT NOT NULL,
+            open         REAL NOT NULL,
+            close        REAL NOT NULL,
+            lo           REAL NOT NULL,
+            hi           REAL NOT NULL,
+            n            INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket, bucket_start, direction)
+        ) WITHOUT ROWID
+    """)
+    # compact_scores: поиск старых дневных свёрток
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_score_rollup_bucket ON score_rollup(bucket, bucket_start)")
+
+
+def _m010_broadcasts(conn: sqlite3.Connection) -> None:
+    # Рассылки с контрольной точкой: cursor — последний обработанный user_id
+    # (получатели идут по первичному ключу users), счётчики копятся по пачкам.
+    # blocked_at — пользователь заблокировал бота, рассылки его пропускают
+    _add_column(conn, "users", "blocked_at", "TEXT DEFAULT NULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id          INTEGER PRIMARY KEY,
+            admin_id    TEXT    NOT NULL,
+            text        TEXT    NOT NULL,
+            status      TEXT    NOT NULL DEFAULT 'draft'
+                                CHECK(status IN ('draft','running','done','cancelled')),
+            cursor      TEXT    NOT NULL DEFAULT '',
+            total       INTEGER NOT NULL DEFAULT 0,
+            sent        INTEGER NOT NULL DEFAULT 0,
+            blocked     INTEGER NOT NULL DEFAULT 0,
+            failed      INTEGER NOT NULL DEFAULT 0,
+            active_sec  REAL    NOT NULL DEFAULT 0,
+            created_at  TEXT    NOT NULL,
+            finished_at TEXT
+        )
+    """)
+
+
+def _m011_journal_fts_user(conn: sqlite3.Connection) -> None:
+    # user_id — колонка индекса: фильтр user_id:"…" в MATCH отсекает чужие
+    # записи ещё в FTS, и bm25 ранжирует только записи пользователя, а не
+    # всё сообщество. Индекс пересобирается с нуля
+    for trigger in ("journal_fts_ai", "journal_fts_ad", "journal_fts_au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS journal_fts")
+    conn.execute("""
+        CREATE VIRTUAL TABLE journal_fts USING fts5(
+            content,
+            user_id,
+            content='journal',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    # Ранжируем только по тексту: совпадение user_id есть у каждой найденной записи
+    conn.execute("INSERT INTO journal_fts(journal_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    conn.execute(f"""
+        CREATE TRIGGER journal_fts_ai AFTER INSERT ON journal BEGIN
+            INSERT INTO journal_fts(rowid, content, user_id)
+            VALUES (new.id, {_fts_text("new.content")}, new.user_id);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER journal_fts_ad AFTER DELETE ON journal BEGIN
+            INSERT INTO journal_fts(journal_fts, rowid, content, user_id)
+            VALUES ('delete', old.id, {_fts_text("old.content")}, old.user_id);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER journal_fts_au AFTER UPDATE OF content, user_id ON journal BEGIN
+            INSERT INTO journal_fts(journal_fts, rowid, content, user_id)
+            VALUES ('delete', old.id, {_fts_text("old.content")}, old.user_id);
+            INSERT INTO journal_fts(rowid, content, user_id)
+            VALUES (new.id, {_fts_text("new.content")}, new.user_id);
+        END
+    """)
+    conn.execute(
+        f"INSERT INTO journal_fts(rowid, content, user_id) SELECT id, {_fts_text('content')}, user_id FROM journal"
+    )
+
+
+MIGRATIONS = [
+    _m001_baseline,
+    _m002_user_states,
+    _m003_hot_indexes,
+    _m004_journal_preview,
+    _m005_journal_type_index,
+    _m006_journal_fts,
+    _m007_goals_archive,
+    _m008_leaderboard,
+    _m009_score_history,
+    _m010_broadcasts,
+    _m011_journal_fts_user,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции, возвращает итоговую версию схемы."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Схема БД v{version} новее кода (v{len(MIGRATIONS)})")
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        log.info("Миграция %s (%s) применена", number, step.__name__)
+    return len(MIGRATIONS)
+
+
+def init_db() -> None:
+    version = migrate(get_conn())
+    log.info("БД инициализирована: %s (схема v%s)", DB_FILE, version)
+
+
+# ── Maintenance ───────────────────────────────────────────────────────────────
+# Фоновые задачи обслуживания БД в отдельном потоке: чистка журнала старше
+# JOURNAL_RETENTION_DAYS небольшими пачками, ANALYZE, incremental vacuum и
+# чистка протухших состояний. Пачки чистки ждут паузы в трафике, чтобы
+# не держать блокировку записи, пока пользователи жмут кнопки.
+JOURNAL_RETENTION_DAYS = int(os.getenv("JOURNAL_RETENTION_DAYS", "30"))
+PRUNE_BATCH            = int(os.getenv("PRUNE_BATCH", "500"))
+PRUNE_PAUSE_MS         = int(os.getenv("PRUNE_PAUSE_MS", "50"))
+PRUNE_IDLE_MS          = int(os.getenv("PRUNE_IDLE_MS", "200"))
+PRUNE_INTERVAL_SEC     = int(os.getenv("PRUNE_INTERVAL_SEC", "3600"))
+ANALYZE_INTERVAL_SEC   = int(os.getenv("ANALYZE_INTERVAL_SEC", str(24 * 3600)))
+VACUUM_INTERVAL_SEC    = int(os.getenv("VACUUM_INTERVAL_SEC", "3600"))
+VACUUM_PAGES           = int(os.getenv("VACUUM_PAGES", "1000"))
+
+_last_activity = 0.0
+
+
+def mark_activity() -> None:
+    """Отмечает интерактивный запрос — фоновые задачи подождут паузы."""
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+class MaintenanceJob:
+    __slots__ = ("name", "fn", "interval", "next_run", "runs", "errors",
+                 "total", "last", "max", "last_result")
+
+    def __init__(self, name: str, fn, interval: float, delay: float):
+        self.name     = name
+        self.fn       = fn
+        self.interval = interval
+        self.next_run = time.monotonic() + delay
+        self.runs = self.errors = 0
+        self.total = self.last = self.max = 0.0
+        self.last_result = None
+
+
+class MaintenanceScheduler:
+    def __init__(self):
+        self.jobs: list[MaintenanceJob] = []
+        self.stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, name: str, fn, interval: float, delay: float = 0.0) -> None:
+        self.jobs.append(MaintenanceJob(name, fn, interval, delay))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while self.jobs:
+            job = min(self.jobs, key=lambda j: j.next_run)
+            if self.stopping.wait(max(0.0, job.next_run - time.monotonic())):
+                return
+            started = time.monotonic()
             try:
-                conn.execute(ddl)
+                job.last_result = job.fn()
             except Exception:
-                pass
-        conn.execute("DELETE FROM journal WHERE created_at < datetime('now', '-30 days')")
-    log.info("БД инициализирована: %s", DB_FILE)
+                job.errors += 1
+                log.exception("Ошибка задачи обслуживания %s", job.name)
+            job.last   = time.monotonic() - started
+            job.total += job.last
+            job.max    = max(job.max, job.last)
+            job.runs  += 1
+            job.next_run = time.monotonic() + job.interval
+            log.info("Обслуживание %s: %.3f с, результат %s", job.name, job.last, job.last_result)
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "job":         j.name,
+                "runs":        j.runs,
+                "errors":      j.errors,
+                "last":        j.last,
+                "avg":         j.total / j.runs if j.runs else 0.0,
+                "max":         j.max,
+                "last_result": j.last_result,
+            }
+            for j in self.jobs
+        ]
+
+
+maintenance = MaintenanceScheduler()
+
+
+def _job_stat(key: str):
+    return lambda: {(st["job"],): st[key] for st in maintenance.stats()}
+
+
+metrics.gauge("risehunt_maintenance_runs_total", "Запуски задач обслуживания",
+              _job_stat("runs"), ("job",), kind="counter")
+metrics.gauge("risehunt_maintenance_errors_total", "Задачи обслуживания, упавшие с ошибкой",
+              _job_stat("errors"), ("job",), kind="counter")
+metrics.gauge("risehunt_maintenance_last_seconds", "Длительность последнего запуска задачи",
+              _job_stat("last"), ("job",))
+metrics.gauge("risehunt_maintenance_max_seconds", "Самый долгий запуск задачи", _job_stat("max"), ("job",))
+
+
+def wait_for_idle() -> None:
+    """Уступает живому трафику перед очередной пачкой, но не дольше пары секунд."""
+    deadline = time.monotonic() + 2.0
+    while (time.monotonic() - _last_activity < PRUNE_IDLE_MS / 1000
+           and time.monotonic() < deadline):
+        maintenance.stopping.wait(PRUNE_IDLE_MS / 1000)
+
+
+def prune_journal() -> int:
+    """Удаляет записи старше срока хранения пачками по PRUNE_BATCH."""
+    conn    = get_conn()
+    cutoff  = f"-{JOURNAL_RETENTION_DAYS} days"
+    removed = 0
+    while not maintenance.stopping.is_set():
+        wait_for_idle()
+        with conn:
+            n = conn.execute(
+                "DELETE FROM journal WHERE id IN ("
+                "  SELECT id FROM journal WHERE created_at < datetime('now', ?) LIMIT ?"
+                ")",
+                (cutoff, PRUNE_BATCH),
+            ).rowcount
+        removed += n
+        if n < PRUNE_BATCH:
+            break
+        maintenance.stopping.wait(PRUNE_PAUSE_MS / 1000)
+    return removed
+
+
+def analyze_db() -> None:
+    conn = get_conn()
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+_vacuum_warned = False
+
+
+def incremental_vacuum() -> int:
+    global _vacuum_warned
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if not _vacuum_warned:
+            log.warning("auto_vacuum не INCREMENTAL — incremental vacuum пропускается "
+                        "(для старой БД один раз: PRAGMA auto_vacuum = INCREMENTAL; VACUUM)")
+            _vacuum_warned = True
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+    return min(free, VACUUM_PAGES)
+
+
+maintenance.add("prune_journal",  prune_journal,      PRUNE_INTERVAL_SEC,   delay=5)
+maintenance.add("analyze",        analyze_db,         ANALYZE_INTERVAL_SEC, delay=600)
+maintenance.add("vacuum",         incremental_vacuum, VACUUM_INTERVAL_SEC,  delay=900)
+maintenance.add("purge_states",   lambda: user_states.purge_expired(), PRUNE_INTERVAL_SEC, delay=60)
+
+
+# ── User cache ────────────────────────────────────────────────────────────────
+# Строки users читаются почти на каждом экране, поэтому держим их в памяти
+# (LRU на USER_CACHE_SIZE записей, 0 — кэш выключен). Все функции, меняющие
+# строку пользователя, сбрасывают её из кэша.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+
+
+class UserCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._rows: OrderedDict[str, dict] = OrderedDict()
+        self._lock    = threading.Lock()
+        self._version = 0
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, user_id: str) -> tuple[dict | None, int]:
+        """Возвращает (копия строки или None, версия для последующего put)."""
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                self.misses += 1
+                return None, self._version
+            self._rows.move_to_end(user_id)
+            self.hits += 1
+            return dict(row), self._version
+
+    def put(self, user_id: str, row: dict, version: int) -> None:
+        if not self.max_entries:
+            return
+        with self._lock:
+            # Пока строку читали из БД, её могли изменить — такую не кэшируем
+            if version != self._version:
+                return
+            self._rows[user_id] = dict(row)
+            self._rows.move_to_end(user_id)
+            while len(self._rows) > self.max_entries:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._rows.pop(user_id, None)
+            self._version += 1
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+user_cache = UserCache(USER_CACHE_SIZE)
+metrics.gauge("risehunt_user_cache_entries", "Пользователи в кэше строк users", lambda: len(user_cache))
+metrics.gauge("risehunt_user_cache_lookups_total", "Обращения к кэшу пользователей",
+              lambda: {("hit",): user_cache.hits, ("miss",): user_cache.misses}, ("result",), kind="counter")
 
 
 def get_user(user_id: str) -> dict:
+    u, version = user_cache.get(user_id)
+    if u is not None:
+        return u
+    _read_barrier(user_id)
     with get_conn() as conn:
         row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
         if row:
-            return dict(row)
-        conn.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-    return {"user_id": user_id, "PV": 5.0, "IQ": 5.0, "EQ": 5.0, "SQ": 5.0,
-            "AQ": 5.0, "XQ": 5.0, "level": 1, "name": None, "age": None,
-            "gender": None, "tg_username": None, "onboarded": 0}
+            u = dict(row)
+        else:
+            conn.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+            u = {"user_id": user_id, "PV": 5.0, "IQ": 5.0, "EQ": 5.0, "SQ": 5.0,
+                 "AQ": 5.0, "XQ": 5.0, "level": 1, "name": None, "age": None,
+                 "gender": None, "tg_username": None, "onboarded": 0, "tz": None,
+                 "blocked_at": None}
+    user_cache.put(user_id, u, version)
+    return u
 
 
 def update_user_fields(user_id: str, **kwargs) -> None:
-    allowed = {"name", "age", "gender", "tg_username", "onboarded"}
+    allowed = {"name", "age", "gender", "tg_username", "onboarded", "tz"}
     fields  = {k: v for k, v in kwargs.items() if k in allowed}
     if not fields:
         return
     clause = ", ".join(f"{k} = ?" for k in fields)
-    values = list(fields.values()) + [user_id]
-    with get_conn() as conn:
-        conn.execute(f"UPDATE users SET {clause} WHERE user_id = ?", values)
+    values = tuple(fields.values()) + (user_id,)
+    _write(user_id, f"UPDATE users SET {clause} WHERE user_id = ?", values)
+    if "onboarded" in fields:
+        u = get_user(user_id)
+        u.update(fields)
+        leaderboard.update(u)
+    user_cache.invalidate(user_id)
 
 
-def update_direction(user_id: str, direction: str, value: float) -> None:
+def update_direction(user_id: str, direction: str, value: float, reason: str = "") -> None:
     if direction not in VALID_DIRECTIONS:
         raise ValueError(f"Недопустимое направление: {direction}")
-    with get_conn() as conn:
-        conn.execute(f"UPDATE users SET {direction} = ? WHERE user_id = ?", (value, user_id))
+    u = get_user(user_id)
+    _write(user_id, f"UPDATE users SET {direction} = ? WHERE user_id = ?", (value, user_id))
+    record_score(user_id, direction, u[direction], value, reason)
+    u[direction] = value
+    leaderboard.update(u)
+    user_cache.invalidate(user_id)
 
 
 def do_level_up(user_id: str, direction: str) -> int:
+    _read_barrier(user_id)
     with get_conn() as conn:
+        row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
         conn.execute(
             f"UPDATE users SET level = level + 1, {direction} = 5.0 WHERE user_id = ?", (user_id,)
         )
-        row = conn.execute("SELECT level FROM users WHERE user_id = ?", (user_id,)).fetchone()
-    return row["level"]
+    user_cache.invalidate(user_id)
+    u = dict(row)
+    record_score(user_id, direction, u[direction], 5.0, "level_up")
+    u["level"] += 1
+    u[direction] = 5.0
+    leaderboard.update(u)
+    return u["level"]
+
+
+TS_FORMAT           = "%Y-%m-%d %H:%M:%S"
+JOURNAL_PREVIEW_LEN = 55
+
+
+def journal_preview(content: str) -> str:
+    """Строка для списка записей: текст после заголовка с датой, без переносов."""
+    if "\n\n" in content:
+        return content[content.find("\n\n")+2:][:JOURNAL_PREVIEW_LEN].replace("\n", " ")
+    return content[:JOURNAL_PREVIEW_LEN]
 
 
 def save_journal(user_id: str, journal_type: str, content: str) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            "INSERT INTO journal (user_id, type, content) VALUES (?, ?, ?)",
-            (user_id, journal_type, content)
-        )
+    # created_at ставим сами (в формате CURRENT_TIMESTAMP, UTC), чтобы
+    # display_ts совпадал с ним и при отложенной записи (write-behind)
+    created_at = datetime.now(timezone.utc).strftime(TS_FORMAT)
+    _write(
+        user_id,
+        "INSERT INTO journal (user_id, type, content, preview, display_ts, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, journal_type, content, journal_preview(content), created_at[:16], created_at),
+    )
+
+
+JOURNAL_PAGE_SIZE = int(os.getenv("JOURNAL_PAGE_SIZE", "10"))
+
+
+def ts_to_epoch(created_at: str) -> int:
+    return int(datetime.strptime(created_at, TS_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
 
+def epoch_to_ts(epoch: int) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(TS_FORMAT)
 
-def get_journal_history(user_id: str) -> list:
+
+def get_journal_page(user_id: str, journal_type: str | None = None,
+                     cursor: tuple[str, int] | None = None, older: bool = True,
+                     limit: int = JOURNAL_PAGE_SIZE) -> tuple[list, bool]:
+    """
+    Страница истории журнала, новые записи первыми. Пагинация по ключу
+    (created_at, id): cursor — граница предыдущей страницы, older — листаем
+    к более старым (иначе к более новым). Стоимость не зависит от глубины.
+    Возвращает (записи, есть ли ещё записи в направлении листания).
+    """
+    _read_barrier(user_id)
+    where  = ["user_id = ?"]
+    params: list = [user_id]
+    if journal_type:
+        where.append("type = ?")
+        params.append(journal_type)
+    if cursor:
+        where.append("(created_at, id) < (?, ?)" if older else "(created_at, id) > (?, ?)")
+        params.extend(cursor)
+    order = "DESC" if older else "ASC"
     with get_conn() as conn:
-        return conn.execute(
-            "SELECT id, type, content, created_at FROM journal "
-            "WHERE user_id = ? AND created_at >= datetime('now', '-7 days') "
-            "ORDER BY created_at DESC LIMIT 15",
-            (user_id,)
+        rows = conn.execute(
+            "SELECT id, type, preview, display_ts, created_at FROM journal "
+            f"WHERE {' AND '.join(where)} "
+            f"ORDER BY created_at {order}, id {order} LIMIT ?",
+            (*params, limit + 1),
         ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not older:
+        rows.reverse()
+    return rows, more
 
 
 def get_journal_entry(entry_id: int, user_id: str):
+    _read_barrier(user_id)
     with get_conn() as conn:
         return conn.execute(
-            "SELECT * FROM journal WHERE id = ? AND user_id = ?", (entry_id, user_id)
+            "SELECT id, type, content, display_ts FROM journal WHERE id = ? AND user_id = ?",
+            (entry_id, user_id)
         ).fetchone()
 
 
+JOURNAL_SEARCH_LIMIT  = int(os.getenv("JOURNAL_SEARCH_LIMIT", "10"))
+SEARCH_MAX_TERMS      = 8
+SEARCH_MIN_STEM       = 3
+# Падежные и родовые окончания, длинные раньше коротких
+_RU_ENDINGS = ("ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "иям", "иях",
+               "ах", "ях", "ов", "ев", "ей", "ой", "ый", "ий", "ая", "яя", "ое", "ее",
+               "ые", "ие", "ую", "юю", "ом", "ем", "ам", "ям", "ью",
+               "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й")
+
+
+def _stem(word: str) -> str:
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= SEARCH_MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def fts_query(text: str) -> str | None:
+    """
+    Пользовательский ввод -> выражение MATCH. Каждое слово берётся в кавычки
+    (никакого синтаксиса FTS от пользователя), «ё» сводится к «е», как в
+    индексе, окончание отрезается и ищется префикс основы: «ёлки» найдёт
+    «ёлка» и «ёлке», «тревожный» — «тревожная».
+    """
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))[:SEARCH_MAX_TERMS]
+    return " ".join(f'"{_stem(word)}"*' for word in words) or None
+
+
+def search_journal(user_id: str, text: str, limit: int = JOURNAL_SEARCH_LIMIT) -> list:
+    """Записи пользователя по релевантности (bm25) с подсвеченным фрагментом."""
+    query = fts_query(text)
+    if query is None:
+        return []
+    _read_barrier(user_id)
+    with get_conn() as conn:
+        # Фильтр по колонке user_id — внутри MATCH: чужие записи не ранжируются
+        return conn.execute(
+            "SELECT j.id, j.type, j.display_ts, "
+            "       snippet(journal_fts, 0, char(2), char(3), '…', 12) AS snippet "
+            "FROM journal_fts JOIN journal j ON j.id = journal_fts.rowid "
+            "WHERE journal_fts MATCH ? AND j.user_id = ? "
+            "ORDER BY rank LIMIT ?",
+            (f'user_id:"{user_id}" AND content:({query})', user_id, limit),
+        ).fetchall()
+
+
 def get_goals(user_id: str, period: str) -> list:
+    # Цели прошлых периодов до прохода rollover_goals() уже не показываем
+    start = user_period_start(user_id, period)
+    _read_barrier(user_id)
     with get_conn() as conn:
         return conn.execute(
-            "SELECT * FROM goals WHERE user_id = ? AND period = ? ORDER BY id",
-            (user_id, period)
+            "SELECT * FROM goals WHERE user_id = ? AND period = ? AND +period_start >= ? ORDER BY id",
+            (user_id, period, start)
         ).fetchall()
 
 
+def get_last_period_stats(user_id: str, period: str):
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT period_start, total, done FROM goal_period_stats "
+            "WHERE user_id = ? AND period = ? ORDER BY period_start DESC LIMIT 1",
+            (user_id, period)
+        ).fetchone()
+
+
 def get_goal_by_id(goal_id: int, user_id: str):
+    _read_barrier(user_id)
     with get_conn() as conn:
         return conn.execute(
             "SELECT * FROM goals WHERE id = ? AND user_id = ?", (goal_id, user_id)
@@ -388,11 +1743,11 @@ def get_goal_by_id(goal_id: int, user_id: str):
 
 
 def add_goal(user_id: str, period: str, direction: str, title: str) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            "INSERT INTO goals (user_id, period, direction, title) VALUES (?, ?, ?, ?)",
-            (user_id, period, direction, title)
-        )
+    _write(
+        user_id,
+        "INSERT INTO goals (user_id, period, period_start, direction, title) VALUES (?, ?, ?, ?, ?)",
+        (user_id, period, user_period_start(user_id, period), direction, title),
+    )
 
 
 def complete_goal(goal_id: int) -> None:
@@ -410,6 +1765,563 @@ def delete_goal(goal_id: int) -> None:
         conn.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
 
 
+# ── Goal rollover ─────────────────────────────────────────────────────────────
+# Период цели закрывается на границе дня/недели/месяца в часовом поясе
+# пользователя (users.tz, по умолчанию GOALS_TZ). Фоновая задача переносит
+# цели закрытых периодов в goals_archive пачками, в той же транзакции
+# накапливая итоги в goal_period_stats, — в goals остаются только текущие.
+GOALS_TZ              = os.getenv("GOALS_TZ", "Europe/Moscow")
+ROLLOVER_INTERVAL_SEC = int(os.getenv("ROLLOVER_INTERVAL_SEC", "300"))
+
+
+@functools.lru_cache(maxsize=256)
+def get_tz(name: str | None) -> tzinfo:
+    try:
+        return ZoneInfo(name or GOALS_TZ)
+    except (ZoneInfoNotFoundError, ValueError):
+        log.warning("Неизвестный часовой пояс %r — используется UTC", name or GOALS_TZ)
+        return timezone.utc
+
+
+def period_start(period: str, tz: tzinfo, now: datetime | None = None) -> str:
+    """Локальная дата начала текущего периода: сегодня, понедельник или 1-е число."""
+    d = (now or datetime.now(timezone.utc)).astimezone(tz).date()
+    if period == "week":
+        d -= timedelta(days=d.weekday())
+    elif period == "month":
+        d = d.replace(day=1)
+    return d.isoformat()
+
+
+def user_period_start(user_id: str, period: str) -> str:
+    return period_start(period, get_tz(get_user(user_id).get("tz")))
+
+
+def _archive_goals(conn: sqlite3.Connection, tz_name: str | None, period: str, start: str) -> int:
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [r[0] for r in conn.execute(
+            "SELECT g.id FROM goals g LEFT JOIN users u ON u.user_id = g.user_id "
+            "WHERE g.period = ? AND g.period_start < ? AND u.tz IS ? LIMIT ?",
+            (period, start, tz_name, PRUNE_BATCH),
+        )]
+        if not ids:
+            return 0
+        batch = json.dumps(ids)
+        conn.execute("""
+            INSERT INTO goal_period_stats (user_id, period, period_start, total, done)
+            SELECT user_id, period, period_start, COUNT(*), SUM(done) FROM goals
+            WHERE id IN (SELECT value FROM json_each(?))
+            GROUP BY user_id, period, period_start
+            ON CONFLICT (user_id, period, period_start)
+            DO UPDATE SET total = total + excluded.total, done = done + excluded.done
+        """, (batch,))
+        conn.execute("""
+            INSERT INTO goals_archive (id, user_id, period, period_start, direction, title, done, created_at)
+            SELECT id, user_id, period, period_start, direction, title, done, created_at FROM goals
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, (batch,))
+        conn.execute("DELETE FROM goals WHERE id IN (SELECT value FROM json_each(?))", (batch,))
+    return len(ids)
+
+
+def rollover_goals() -> int:
+    """Переносит цели закрытых периодов в архив. Возвращает число перенесённых."""
+    conn  = get_conn()
+    zones = {r[0] for r in conn.execute("SELECT DISTINCT tz FROM users")} | {None}
+    moved = 0
+    for tz_name in zones:
+        tz = get_tz(tz_name)
+        for period in PERIOD_BONUS:
+            start = period_start(period, tz)
+            while not maintenance.stopping.is_set():
+                wait_for_idle()
+                n = _archive_goals(conn, tz_name, period, start)
+                moved += n
+                if n < PRUNE_BATCH:
+                    break
+                maintenance.stopping.wait(PRUNE_PAUSE_MS / 1000)
+    return moved
+
+
+maintenance.add("goals_rollover", rollover_goals, ROLLOVER_INTERVAL_SEC, delay=30)
+
+
+# ── Leaderboard ───────────────────────────────────────────────────────────────
+# Рейтинги по уровню и трём ядрам. Очки лежат в таблице leaderboard и
+# меняются точечно из update_direction / do_level_up — пересчёта по всей
+# users нет. В памяти каждая доска — отсортированный список (-score, user_id):
+# место пользователя ищется бинарным поиском, топ — срез, кэшируемый на
+# LEADERBOARD_TTL_SEC. В рейтинг попадают только прошедшие регистрацию.
+LEADERBOARD_BOARDS  = {"level": "🏅 Уровень", "body": "💪 Тело", "mind": "🧠 Разум", "spirit": "🧘 Дух"}
+LEADERBOARD_TOP     = int(os.getenv("LEADERBOARD_TOP", "10"))
+LEADERBOARD_TTL_SEC = float(os.getenv("LEADERBOARD_TTL_SEC", "30"))
+
+
+def board_scores(u: dict) -> dict[str, float]:
+    body, mind, spirit = calc_cores(u)
+    return {
+        # При равном уровне выше тот, кто дальше продвинулся (сумма ядер < 31)
+        "level":  round(u["level"] + (body + mind + spirit) / 31, 4),
+        "body":   round(body, 4),
+        "mind":   round(mind, 4),
+        "spirit": round(spirit, 4),
+    }
+
+
+class Leaderboard:
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._boards: dict[str, list] | None = None
+        self._keys:   dict[str, dict[str, tuple]] = {}
+        self._top:    dict[str, tuple[float, list]] = {}
+
+    def _ensure_loaded(self) -> None:
+        # Под self._lock. Один раз за процесс: дальше доски живут в памяти
+        if self._boards is not None:
+            return
+        boards = {b: [] for b in LEADERBOARD_BOARDS}
+        with get_conn() as conn:
+            for row in conn.execute("SELECT board, user_id, score FROM leaderboard"):
+                if row["board"] in boards:
+                    boards[row["board"]].append((-row["score"], row["user_id"]))
+        for board, entries in boards.items():
+            entries.sort()
+            self._keys[board] = {key[1]: key for key in entries}
+        self._boards = boards
+
+    def load(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._keys["level"])
+
+    def update(self, u: dict) -> None:
+        if not u.get("onboarded"):
+            return
+        user_id = u["user_id"]
+        scores  = board_scores(u)
+        with self._lock:
+            self._ensure_loaded()
+            for board, score in scores.items():
+                entries, keys = self._boards[board], self._keys[board]
+                key = (-score, user_id)
+                old = keys.get(user_id)
+                if old == key:
+                    continue
+                if old is not None:
+                    del entries[bisect.bisect_left(entries, old)]
+                bisect.insort(entries, key)
+                keys[user_id] = key
+        _write(
+            user_id,
+            "INSERT INTO leaderboard (board, user_id, score) VALUES "
+            + ", ".join("(?, ?, ?)" for _ in scores)
+            + " ON CONFLICT (board, user_id) DO UPDATE SET score = excluded.score",
+            tuple(v for board, score in scores.items() for v in (board, user_id, score)),
+        )
+
+    def rank(self, board: str, user_id: str) -> tuple[int, int] | None:
+        """(место, всего участников) или None, если пользователя нет в рейтинге."""
+        with self._lock:
+            self._ensure_loaded()
+            key = self._keys[board].get(user_id)
+            if key is None:
+                return None
+            entries = self._boards[board]
+            return bisect.bisect_left(entries, key) + 1, len(entries)
+
+    def top(self, board: str, n: int = LEADERBOARD_TOP) -> list[tuple[str, float]]:
+        now    = time.monotonic()
+        cached = self._top.get(board)
+        if cached and cached[0] > now:
+            return cached[1]
+        with self._lock:
+            self._ensure_loaded()
+            rows = [(uid, -neg) for neg, uid in self._boards[board][:n]]
+        self._top[board] = (now + LEADERBOARD_TTL_SEC, rows)
+        return rows
+
+
+leaderboard = Leaderboard()
+
+
+# ── Score history ─────────────────────────────────────────────────────────────
+# Каждое изменение направления (анкета, бонус за цель, отмена, сброс при
+# level-up) пишется в score_history и сразу сворачивается в score_rollup по
+# дню и неделе пользователя (open/close/min/max). Экран прогресса читает только
+# свёртки. Сырые события живут SCORE_RAW_DAYS, дневные свёртки —
+# SCORE_DAILY_DAYS; недельные остаются навсегда (52 строки на направление в год).
+SCORE_RAW_DAYS   = int(os.getenv("SCORE_RAW_DAYS", "30"))
+SCORE_DAILY_DAYS = int(os.getenv("SCORE_DAILY_DAYS", "120"))
+PROGRESS_POINTS  = {"day": 14, "week": 12}
+SPARK_CHARS      = "▁▂▃▄▅▆▇█"
+
+_ROLLUP_UPSERT = """
+    INSERT INTO score_rollup (user_id, bucket, bucket_start, direction, open, close, lo, hi, n)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT (user_id, bucket, bucket_start, direction) DO UPDATE SET
+        close = excluded.close,
+        lo    = min(lo, excluded.lo),
+        hi    = max(hi, excluded.hi),
+        n     = n + 1
+"""
+
+
+def record_score(user_id: str, direction: str, old_value: float, value: float, reason: str = "") -> None:
+    now = datetime.now(timezone.utc)
+    tz  = get_tz(get_user(user_id).get("tz"))
+    lo, hi = min(old_value, value), max(old_value, value)
+    _write(
+        user_id,
+        "INSERT INTO score_history (user_id, direction, old_value, value, reason, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, direction, old_value, value, reason, now.strftime(TS_FORMAT)),
+    )
+    for bucket in PROGRESS_POINTS:
+        _write(user_id, _ROLLUP_UPSERT,
+               (user_id, bucket, period_start(bucket, tz, now), direction, old_value, value, lo, hi))
+
+
+def get_score_series(user_id: str, bucket: str, points: int) -> tuple[list[str], dict[str, list[float]]]:
+    """
+    Значения close по направлениям за последние points дней/недель.
+    Пустые корзины заполняются предыдущим значением, корзины до первого
+    изменения — его open (или текущим значением, если изменений не было).
+    """
+    u     = get_user(user_id)
+    last  = date.fromisoformat(period_start(bucket, get_tz(u.get("tz"))))
+    step  = timedelta(days=1 if bucket == "day" else 7)
+    starts = [(last - step * i).isoformat() for i in range(points - 1, -1, -1)]
+    _read_barrier(user_id)
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT bucket_start, direction, open, close FROM score_rollup "
+            "WHERE user_id = ? AND bucket = ? AND bucket_start >= ?",
+            (user_id, bucket, starts[0]),
+        ).fetchall()
+    by_dir: dict[str, dict[str, tuple]] = {d: {} for d in DIRECTION_META}
+    for r in rows:
+        if r["direction"] in by_dir:
+            by_dir[r["direction"]][r["bucket_start"]] = (r["open"], r["close"])
+    series = {}
+    for d, points_map in by_dir.items():
+        if points_map:
+            value = points_map[min(points_map)][0]
+        else:
+            value = u[d]
+        values = []
+        for start in starts:
+            if start in points_map:
+                value = points_map[start][1]
+            values.append(value)
+        series[d] = values
+    return starts, series
+
+
+def sparkline(values: list[float], lo: float = 0.0, hi: float = 10.0) -> str:
+    top = len(SPARK_CHARS) - 1
+    return "".join(
+        SPARK_CHARS[max(0, min(top, round((v - lo) / (hi - lo) * top)))] for v in values
+    )
+
+
+def compact_scores() -> int:
+    """Удаляет сырые события старше SCORE_RAW_DAYS и дневные свёртки старше SCORE_DAILY_DAYS."""
+    conn    = get_conn()
+    removed = 0
+    for sql, cutoff in (
+        ("DELETE FROM score_history WHERE id IN ("
+         "  SELECT id FROM score_history WHERE created_at < datetime('now', ?) LIMIT ?)",
+         f"-{SCORE_RAW_DAYS} days"),
+        ("DELETE FROM score_rollup WHERE (user_id, bucket, bucket_start, direction) IN ("
+         "  SELECT user_id, bucket, bucket_start, direction FROM score_rollup"
+         "  WHERE bucket = 'day' AND bucket_start < date('now', ?) LIMIT ?)",
+         f"-{SCORE_DAILY_DAYS} days"),
+    ):
+        while not maintenance.stopping.is_set():
+            wait_for_idle()
+            with conn:
+                n = conn.execute(sql, (cutoff, PRUNE_BATCH)).rowcount
+            removed += n
+            if n < PRUNE_BATCH:
+                break
+            maintenance.stopping.wait(PRUNE_PAUSE_MS / 1000)
+    return removed
+
+
+maintenance.add("compact_scores", compact_scores, PRUNE_INTERVAL_SEC, delay=120)
+
+
+# ── User states ───────────────────────────────────────────────────────────────
+# Состояния незавершённых диалогов (регистрация, ввод теста, план тренировок…).
+# В памяти держим не больше STATE_MAX_ENTRIES записей: давно не тронутые
+# вытесняются (LRU), брошенные дольше STATE_TTL_SEC — удаляются совсем.
+# STATE_BACKEND=sqlite дополнительно пишет состояния в таблицу user_states,
+# чтобы начатые сценарии переживали рестарт; в память они поднимаются лениво.
+STATE_BACKEND     = os.getenv("STATE_BACKEND", "memory")
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+STATE_TTL_SEC     = int(os.getenv("STATE_TTL_SEC", str(6 * 3600)))
+
+
+STATE_TYPES: dict[str, type["DialogState"]] = {}
+
+
+@dataclass
+class DialogState:
+    """
+    Состояние диалога. Поле type — имя состояния в handle_state и в JSON
+    таблицы user_states; у каждого сценария свой класс с его полями.
+    """
+    type: ClassVar[str] = ""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        STATE_TYPES[cls.type] = cls
+
+    def to_json(self) -> str:
+        return json.dumps({"type": self.type, **asdict(self)}, ensure_ascii=False)
+
+    @staticmethod
+    def from_json(raw: str) -> "DialogState | None":
+        data = json.loads(raw)
+        cls  = STATE_TYPES.get(data.pop("type", None))
+        try:
+            return cls(**data) if cls is not None else None
+        except TypeError:
+            return None   # сохранено другой версией бота — сценарий начнётся заново
+
+
+@dataclass
+class RegNameState(DialogState):
+    type: ClassVar[str] = "reg_name"
+
+
+@dataclass
+class RegAgeState(DialogState):
+    type: ClassVar[str] = "reg_age"
+
+
+@dataclass
+class RegGenderState(DialogState):
+    type: ClassVar[str] = "reg_gender_wait"
+
+
+@dataclass
+class RegTgState(DialogState):
+    type: ClassVar[str] = "reg_tg"
+
+
+@dataclass
+class RegWeekGoalsState(DialogState):
+    type: ClassVar[str] = "reg_week_goals"
+    goals: list[str] = field(default_factory=list)
+
+
+@dataclass
+class EditNameState(DialogState):
+    type: ClassVar[str] = "edit_name"
+
+
+@dataclass
+class PvInputState(DialogState):
+    type: ClassVar[str] = "pv_input"
+    cat_key: str
+
+
+@dataclass
+class TestInputState(DialogState):
+    type: ClassVar[str] = "test_input"
+    test_key: str
+    direction: str
+
+
+@dataclass
+class EmotionsState(DialogState):
+    type: ClassVar[str] = "emotions"
+
+
+@dataclass
+class ReflectionState(DialogState):
+    type: ClassVar[str] = "reflection"
+
+
+@dataclass
+class JournalSearchState(DialogState):
+    type: ClassVar[str] = "journal_search"
+
+
+@dataclass
+class WorkoutState(DialogState):
+    type: ClassVar[str] = "workout"
+    days: int
+    current_day: int = 1
+    entries: list[str] = field(default_factory=list)
+
+
+@dataclass
+class GoalsViewState(DialogState):
+    type: ClassVar[str] = "goals_view"
+    period: str
+
+
+@dataclass
+class GoalAddState(DialogState):
+    type: ClassVar[str] = "goal_add"
+    period: str
+    direction: str
+
+
+class _StateEntry:
+    __slots__ = ("state", "touched")
+
+    def __init__(self, state: DialogState, touched: float):
+        self.state   = state
+        self.touched = touched
+
+
+class StateStore:
+    def __init__(self, max_entries: int, ttl: float, durable: bool = False):
+        self.max_entries = max_entries
+        self.ttl         = ttl
+        self.durable     = durable
+        self._entries: OrderedDict[str, _StateEntry] = OrderedDict()
+        self._lock    = threading.Lock()
+        self.evicted  = 0
+        self.expired  = 0
+        # user_id, у которых есть строка в user_states (None — таблицу ещё не читали):
+        # без строки get/pop не ходят в SQLite, а это каждое нажатие меню
+        self._persisted: set[str] | None = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id: str) -> DialogState:
+        state = self.get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id: str, state: DialogState) -> None:
+        now = time.time()
+        with self._lock:
+            self._entries[user_id] = _StateEntry(state, now)
+            self._entries.move_to_end(user_id)
+            self._trim(now)
+        if self.durable:
+            persisted = self._stored()
+            with get_conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO user_states (user_id, state, updated_at) VALUES (?, ?, ?)",
+                    (user_id, state.to_json(), now),
+                )
+            persisted.add(user_id)
+
+    def __delitem__(self, user_id: str) -> None:
+        if self.pop(user_id, None) is None:
+            raise KeyError(user_id)
+
+    def get(self, user_id: str, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if now - entry.touched > self.ttl:
+                    del self._entries[user_id]
+                    self.expired += 1
+                    entry = None
+                else:
+                    entry.touched = now
+                    self._entries.move_to_end(user_id)
+                    return entry.state
+        if not self.durable or user_id not in self._stored():
+            return default
+        state = self._load(user_id, now)
+        if state is None:
+            return default
+        with self._lock:
+            self._entries[user_id] = _StateEntry(state, now)
+            self._trim(now)
+        return state
+
+    def pop(self, user_id: str, default=None):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+        state = entry.state if entry is not None else None
+        if self.durable and user_id in self._stored():
+            with get_conn() as conn:
+                rows = conn.execute(
+                    "DELETE FROM user_states WHERE user_id = ? RETURNING state, updated_at", (user_id,)
+                ).fetchall()
+            self._persisted.discard(user_id)
+            if state is None and rows and time.time() - rows[0]["updated_at"] <= self.ttl:
+                state = DialogState.from_json(rows[0]["state"])
+        return default if state is None else state
+
+    def _stored(self) -> set[str]:
+        if self._persisted is None:
+            with get_conn() as conn:
+                ids = {row["user_id"] for row in conn.execute("SELECT user_id FROM user_states")}
+            with self._lock:
+                if self._persisted is None:
+                    self._persisted = ids
+        return self._persisted
+
+    def _trim(self, now: float) -> None:
+        # Записи упорядочены по последнему обращению — протухшие всегда в начале
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if now - entry.touched > self.ttl:
+                self.expired += 1
+            elif len(self._entries) > self.max_entries:
+                self.evicted += 1   # в durable-режиме остаётся в таблице
+            else:
+                break
+            del self._entries[user_id]
+
+    def _load(self, user_id: str, now: float) -> DialogState | None:
+        with get_conn() as conn:
+            row = conn.execute(
+                "SELECT state, updated_at FROM user_states WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                self._persisted.discard(user_id)
+                return None
+            if now - row["updated_at"] > self.ttl:
+                conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+                self._persisted.discard(user_id)
+                return None
+        return DialogState.from_json(row["state"])
+
+    def purge_expired(self) -> int:
+        """Чистит протухшие состояния в памяти и (для sqlite) в таблице."""
+        now = time.time()
+        with self._lock:
+            stale = [uid for uid, e in self._entries.items() if now - e.touched > self.ttl]
+            for uid in stale:
+                del self._entries[uid]
+            self.expired += len(stale)
+        removed = len(stale)
+        if self.durable:
+            persisted = self._stored()
+            with get_conn() as conn:
+                purged = [row["user_id"] for row in conn.execute(
+                    "DELETE FROM user_states WHERE updated_at < ? RETURNING user_id", (now - self.ttl,)
+                )]
+            persisted.difference_update(purged)
+            removed += len(purged)
+        return removed
+
+
+user_states = StateStore(STATE_MAX_ENTRIES, STATE_TTL_SEC, durable=STATE_BACKEND == "sqlite")
+metrics.gauge("risehunt_user_states", "Незавершённые диалоги в памяти", lambda: len(user_states))
+metrics.gauge("risehunt_user_states_dropped_total", "Диалоги, вытесненные из памяти или протухшие",
+              lambda: {("evicted",): user_states.evicted, ("expired",): user_states.expired}, ("reason",),
+              kind="counter")
+
+
 # ── Helpers ───────────────────────────────────────────────────────────────────
 def bar(value: float, width: int = 10) -> str:
     filled = max(0, min(width, round(value)))
@@ -437,6 +2349,15 @@ def fmt_goals_plain(goals: list) -> str:
     )
 
 
+def md_escape(text: str) -> str:
+    """Экранирование для parse_mode="Markdown" (legacy)."""
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+
+def is_admin(user_id: str) -> bool:
+    return user_id in ADMIN_IDS
+
+
 def user_display(u: dict) -> str:
     return u.get("name") or "—"
 
@@ -447,12 +2368,6 @@ def check_and_level_up(chat_id, user_id: str, direction: str, new_val: float) ->
         return False
     new_level = do_level_up(user_id, direction)
     meta    = DIRECTION_META[direction]
-    adv_url = ADVANCED_TEST_URLS.get(direction, "https://google.com")
-    markup  = InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        InlineKeyboardButton(f"🚀 Продвинутый тест {direction}", url=adv_url),
-        InlineKeyboardButton("🧭 Главное меню", callback_data="main_menu"),
-    )
     bot.send_message(
         chat_id,
         f"🏆 *УРОВЕНЬ {new_level} ДОСТИГНУТ!*\n\n"
@@ -460,13 +2375,62 @@ def check_and_level_up(chat_id, user_id: str, direction: str, new_val: float) ->
         f"✨ Шкала сброшена до `5.0` — новый цикл роста начат\n"
         f"🎯 Вам открыт *продвинутый тест* для {direction}\n\n"
         f"_Базовый уровень пройден — впереди новые вершины!_",
-        reply_markup=markup,
+        reply_markup=kb_level_up(direction),
         parse_mode="Markdown",
+        priority=PRIO_BACKGROUND,
     )
     return True
 
 
 # ── Keyboards ─────────────────────────────────────────────────────────────────
+# Клавиатуры не зависят от пользователя, поэтому собираются один раз:
+# статичные — при старте (warm_keyboards), параметризованные — по первому
+# запросу, в ограниченный LRU. JSON для reply_markup тоже считается один раз.
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "1024"))
+
+
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """Готовая клавиатура: reply_markup сериализован заранее, менять нельзя."""
+
+    def __init__(self, markup: InlineKeyboardMarkup):
+        super().__init__(keyboard=markup.keyboard, row_width=markup.row_width)
+        self._json = markup.to_json()
+
+    def to_json(self):
+        return self._json
+
+    def add(self, *args, **kwargs):
+        raise TypeError("FrozenKeyboard нельзя изменять — соберите новую клавиатуру")
+
+    row = add
+
+
+_STATIC_KEYBOARDS: list = []
+
+
+def static_keyboard(build):
+    cached = functools.lru_cache(maxsize=None)(lambda: FrozenKeyboard(build()))
+    functools.update_wrapper(cached, build)
+    _STATIC_KEYBOARDS.append(cached)
+    return cached
+
+
+def cached_keyboard(build):
+    return functools.lru_cache(maxsize=KB_CACHE_SIZE)(
+        functools.wraps(build)(lambda *args, **kwargs: FrozenKeyboard(build(*args, **kwargs)))
+    )
+
+
+def warm_keyboards() -> None:
+    for build in _STATIC_KEYBOARDS:
+        build()
+    for cat_key in PV_CATEGORIES:
+        kb_pv_test(cat_key)
+    for test_key in TESTS_CONFIG:
+        kb_test_link(test_key)
+
+
+@static_keyboard
 def kb_main() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     m.add(
@@ -474,25 +2438,30 @@ def kb_main() -> InlineKeyboardMarkup:
         InlineKeyboardButton("📓 Журнал",   callback_data="journal"),
         InlineKeyboardButton("📋 Анкеты",   callback_data="tests_menu"),
         InlineKeyboardButton("🎯 Цели",     callback_data="goals"),
+        InlineKeyboardButton("🏆 Рейтинг",  callback_data="leaderboard"),
     )
     return m
 
 
+@static_keyboard
 def kb_back_main() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup()
     m.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
     return m
 
 
+@cached_keyboard
 def kb_back(cb: str, label: str = "🔙 Назад") -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup()
     m.add(InlineKeyboardButton(label, callback_data=cb))
     return m
 
 
+@static_keyboard
 def kb_profile() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     m.add(
+        InlineKeyboardButton("📈 Прогресс",      callback_data="progress"),
         InlineKeyboardButton("✏️ Изменить имя",  callback_data="edit_name"),
         InlineKeyboardButton("📋 Пройти анкеты", callback_data="tests_menu"),
         InlineKeyboardButton("🔙 Главное меню",  callback_data="main_menu"),
@@ -500,6 +2469,7 @@ def kb_profile() -> InlineKeyboardMarkup:
     return m
 
 
+@static_keyboard
 def kb_tests() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     for d, meta in DIRECTION_META.items():
@@ -519,36 +2489,80 @@ def kb_test_action(direction: str, user_level: int) -> InlineKeyboardMarkup:
     return m
 
 
+@static_keyboard
 def kb_journal() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     m.add(
         InlineKeyboardButton("🏋️ Тренировка",       callback_data="journal_workout"),
         InlineKeyboardButton("❤️ Дневник эмоций",   callback_data="journal_emotions"),
         InlineKeyboardButton("🕯️ Рефлексия",        callback_data="journal_reflection"),
-        InlineKeyboardButton("📜 История (7 дней)", callback_data="journal_history"),
+        InlineKeyboardButton("📜 История",          callback_data="journal_history"),
+        InlineKeyboardButton("🔎 Поиск по записям", callback_data="journal_search"),
         InlineKeyboardButton("🔙 Главное меню",     callback_data="main_menu"),
     )
     return m
 
 
+@static_keyboard
 def kb_training() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=2)
     for n in (2, 3, 4, 5):
-        m.add(InlineKeyboardButton(f"{n} раза/нед", callback_data=f"training_{n}"))
+        m.add(InlineKeyboardButton(f"{n} раза/нед", callback_data=cb_data("training", n)))
     m.add(InlineKeyboardButton("🔙 Журнал", callback_data="journal"))
     return m
 
 
-def kb_history_list(entries: list) -> InlineKeyboardMarkup:
+def kb_history_page(entries: list, jfilter: str, newer: bool, older: bool) -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     for e in entries:
         emoji = TYPE_EMOJI.get(e["type"], "📝")
-        dt    = e["created_at"][:16]
-        m.add(InlineKeyboardButton(f"{emoji} {dt}", callback_data=f"jentry_{e['id']}"))
+        dt    = e["display_ts"]
+        m.add(InlineKeyboardButton(f"{emoji} {dt}", callback_data=cb_data("jentry", e["id"])))
+    nav = []
+    if newer:
+        first = entries[0]
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=cb_data(
+            "jpage", jfilter, "n", ts_to_epoch(first["created_at"]), first["id"])))
+    if older:
+        last = entries[-1]
+        nav.append(InlineKeyboardButton("Старее ➡️", callback_data=cb_data(
+            "jpage", jfilter, "o", ts_to_epoch(last["created_at"]), last["id"])))
+    if nav:
+        m.row(*nav)
+    m.row(*(
+        InlineKeyboardButton(("• " if code == jfilter else "") + label,
+                             callback_data=cb_data("jpage", code, "o", 0, 0))
+        for code, (label, _) in JOURNAL_FILTERS.items()
+    ))
     m.add(InlineKeyboardButton("🔙 Журнал", callback_data="journal"))
     return m
 
 
+@cached_keyboard
+def kb_progress(bucket: str) -> InlineKeyboardMarkup:
+    m = InlineKeyboardMarkup()
+    m.row(
+        InlineKeyboardButton(("• " if bucket == "day" else "") + "📅 14 дней",
+                             callback_data=cb_data("progress", "day")),
+        InlineKeyboardButton(("• " if bucket == "week" else "") + "📆 12 недель",
+                             callback_data=cb_data("progress", "week")),
+    )
+    m.add(InlineKeyboardButton("🔙 Профиль", callback_data="profile"))
+    return m
+
+
+@cached_keyboard
+def kb_leaderboard(board: str) -> InlineKeyboardMarkup:
+    m = InlineKeyboardMarkup()
+    m.row(*(
+        InlineKeyboardButton(("• " if b == board else "") + label, callback_data=cb_data("lb", b))
+        for b, label in LEADERBOARD_BOARDS.items()
+    ))
+    m.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    return m
+
+
+@static_keyboard
 def kb_entry_back() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     m.add(
@@ -558,43 +2572,134 @@ def kb_entry_back() -> InlineKeyboardMarkup:
     return m
 
 
+@cached_keyboard
 def kb_goal_direction(period: str) -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=2)
     for d, meta in DIRECTION_META.items():
-        m.add(InlineKeyboardButton(f"{meta['emoji']} {d}", callback_data=f"goal_dir_{period}_{d}"))
+        m.add(InlineKeyboardButton(f"{meta['emoji']} {d}", callback_data=cb_data("goal_dir", period, d)))
     m.add(InlineKeyboardButton("🔙 Назад", callback_data=f"goals_{period}"))
     return m
 
 
+@cached_keyboard
 def kb_goal_manage(goal_id: int, period: str) -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=2)
     m.add(
-        InlineKeyboardButton("✅ Выполнено", callback_data=f"goal_done_{goal_id}_{period}"),
-        InlineKeyboardButton("↩️ Отменить",  callback_data=f"goal_undo_{goal_id}_{period}"),
-        InlineKeyboardButton("🗑 Удалить",   callback_data=f"goal_del_{goal_id}_{period}"),
+        InlineKeyboardButton("✅ Выполнено", callback_data=cb_data("goal_done", goal_id, period)),
+        InlineKeyboardButton("↩️ Отменить",  callback_data=cb_data("goal_undo", goal_id, period)),
+        InlineKeyboardButton("🗑 Удалить",   callback_data=cb_data("goal_del", goal_id, period)),
         InlineKeyboardButton("🔙 К целям",   callback_data=f"goals_{period}"),
     )
     return m
 
 
+def kb_broadcast(broadcast_id: int, status: str) -> InlineKeyboardMarkup | None:
+    m = InlineKeyboardMarkup(row_width=2)
+    if status == "draft":
+        m.add(
+            InlineKeyboardButton("🚀 Отправить", callback_data=cb_data("bc_go", broadcast_id)),
+            InlineKeyboardButton("✖️ Отмена",    callback_data=cb_data("bc_cancel", broadcast_id)),
+        )
+    elif status == "running":
+        m.add(
+            InlineKeyboardButton("🔄 Обновить",   callback_data=cb_data("bc_status", broadcast_id)),
+            InlineKeyboardButton("⏹ Остановить", callback_data=cb_data("bc_cancel", broadcast_id)),
+        )
+    else:
+        return None
+    return m
+
+
+@cached_keyboard
+def kb_level_up(direction: str) -> InlineKeyboardMarkup:
+    adv_url = ADVANCED_TEST_URLS.get(direction, "https://google.com")
+    m = InlineKeyboardMarkup(row_width=1)
+    m.add(
+        InlineKeyboardButton(f"🚀 Продвинутый тест {direction}", url=adv_url),
+        InlineKeyboardButton("🧭 Главное меню", callback_data="main_menu"),
+    )
+    return m
+
+
+@static_keyboard
+def kb_tests_menu() -> InlineKeyboardMarkup:
+    m = InlineKeyboardMarkup(row_width=1)
+    # PV — отдельная кнопка (у неё свой обработчик с категориями)
+    m.add(InlineKeyboardButton(
+        "💪 PV — Физическая витальность",
+        callback_data="test_PV"
+    ))
+    # Остальные тесты из TESTS_CONFIG
+    for cb, cfg in TESTS_CONFIG.items():
+        m.add(InlineKeyboardButton(
+
+            f"{cfg['emoji']} {cfg['direction']} — {cfg['name']}",
+
+            callback_data=cb
+
+        ))
+    m.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    return m
+
+
+@static_keyboard
+def kb_pv_categories() -> InlineKeyboardMarkup:
+    m = InlineKeyboardMarkup(row_width=1)
+    for cat_key, cat in PV_CATEGORIES.items():
+        m.add(InlineKeyboardButton(
+            f"{cat['emoji']} {cat['label']}",
+            callback_data=cb_data("pv_cat", cat_key)
+        ))
+    m.add(InlineKeyboardButton("🔙 Назад", callback_data="tests_menu"))
+    return m
+
+
+@cached_keyboard
+def kb_pv_test(cat_key: str) -> InlineKeyboardMarkup:
+    cat = PV_CATEGORIES[cat_key]
+    m = InlineKeyboardMarkup(row_width=1)
+    m.add(
+        InlineKeyboardButton(f"🌐 Пройти тест — {cat['label']}", url=cat["url"]),
+        InlineKeyboardButton("🔙 Выбрать категорию", callback_data="test_PV"),
+    )
+    return m
+
+
+@cached_keyboard
+def kb_test_link(test_key: str) -> InlineKeyboardMarkup:
+    cfg = TESTS_CONFIG[test_key]
+    m = InlineKeyboardMarkup(row_width=1)
+    m.add(
+        InlineKeyboardButton(
+            f"🌐 Перейти к тесту {cfg['direction']}",
+            url=cfg["url"]
+        ),
+        InlineKeyboardButton("🔙 Назад", callback_data="tests_menu"),
+    )
+    return m
+
+
 # ── Registration keyboards ────────────────────────────────────────────────────
+@static_keyboard
 def kb_gender() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=2)
     m.add(
-        InlineKeyboardButton("👨 Мужской",      callback_data="reg_gender_М"),
-        InlineKeyboardButton("👩 Женский",       callback_data="reg_gender_Ж"),
-        InlineKeyboardButton("🌀 Другой",        callback_data="reg_gender_Другой"),
-        InlineKeyboardButton("⏭ Не указывать",  callback_data="reg_gender_skip"),
+        InlineKeyboardButton("👨 Мужской",      callback_data=cb_data("reg_gender", "М")),
+        InlineKeyboardButton("👩 Женский",       callback_data=cb_data("reg_gender", "Ж")),
+        InlineKeyboardButton("🌀 Другой",        callback_data=cb_data("reg_gender", "Другой")),
+        InlineKeyboardButton("⏭ Не указывать",  callback_data=cb_data("reg_gender", "skip")),
     )
     return m
 
 
+@cached_keyboard
 def kb_skip(next_cb: str) -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup()
     m.add(InlineKeyboardButton("⏭ Пропустить", callback_data=next_cb))
     return m
 
 
+@static_keyboard
 def kb_reg_finish() -> InlineKeyboardMarkup:
     m = InlineKeyboardMarkup(row_width=1)
     m.add(
@@ -605,6 +2710,13 @@ def kb_reg_finish() -> InlineKeyboardMarkup:
     return m
 
 
+@static_keyboard
+def kb_reg_goals_done() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup().add(
+        InlineKeyboardButton("✅ Готово", callback_data="reg_goals_done")
+    )
+
+
 # ── Screen builders ───────────────────────────────────────────────────────────
 def build_profile(u: dict) -> str:
     body, mind, spirit = calc_cores(u)
@@ -637,11 +2749,13 @@ def build_goals_view(user_id: str, period: str) -> tuple[str, InlineKeyboardMark
     bonus_hint = {"day": "+0.1", "week": "+0.3", "month": "+0.5"}[period]
     goals      = get_goals(user_id, period)
     done       = sum(1 for g in goals if g["done"])
+    last       = get_last_period_stats(user_id, period)
 
     text = (
         f"🎯 *ЦЕЛИ — {label}* _({bonus_hint} к направлению за выполнение)_\n\n"
         + fmt_goals_plain(goals)
         + f"\n\n✅ Выполнено: {done}/{len(goals)}"
+        + (f"\n📊 Прошлый период: {last['done']}/{last['total']}" if last else "")
         + "\n_Нажмите на цель для управления_"
     )
 
@@ -651,27 +2765,106 @@ def build_goals_view(user_id: str, period: str) -> tuple[str, InlineKeyboardMark
         check = "✅" if g["done"] else "⬜"
         m.add(InlineKeyboardButton(
             f"{check} {meta['emoji']} {g['title'][:35]}",
-            callback_data=f"goal_manage_{g['id']}_{period}"
+            callback_data=cb_data("goal_manage", g["id"], period)
         ))
     for lbl, cb in [("📅 День", "goals_day"), ("📋 Неделя", "goals_week"), ("📆 Месяц", "goals_month")]:
         m.add(InlineKeyboardButton(lbl, callback_data=cb))
     m.add(
-        InlineKeyboardButton("➕ Добавить цель", callback_data=f"goal_add_{period}"),
+        InlineKeyboardButton("➕ Добавить цель", callback_data=cb_data("goal_add", period)),
         InlineKeyboardButton("🔙 Главное меню",  callback_data="main_menu"),
     )
     return text, m
 
 
+def build_search_results(user_id: str, query: str) -> tuple[str, InlineKeyboardMarkup]:
+    rows = search_journal(user_id, query)
+    m = InlineKeyboardMarkup(row_width=1)
+    if not rows:
+        m.add(
+            InlineKeyboardButton("🔎 Искать ещё",  callback_data="journal_search"),
+            InlineKeyboardButton("🔙 Журнал",      callback_data="journal"),
+        )
+        return f"🔎 По запросу «{md_escape(query[:60])}» ничего не найдено.", m
+
+    lines = [f"🔎 *НАЙДЕНО: {len(rows)}* — «{md_escape(query[:60])}»\n"]
+    for r in rows:
+        emoji   = TYPE_EMOJI.get(r["type"], "📝")
+        snippet = md_escape(" ".join(r["snippet"].split()))
+        snippet = snippet.replace("\x02", "*").replace("\x03", "*")
+        lines.append(f"{emoji} `{r['display_ts']}` — {snippet}")
+        m.add(InlineKeyboardButton(f"{emoji} {r['display_ts']}", callback_data=cb_data("jentry", r["id"])))
+    m.add(
+        InlineKeyboardButton("🔎 Искать ещё",  callback_data="journal_search"),
+        InlineKeyboardButton("🔙 Журнал",      callback_data="journal"),
+    )
+    return "\n".join(lines), m
+
+
+def build_progress(user_id: str, bucket: str) -> tuple[str, InlineKeyboardMarkup]:
+    points        = PROGRESS_POINTS[bucket]
+    starts, series = get_score_series(user_id, bucket, points)
+    label = f"{points} ДНЕЙ" if bucket == "day" else f"{points} НЕДЕЛЬ"
+    lines = [f"📈 *ПРОГРЕСС — {label}*\n"]
+    for d, meta in DIRECTION_META.items():
+        values = series[d]
+        lines.append(f"{meta['emoji']} {d} `{sparkline(values)}` {values[0]:.1f} → {values[-1]:.1f}")
+    lines.append(f"\n_с {date.fromisoformat(starts[0]):%d.%m.%Y}_")
+    return "\n".join(lines), kb_progress(bucket)
+
+
+def build_leaderboard(user_id: str, board: str) -> tuple[str, InlineKeyboardMarkup]:
+    label = LEADERBOARD_BOARDS[board]
+    top   = leaderboard.top(board)
+    lines = [f"🏆 *РЕЙТИНГ — {label}*\n"]
+    if not top:
+        lines.append("_Пока никого — станьте первым!_")
+    for i, (uid, score) in enumerate(top, 1):
+        place = {1: "🥇", 2: "🥈", 3: "🥉"}.get(i, f"{i}.")
+        value = f"ур. {int(score)}" if board == "level" else f"{score:.1f}"
+        lines.append(f"{place} {md_escape(user_display(get_user(uid)))} — `{value}`")
+    mine = leaderboard.rank(board, user_id)
+    if mine:
+        lines.append(f"\n📍 Ваше место: *{mine[0]}* из {mine[1]}")
+    return "\n".join(lines), kb_leaderboard(board)
+
+
+BROADCAST_STATUS = {"draft": "черновик", "running": "идёт", "done": "завершена", "cancelled": "отменена"}
+
+
+def build_broadcast_status(row) -> str:
+    done  = row["sent"] + row["blocked"] + row["failed"]
+    lines = [
+        f"📣 *Рассылка #{row['id']}* — {BROADCAST_STATUS[row['status']]}",
+        f"Получателей: {row['total']}",
+    ]
+    if row["status"] == "draft":
+        return "\n".join(lines)
+    if row["total"]:
+        lines.append(f"{bar(min(10.0, done * 10 / row['total']))} {done * 100 // row['total']}%")
+    lines.append(f"✅ Отправлено: {row['sent']} · 🚫 Заблокировали: {row['blocked']} · ⚠️ Ошибок: {row['failed']}")
+    if row["active_sec"] > 0:
+        rate = done / row["active_sec"]
+        line = f"⏱ {row['active_sec']:.0f} с, {rate:.1f} сообщ./с"
+        if row["status"] == "running" and rate > 0:
+            line += f", осталось ~{max(0, row['total'] - done) / rate:.0f} с"
+        lines.append(line)
+    return "\n".join(lines)
+
+
 # ── Handlers ──────────────────────────────────────────────────────────────────
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
     user_id = str(message.from_user.id)
     u = get_user(user_id)
-    log.info("Старт: user_id=%s", user_id)
+    log.info("Старт: user_id=%s", user_id, extra={"user_id": user_id})
+    if u.get("blocked_at"):
+        # Вернулся после блокировки — снова получает рассылки
+        _write(user_id, "UPDATE users SET blocked_at = NULL WHERE user_id = ?", (user_id,))
+        user_cache.invalidate(user_id)
 
     if not u.get("onboarded"):
         tg_first = message.from_user.first_name or ""
-        user_states[user_id] = {"type": "reg_name"}
+        user_states[user_id] = RegNameState()
         bot.reply_to(
             message,
             f"👋 Привет{', ' + tg_first if tg_first else ''}! Добро пожаловать в *RiseHunt* 🔥\n\n"
@@ -696,9 +2889,12 @@ def cmd_help(message):
         "ℹ️ *Помощь RiseHunt*\n\n"
         "• /start — главное меню\n"
         "• /profile — ваш профиль\n"
+        "• /search _текст_ — поиск по журналу\n"
+        "• /timezone — часовой пояс для целей\n"
         "• /reset — сбросить зависшее состояние\n\n"
         "*Цели*: при добавлении выбирается направление.\n"
-        "Выполнение: день +0.1 · неделя +0.3 · месяц +0.5\n\n"
+        "Выполнение: день +0.1 · неделя +0.3 · месяц +0.5\n"
+        "Цели закрываются в конце своего дня, недели или месяца.\n\n"
         "*Уровни*: достигните 10.0 → уровень ↑, шкала сбросится до 5.0.",
         parse_mode="Markdown",
     )
@@ -710,391 +2906,828 @@ def cmd_profile(message):
     bot.reply_to(message, build_profile(u), reply_markup=kb_profile(), parse_mode="Markdown")
 
 
+@bot.message_handler(commands=["search"])
+def cmd_search(message):
+    user_id = str(message.from_user.id)
+    query   = message.text.partition(" ")[2].strip()
+    if not query:
+        user_states[user_id] = JournalSearchState()
+        bot.reply_to(message, "🔎 Что найти в журнале? Напишите слово или фразу:", reply_markup=kb_back(cb="journal"))
+        return
+    text, m = build_search_results(user_id, query)
+    bot.reply_to(message, text, reply_markup=m, parse_mode="Markdown")
+
+
+@bot.message_handler(commands=["timezone"])
+def cmd_timezone(message):
+    user_id = str(message.from_user.id)
+    name    = message.text.partition(" ")[2].strip()
+    if not name:
+        current = get_user(user_id).get("tz") or GOALS_TZ
+        bot.reply_to(
+            message,
+            f"🕒 Часовой пояс: `{current}`\n\n"
+            "Сменить: `/timezone Europe/Moscow` — по нему цели дня, недели\n"
+            "и месяца закрываются в полночь.",
+            parse_mode="Markdown",
+        )
+        return
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        bot.reply_to(message, "❌ Не знаю такой пояс. Пример: `Europe/Moscow`, `Asia/Almaty`.", parse_mode="Markdown")
+        return
+    update_user_fields(user_id, tz=name)
+    bot.reply_to(message, f"✅ Часовой пояс: `{name}`", parse_mode="Markdown")
+
+
+@bot.message_handler(commands=["prof"])
+def cmd_prof(message):
+    user_id = str(message.from_user.id)
+    if not is_admin(user_id):
+        bot.reply_to(message, "🔙 Используйте меню кнопок.", reply_markup=kb_main())
+        return
+    arg = message.text.partition(" ")[2].strip()
+    seconds = min(int(arg), PROFILE_MAX_SECONDS) if arg.isdigit() and int(arg) > 0 else PROFILE_SECONDS
+    chat_id = message.chat.id
+
+    def done(path: str, stacks: dict[str, int]) -> None:
+        total = sum(stacks.values())
+        lines = [f"🔬 *Профиль готов* — {total} сэмплов", f"`{path}`\n"]
+        for route, n in profile_summary(stacks):
+            lines.append(f"`{n * 100 / total:5.1f}%` {md_escape(route)}")
+        if not total:
+            lines.append("_Хендлеры в окне не выполнялись._")
+        bot.send_message(chat_id, "\n".join(lines), parse_mode="Markdown", priority=PRIO_BACKGROUND)
+
+    if profiler.start(seconds, done):
+        bot.reply_to(message, f"🔬 Профилирование {seconds} с…")
+    else:
+        bot.reply_to(message, "⏳ Профилирование уже идёт.")
+
+
+@bot.message_handler(commands=["broadcast"])
+def cmd_broadcast(message):
+    user_id = str(message.from_user.id)
+    if not is_admin(user_id):
+        bot.reply_to(message, "🔙 Используйте меню кнопок.", reply_markup=kb_main())
+        return
+    parts = message.text.split(None, 1)
+    if len(parts) == 1:
+        row = broadcaster.get()
+        if row is None:
+            bot.reply_to(message, "📣 Рассылок ещё не было.\n\nНовая: `/broadcast текст сообщения`",
+                         parse_mode="Markdown")
+            return
+        bot.reply_to(message, build_broadcast_status(row),
+                     reply_markup=kb_broadcast(row["id"], row["status"]), parse_mode="Markdown")
+        return
+    broadcast_id = broadcaster.create(user_id, parts[1])
+    row = broadcaster.get(broadcast_id)
+    # Текст — как его увидят пользователи, без разметки
+    bot.reply_to(message, f"📣 Рассылка #{broadcast_id}, получателей: {row['total']}\n\n{parts[1]}",
+                 reply_markup=kb_broadcast(broadcast_id, "draft"))
+
+
 @bot.message_handler(commands=["reset"])
 def cmd_reset(message):
     user_states.pop(str(message.from_user.id), None)
     bot.reply_to(message, "✅ Состояние сброшено.", reply_markup=kb_main())
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_handler(call):
-    data    = call.data
-    user_id = str(call.from_user.id)
-    cid     = call.message.chat.id
-    mid     = call.message.message_id
-    log.info("Callback: %s from %s", data, user_id)
+# ── Callback routing ──────────────────────────────────────────────────────────
+# callback_data бывает двух видов:
+#   • статичный ключ — "main_menu", "goals_week", "test_EQ" (точное совпадение);
+#   • маршрут с параметрами. Формат v1: "goal_manage|12|day" — имя маршрута и
+#     аргументы через "|". Старые кнопки v0 ("goal_manage_12_day") остались в
+#     уже отправленных сообщениях, поэтому тоже разбираются.
+# Поиск — словарь по ключу/имени маршрута, без перебора всех веток подряд.
+CB_SEP       = "|"
+CB_MAX_BYTES = 64   # лимит Telegram на callback_data
+
+
+def _period(value: str) -> str:
+    if value not in PERIOD_BONUS:
+        raise ValueError(f"Недопустимый период: {value}")
+    return value
+
+
+def _direction(value: str) -> str:
+    if value not in VALID_DIRECTIONS:
+        raise ValueError(f"Недопустимое направление: {value}")
+    return value
+
+
+class CallbackRouter:
+    def __init__(self):
+        self.exact:  dict[str, tuple] = {}   # data -> (handler, args)
+        self.routes: dict[str, tuple] = {}   # имя  -> (handler, типы аргументов)
+
+    def add_exact(self, data: str, handler, *args) -> None:
+        self.exact[data] = (handler, args)
+
+    def on(self, *keys: str):
+        def deco(fn):
+            for key in keys:
+                self.add_exact(key, fn)
+            return fn
+        return deco
+
+    def on_route(self, name: str, *types):
+        def deco(fn):
+            self.routes[name] = (fn, types)
+            return fn
+        return deco
+
+    def encode(self, name: str, *args) -> str:
+        _, types = self.routes[name]
+        if len(args) != len(types):
+            raise ValueError(f"{name}: ожидается {len(types)} аргумент(ов), передано {len(args)}")
+        parts = [str(a) for a in args]
+        if any(CB_SEP in p for p in parts):
+            raise ValueError(f"{name}: аргумент содержит '{CB_SEP}'")
+        data = CB_SEP.join([name, *parts])
+        if len(data.encode("utf-8")) > CB_MAX_BYTES:
+            raise ValueError(f"callback_data длиннее {CB_MAX_BYTES} байт: {data}")
+        return data
+
+    def resolve(self, data: str):
+        """Возвращает (handler, args) или None, если callback неизвестен/битый."""
+        hit = self.exact.get(data)
+        if hit is not None:
+            return hit
+        if CB_SEP in data:
+            raw   = data.split(CB_SEP)
+            route = self.routes.get(raw[0])
+            if route is None:
+                return None
+            del raw[0]
+        else:
+            # v0: имя маршрута — одно или два первых слова до "_"
+            i = data.find("_")
+            j = data.find("_", i + 1)
+            route = self.routes.get(data[:j]) if j > 0 else None
+            if route is None:
+                route = self.routes.get(data[:i]) if i > 0 else None
+                j = i
+            if route is None:
+                return None
+            raw = data[j + 1:].split("_", len(route[1]) - 1)
+        fn, types = route
+        if len(raw) != len(types):
+            return None
+        try:
+            if len(types) == 1:
+                return fn, (types[0](raw[0]),)
+            if len(types) == 2:
+                return fn, (types[0](raw[0]), types[1](raw[1]))
+            return fn, tuple([t(v) for t, v in zip(types, raw)])
+        except ValueError:
+            return None
+
+
+callbacks = CallbackRouter()
+
+
+def cb_data(name: str, *args) -> str:
+    return callbacks.encode(name, *args)
+
+
+# ── Render cache ──────────────────────────────────────────────────────────────
+# Последний показанный экран для каждого (chat_id, message_id). Если новый
+# edit совпадает с ним байт в байт, запрос в Telegram не отправляем — он всё
+# равно ответил бы «message is not modified».
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "10000"))
+
+
+class RenderCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._shown: OrderedDict[tuple, bytes] = OrderedDict()
+        self._pending: dict[tuple, tuple[int, int]] = {}   # (chat, msg) -> (номер последней правки, в очереди)
+        self._lock   = threading.Lock()
+        self.skipped = 0
+        self.edits   = 0
+
+    @staticmethod
+    def digest(text: str, markup, parse_mode) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+        if markup is not None:
+            h.update(markup if isinstance(markup, str) else markup.to_json().encode("utf-8"))
+        h.update(b"\0" + str(parse_mode).encode())
+        return h.digest()
+
+    def unchanged(self, key: tuple, digest: bytes) -> bool:
+        with self._lock:
+            if key not in self._pending and self._shown.get(key) == digest:
+                self._shown.move_to_end(key)
+                self.skipped += 1
+                return True
+            return False
+
+    def remember(self, key: tuple, digest: bytes) -> None:
+        with self._lock:
+            self._store(key, digest)
+
+    def begin(self, key: tuple) -> int:
+        """Правка ушла в очередь: пока она не отправлена, экран неизвестен. Возвращает её номер."""
+        with self._lock:
+            self._shown.pop(key, None)
+            last, in_flight = self._pending.get(key, (0, 0))
+            self._pending[key] = (last + 1, in_flight + 1)
+            return last + 1
+
+    def done(self, key: tuple, seq: int, digest: bytes | None) -> None:
+        """
+        Правка seq завершилась (digest=None — не дошла). Экран запоминаем,
+        только если это последняя правка сообщения и других в очереди нет.
+        """
+        with self._lock:
+            last, in_flight = self._pending.pop(key)
+            if in_flight > 1:
+                self._pending[key] = (last, in_flight - 1)
+            elif digest is not None and seq == last:
+                self._store(key, digest)
+
+    def _store(self, key: tuple, digest: bytes) -> None:
+        if not self.max_entries:
+            return
+        self.edits += 1
+        self._shown[key] = digest
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.max_entries:
+            self._shown.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._shown)
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+metrics.gauge("risehunt_render_cache_edits_total", "Правки экранов: отправлены или пропущены без изменений",
+              lambda: {("sent",): render_cache.edits, ("skipped",): render_cache.skipped}, ("result",),
+              kind="counter")
+metrics.gauge("risehunt_render_cache_entries", "Сообщения с известным экраном", lambda: len(render_cache))
+metrics.gauge("risehunt_render_cache_pending", "Сообщения с правками в очереди Outbox",
+              lambda: len(render_cache._pending))
+
+
+class CallbackContext:
+    __slots__ = ("call", "user_id", "cid", "mid", "answered")
+
+    def __init__(self, call):
+        mark_activity()
+        self.call     = call
+        self.user_id  = str(call.from_user.id)
+        self.cid      = call.message.chat.id
+        self.mid      = call.message.message_id
+        self.answered = False
+
+    def edit(self, text, markup=None):
+        key    = (self.cid, self.mid)
+        digest = render_cache.digest(text, markup, "Markdown")
+        if render_cache.unchanged(key, digest):
+            return
+        if bot.outbox is not None:
+            # Правка уйдёт позже и может не дойти: пока она в очереди, экран
+            # неизвестен, а запоминаем его только после отправки последней правки
+            seq = render_cache.begin(key)
 
-    def edit(text, markup=None):
-        bot.edit_message_text(text, cid, mid, reply_markup=markup, parse_mode="Markdown")
+            def on_done(error):
+                shown = error is None or "message is not modified" in str(error)
+                render_cache.done(key, seq, digest if shown else None)
 
-    try:
-        if data == "main_menu":
-            user_states.pop(user_id, None)
-            edit("🧭 *Главное меню*\nВыберите действие:", kb_main())
-
-        elif data == "profile":
-            edit(build_profile(get_user(user_id)), kb_profile())
-
-        elif data == "edit_name":
-            user_states[user_id] = {"type": "edit_name"}
-            edit("✏️ *Изменить имя*\n\nНапишите новое имя или псевдоним:", kb_back(cb="profile"))
-
-        # ── Registration: age skip ────────────────────────────────────────────
-        elif data == "reg_age_skip":
-            user_states[user_id] = {"type": "reg_gender_wait"}
-            edit("3️⃣ *Укажи пол:*", kb_gender())
-
-        # ── Registration: gender ──────────────────────────────────────────────
-        elif data.startswith("reg_gender_"):
-            val    = data[len("reg_gender_"):]
-            gender = None if val == "skip" else val
-            update_user_fields(user_id, gender=gender)
-            user_states[user_id] = {"type": "reg_tg"}
-            edit(
-                "4️⃣ *Ваш Telegram username*\n\n"
-                "Напишите @username или нажмите «Пропустить»:",
-                kb_skip(next_cb="reg_tg_skip"),
-            )
+            bot.edit_message_text(text, self.cid, self.mid, reply_markup=markup, parse_mode="Markdown",
+                                  on_done=on_done)
+            return
+        try:
+            bot.edit_message_text(text, self.cid, self.mid, reply_markup=markup, parse_mode="Markdown")
+        except ApiTelegramException as e:
+            if "message is not modified" not in e.description:
+                raise
+        render_cache.remember(key, digest)
 
-        elif data == "reg_tg_skip":
-            user_states.pop(user_id, None)
-            edit(
-                "🎉 *Отлично! Профиль заполнен*\n\nС чего начнём прямо сейчас?",
-                kb_reg_finish(),
-            )
+    def answer(self, text=None):
+        self.answered = True
+        answer_callback(self.call.id, text)
 
-        # ── Registration finish ───────────────────────────────────────────────
-        elif data == "reg_action_goals":
-            update_user_fields(user_id, onboarded=1)
-            user_states[user_id] = {"type": "reg_week_goals", "goals": []}
-            edit(
-                "📋 *ЦЕЛИ НА НЕДЕЛЮ*\n\n"
-                "Пиши цели по одной — каждую отдельным сообщением.\n"
-                "Когда закончишь — нажми *«Готово»*:",
-                InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("✅ Готово", callback_data="reg_goals_done")
-                ),
-            )
 
-        elif data == "reg_goals_done":
-            state      = user_states.get(user_id, {})
-            goals_list = state.get("goals", [])
-            for title in goals_list:
-                add_goal(user_id, "week", "PV", title)
-            user_states.pop(user_id, None)
-            u     = get_user(user_id)
-            count = len(goals_list)
-            edit(
-                f"🎉 *Готово, {user_display(u)}!*\n\n"
-                f"Сохранено целей на неделю: *{count}*\n\n"
-                "Добро пожаловать в RiseHunt! 🚀",
-                kb_main(),
-            )
+CALLBACK_RETRY_MAX_SEC = float(os.getenv("CALLBACK_RETRY_MAX_SEC", "1"))
 
-        elif data == "reg_action_workout":
-            update_user_fields(user_id, onboarded=1)
-            user_states.pop(user_id, None)
-            edit(
-                "🏋️ *ПЛАН ТРЕНИРОВОК*\n\n"
-                "_ВОЗ рекомендует 150 мин/нед умеренной нагрузки_\n\n"
-                "Выберите частоту тренировок в неделю:",
-                kb_training(),
-            )
-        elif data == "tests_menu":
-            m = InlineKeyboardMarkup(row_width=1)
-            # PV — отдельная кнопка (у неё свой обработчик с категориями)
-            m.add(InlineKeyboardButton(
-                "💪 PV — Физическая витальность",
-                callback_data="test_PV"
-            ))
-            # Остальные тесты из TESTS_CONFIG
-            for cb, cfg in TESTS_CONFIG.items():
-                m.add(InlineKeyboardButton(
-
-                    f"{cfg['emoji']} {cfg['direction']} — {cfg['name']}",
-
-                    callback_data=cb
-
-                ))
-            m.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
-            edit(
-                "📋 *АНКЕТЫ И ТЕСТЫ*\n\n"
-                "Выбери направление → перейди по ссылке → "
-                "пройди тест → вернись и введи результат:",
-                m,
-            )
-        elif data == "test_PV":
-            u = get_user(user_id)
-            old = u["PV"]
-            m = InlineKeyboardMarkup(row_width=1)
-            for cat_key, cat in PV_CATEGORIES.items():
-                m.add(InlineKeyboardButton(
-                    f"{cat['emoji']} {cat['label']}",
-                    callback_data=f"pv_cat_{cat_key}"
-                ))
-            m.add(InlineKeyboardButton("🔙 Назад", callback_data="tests_menu"))
-            edit(
-                f"💪 *PV — Физическая витальность*\n\n"
-                f"Текущий уровень: `{old:.1f}/10` {bar(old)}\n\n"
-                "Выбери свою категорию подготовки:",
-                m,
-            )
 
-        elif data.startswith("pv_cat_"):
-            cat_key = data[7:]
-            if cat_key not in PV_CATEGORIES:
-                bot.answer_callback_query(call.id, "Неизвестная категория")
-                return
-            cat = PV_CATEGORIES[cat_key]
-            user_states[user_id] = {"type": "pv_input", "cat_key": cat_key}
-            m = InlineKeyboardMarkup(row_width=1)
-            m.add(
-                InlineKeyboardButton(f"🌐 Пройти тест — {cat['label']}", url=cat["url"]),
-                InlineKeyboardButton("🔙 Выбрать категорию", callback_data="test_PV"),
-            )
-            edit(
-                f"{cat['emoji']} *{cat['label']}*\n\n"
-                f"{cat['desc']}\n\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                "Пройди тест по ссылке выше.\n"
-                "Tally покажет *балл от 0 до 100*.\n\n"
-                "✏️ Вернись и введи этот балл:",
-                m,
-            )
-        elif data in TESTS_CONFIG:
-            # Показываем конкретный тест с кнопкой-ссылкой
-            cfg = TESTS_CONFIG[data]
-            direction = cfg["direction"]
-            u = get_user(user_id)
-            level = u.get("level", 1)
-            old = u[direction]
-
-            m = InlineKeyboardMarkup(row_width=1)
-            m.add(
-                InlineKeyboardButton(
-                    f"🌐 Перейти к тесту {direction}",
-                    url=cfg["url"]
-                ),
-                InlineKeyboardButton("🔙 Назад", callback_data="tests_menu"),
-            )
+def answer_callback(call_id: str, text: str | None = None) -> None:
+    """
+    answerCallbackQuery не больше чем с одним коротким повтором (429 с
+    retry_after до CALLBACK_RETRY_MAX_SEC или сетевой сбой). Ждём в потоке
+    хендлера, то есть держим весь шард, а запрос через несколько секунд всё
+    равно протухнет. Идёт напрямую, а не через очередь: это не сообщение в чат,
+    и лимит чата на него не тратим. Неудача не роняет хендлер — кнопка погаснет сама.
+    """
+    for attempt in (1, 2):
+        try:
+            bot.answer_callback_query(call_id, text)
+            return
+        except ApiTelegramException as e:
+            error       = e.description
+            retry_after = retry_after_of(e) if e.error_code == 429 else None
+        except Exception as e:
+            error       = e
+            retry_after = 0.5
+        if attempt > 1 or retry_after is None or retry_after > CALLBACK_RETRY_MAX_SEC:
+            log.warning("Ответ на callback не отправлен: %s", error)
+            return
+        log.warning("Ответ на callback: повтор через %.1f с", retry_after)
+        time.sleep(retry_after)
 
-            tier = "продвинутый (Ур.2+)" if level > 1 else "базовый"
-            edit(
-                f"{cfg['emoji']} *{direction} — {cfg['name']}* _{tier}_\n\n"
-                f"Текущий уровень: `{old:.1f}/10` {bar(old)}\n\n"
-                f"{cfg['instruction']}\n\n"
-                f"💡 {cfg['hint']}",
-                m,
-            )
-            # Ждём ввода числа
-            user_states[user_id] = {
-                "type": "test_input",
-                "test_key": data,
-                "direction": direction,
-            }
 
-        # ── Journal ───────────────────────────────────────────────────────────
-        elif data == "journal":
-            edit("📓 *ЖУРНАЛ*\nВыберите раздел:", kb_journal())
-
-        elif data == "journal_emotions":
-            user_states[user_id] = {"type": "emotions"}
-            edit(
-                "❤️ *ДНЕВНИК ЭМОЦИЙ*\n\n"
-                "• Что сегодня чувствовали?\n"
-                "• Какие эмоции доминировали?\n"
-                "• Что помогло справиться?\n\n"
-                "✍️ Напишите запись:",
-                kb_back_main(),
-            )
+@callbacks.on("main_menu")
+def cb_main_menu(ctx):
+    user_states.pop(ctx.user_id, None)
+    ctx.edit("🧭 *Главное меню*\nВыберите действие:", kb_main())
 
-        elif data == "journal_reflection":
-            user_states[user_id] = {"type": "reflection"}
-            edit(
-                "🕯️ *РЕФЛЕКСИЯ*\n\n"
-                "• Лучший момент дня?\n"
-                "• Что можно улучшить?\n"
-                "• Главный инсайт?\n\n"
-                "💭 Ваши мысли:",
-                kb_back_main(),
-            )
 
-        elif data == "journal_workout":
-            edit(
-                "🏋️ *ТРЕНИРОВКА*\n\n"
-                "_ВОЗ рекомендует 150 мин/нед умеренной нагрузки_\n\n"
-                "Выберите частоту тренировок в неделю:",
-                kb_training(),
-            )
+@callbacks.on("profile")
+def cb_profile(ctx):
+    ctx.edit(build_profile(get_user(ctx.user_id)), kb_profile())
 
-        elif data == "journal_history":
-            entries = get_journal_history(user_id)
-            if not entries:
-                edit("📜 *История пуста* — записей за 7 дней нет.", kb_back(cb="journal"))
-            else:
-                lines = ["📜 *ЗАПИСИ ЗА 7 ДНЕЙ*\n", "_Нажмите на запись, чтобы открыть полностью:_\n"]
-                for e in entries:
-                    emoji   = TYPE_EMOJI.get(e["type"], "📝")
-                    dt      = e["created_at"][:16]
-                    raw     = e["content"]
-                    preview = raw[raw.find("\n\n")+2:][:55].replace("\n", " ") if "\n\n" in raw else raw[:55]
-                    lines.append(f"{emoji} `{dt}` — _{preview}..._")
-                edit("\n".join(lines), kb_history_list(entries))
-
-        elif data.startswith("jentry_"):
-            entry_id = int(data[7:])
-            entry    = get_journal_entry(entry_id, user_id)
-            if not entry:
-                edit("❌ Запись не найдена.", kb_back(cb="journal_history"))
-            else:
-                emoji   = TYPE_EMOJI.get(entry["type"], "📝")
-                dt      = entry["created_at"][:16]
-                content = entry["content"]
-                if len(content) > 3600:
-                    content = content[:3600] + "\n\n_[текст обрезан]_"
-                edit(f"{emoji} *Запись от {dt}*\n\n{content}", kb_entry_back())
-
-        elif data.startswith("training_"):
-            freq = int(data.split("_")[1])
-            user_states[user_id] = {"type": "workout", "days": freq, "current_day": 1, "entries": []}
-            edit(
-                f"✅ *{freq} ДНЕЙ/НЕДЕЛЮ*\n\n"
-                f"📅 *День 1 из {freq}*\n"
-                "Напишите упражнения для этого дня:",
-                kb_back_main(),
-            )
 
-        # ── Goals ─────────────────────────────────────────────────────────────
-        elif data in ("goals", "goals_day", "goals_week", "goals_month"):
-            period = "day" if data in ("goals", "goals_day") else data.split("_")[1]
-            user_states[user_id] = {"type": "goals_view", "period": period}
-            text, markup = build_goals_view(user_id, period)
-            edit(text, markup)
-
-        elif data.startswith("goal_add_"):
-            period = data[9:]
-            lbl    = {"day": "на день", "week": "на неделю", "month": "на месяц"}[period]
-            edit(
-                f"➕ *Новая цель {lbl}*\n\n"
-                "Выберите направление, к которому относится цель:",
-                kb_goal_direction(period),
-            )
+def _bucket(value: str) -> str:
+    if value not in PROGRESS_POINTS:
+        raise ValueError(f"Недопустимый интервал: {value}")
+    return value
+
+
+@callbacks.on_route("progress", _bucket)
+def cb_progress(ctx, bucket="day"):
+    text, markup = build_progress(ctx.user_id, bucket)
+    ctx.edit(text, markup)
+
+
+callbacks.add_exact("progress", cb_progress)
+
+
+@callbacks.on("edit_name")
+def cb_edit_name(ctx):
+    user_states[ctx.user_id] = EditNameState()
+    ctx.edit("✏️ *Изменить имя*\n\nНапишите новое имя или псевдоним:", kb_back(cb="profile"))
+
+
+# ── Registration ──────────────────────────────────────────────────────────────
+@callbacks.on("reg_age_skip")
+def cb_reg_age_skip(ctx):
+    user_states[ctx.user_id] = RegGenderState()
+    ctx.edit("3️⃣ *Укажи пол:*", kb_gender())
+
+
+@callbacks.on_route("reg_gender", str)
+def cb_reg_gender(ctx, val):
+    gender = None if val == "skip" else val
+    update_user_fields(ctx.user_id, gender=gender)
+    user_states[ctx.user_id] = RegTgState()
+    ctx.edit(
+        "4️⃣ *Ваш Telegram username*\n\n"
+        "Напишите @username или нажмите «Пропустить»:",
+        kb_skip(next_cb="reg_tg_skip"),
+    )
+
+
+@callbacks.on("reg_tg_skip")
+def cb_reg_tg_skip(ctx):
+    user_states.pop(ctx.user_id, None)
+    ctx.edit(
+        "🎉 *Отлично! Профиль заполнен*\n\nС чего начнём прямо сейчас?",
+        kb_reg_finish(),
+    )
+
 
-        elif data.startswith("goal_dir_"):
-            parts     = data.split("_")
-            period    = parts[2]
-            direction = parts[3]
-            user_states[user_id] = {"type": "goal_add", "period": period, "direction": direction}
-            meta = DIRECTION_META[direction]
-            lbl  = {"day": "на день", "week": "на неделю", "month": "на месяц"}[period]
-            edit(
-                f"➕ *Новая цель {lbl}*\n"
-                f"Направление: {meta['emoji']} *{direction} — {meta['name']}*\n\n"
-                "Напишите текст цели одним сообщением:",
-                kb_back(cb=f"goal_add_{period}"),
+@callbacks.on("reg_action_goals")
+def cb_reg_action_goals(ctx):
+    update_user_fields(ctx.user_id, onboarded=1)
+    user_states[ctx.user_id] = RegWeekGoalsState()
+    ctx.edit(
+        "📋 *ЦЕЛИ НА НЕДЕЛЮ*\n\n"
+        "Пиши цели по одной — каждую отдельным сообщением.\n"
+        "Когда закончишь — нажми *«Готово»*:",
+        kb_reg_goals_done(),
+    )
+
+
+@callbacks.on("reg_goals_done")
+def cb_reg_goals_done(ctx):
+    user_id    = ctx.user_id
+    state      = user_states.get(user_id)
+    goals_list = state.goals if isinstance(state, RegWeekGoalsState) else []
+    for title in goals_list:
+        add_goal(user_id, "week", "PV", title)
+    user_states.pop(user_id, None)
+    u     = get_user(user_id)
+    count = len(goals_list)
+    ctx.edit(
+        f"🎉 *Готово, {user_display(u)}!*\n\n"
+        f"Сохранено целей на неделю: *{count}*\n\n"
+        "Добро пожаловать в RiseHunt! 🚀",
+        kb_main(),
+    )
+
+
+@callbacks.on("reg_action_workout")
+def cb_reg_action_workout(ctx):
+    update_user_fields(ctx.user_id, onboarded=1)
+    user_states.pop(ctx.user_id, None)
+    ctx.edit(
+        "🏋️ *ПЛАН ТРЕНИРОВОК*\n\n"
+        "_ВОЗ рекомендует 150 мин/нед умеренной нагрузки_\n\n"
+        "Выберите частоту тренировок в неделю:",
+        kb_training(),
+    )
+
+
+# ── Tests ─────────────────────────────────────────────────────────────────────
+@callbacks.on("tests_menu")
+def cb_tests_menu(ctx):
+    ctx.edit(
+        "📋 *АНКЕТЫ И ТЕСТЫ*\n\n"
+        "Выбери направление → перейди по ссылке → "
+        "пройди тест → вернись и введи результат:",
+        kb_tests_menu(),
+    )
+
+
+@callbacks.on("test_PV")
+def cb_test_pv(ctx):
+    u = get_user(ctx.user_id)
+    old = u["PV"]
+    ctx.edit(
+        f"💪 *PV — Физическая витальность*\n\n"
+        f"Текущий уровень: `{old:.1f}/10` {bar(old)}\n\n"
+        "Выбери свою категорию подготовки:",
+        kb_pv_categories(),
+    )
+
+
+@callbacks.on_route("pv_cat", str)
+def cb_pv_cat(ctx, cat_key):
+    if cat_key not in PV_CATEGORIES:
+        ctx.answer("Неизвестная категория")
+        return
+    cat = PV_CATEGORIES[cat_key]
+    user_states[ctx.user_id] = PvInputState(cat_key)
+    ctx.edit(
+        f"{cat['emoji']} *{cat['label']}*\n\n"
+        f"{cat['desc']}\n\n"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        "Пройди тест по ссылке выше.\n"
+        "Tally покажет *балл от 0 до 100*.\n\n"
+        "✏️ Вернись и введи этот балл:",
+        kb_pv_test(cat_key),
+    )
+
+
+def cb_test_open(ctx, test_key):
+    # Показываем конкретный тест с кнопкой-ссылкой
+    cfg = TESTS_CONFIG[test_key]
+    direction = cfg["direction"]
+    u = get_user(ctx.user_id)
+    level = u.get("level", 1)
+    old = u[direction]
+
+    tier = "продвинутый (Ур.2+)" if level > 1 else "базовый"
+    ctx.edit(
+        f"{cfg['emoji']} *{direction} — {cfg['name']}* _{tier}_\n\n"
+        f"Текущий уровень: `{old:.1f}/10` {bar(old)}\n\n"
+        f"{cfg['instruction']}\n\n"
+        f"💡 {cfg['hint']}",
+        kb_test_link(test_key),
+    )
+    # Ждём ввода числа
+    user_states[ctx.user_id] = TestInputState(test_key, direction)
+
+
+for _test_key in TESTS_CONFIG:
+    callbacks.add_exact(_test_key, cb_test_open, _test_key)
+
+
+# ── Journal ───────────────────────────────────────────────────────────────────
+@callbacks.on("journal")
+def cb_journal(ctx):
+    ctx.edit("📓 *ЖУРНАЛ*\nВыберите раздел:", kb_journal())
+
+
+@callbacks.on("journal_emotions")
+def cb_journal_emotions(ctx):
+    user_states[ctx.user_id] = EmotionsState()
+    ctx.edit(
+        "❤️ *ДНЕВНИК ЭМОЦИЙ*\n\n"
+        "• Что сегодня чувствовали?\n"
+        "• Какие эмоции доминировали?\n"
+        "• Что помогло справиться?\n\n"
+        "✍️ Напишите запись:",
+        kb_back_main(),
+    )
+
+
+@callbacks.on("journal_reflection")
+def cb_journal_reflection(ctx):
+    user_states[ctx.user_id] = ReflectionState()
+    ctx.edit(
+        "🕯️ *РЕФЛЕКСИЯ*\n\n"
+        "• Лучший момент дня?\n"
+        "• Что можно улучшить?\n"
+        "• Главный инсайт?\n\n"
+        "💭 Ваши мысли:",
+        kb_back_main(),
+    )
+
+
+@callbacks.on("journal_workout")
+def cb_journal_workout(ctx):
+    ctx.edit(
+        "🏋️ *ТРЕНИРОВКА*\n\n"
+        "_ВОЗ рекомендует 150 мин/нед умеренной нагрузки_\n\n"
+        "Выберите частоту тренировок в неделю:",
+        kb_training(),
+    )
+
+
+# Фильтры истории: код в callback_data -> (подпись кнопки, тип записи)
+JOURNAL_FILTERS = {
+    "a": ("Все",  None),
+    "e": ("❤️",   "emotions"),
+    "r": ("🕯️",   "reflection"),
+    "w": ("🏋️",   "workout"),
+}
+
+
+def _journal_filter(value: str) -> str:
+    if value not in JOURNAL_FILTERS:
+        raise ValueError(f"Недопустимый фильтр журнала: {value}")
+    return value
+
+
+def _page_dir(value: str) -> str:
+    if value not in ("o", "n"):
+        raise ValueError(f"Недопустимое направление листания: {value}")
+    return value
+
+
+@callbacks.on_route("jpage", _journal_filter, _page_dir, int, int)
+def cb_journal_page(ctx, jfilter="a", direction="o", epoch=0, last_id=0):
+    older   = direction == "o"
+    cursor  = (epoch_to_ts(epoch), last_id) if epoch else None
+    entries, more = get_journal_page(ctx.user_id, JOURNAL_FILTERS[jfilter][1], cursor, older)
+    if not entries:
+        ctx.edit("📜 *История пуста* — записей нет.", kb_history_page([], jfilter, False, False))
+        return
+    # В сторону, откуда пришли, записи точно есть; в сторону листания — если more
+    has_newer = more if not older else cursor is not None
+    has_older = more if older else True
+    lines = ["📜 *ЗАПИСИ ЖУРНАЛА*\n", "_Нажмите на запись, чтобы открыть полностью:_\n"]
+    for e in entries:
+        emoji = TYPE_EMOJI.get(e["type"], "📝")
+        lines.append(f"{emoji} `{e['display_ts']}` — _{e['preview']}..._")
+    ctx.edit("\n".join(lines), kb_history_page(entries, jfilter, has_newer, has_older))
+
+
+callbacks.add_exact("journal_history", cb_journal_page)
+
+
+@callbacks.on("journal_search")
+def cb_journal_search(ctx):
+    user_states[ctx.user_id] = JournalSearchState()
+    ctx.edit(
+        "🔎 *ПОИСК ПО ЖУРНАЛУ*\n\n"
+        "Напишите слово или фразу — например, _сон_ или _тренировка ног_:",
+        kb_back(cb="journal"),
+    )
+
+
+@callbacks.on_route("jentry", int)
+def cb_jentry(ctx, entry_id):
+    entry = get_journal_entry(entry_id, ctx.user_id)
+    if not entry:
+        ctx.edit("❌ Запись не найдена.", kb_back(cb="journal_history"))
+    else:
+        emoji   = TYPE_EMOJI.get(entry["type"], "📝")
+        dt      = entry["display_ts"]
+        content = entry["content"]
+        if len(content) > 3600:
+            content = content[:3600] + "\n\n_[текст обрезан]_"
+        ctx.edit(f"{emoji} *Запись от {dt}*\n\n{content}", kb_entry_back())
+
+
+@callbacks.on_route("training", int)
+def cb_training(ctx, freq):
+    user_states[ctx.user_id] = WorkoutState(days=freq)
+    ctx.edit(
+        f"✅ *{freq} ДНЕЙ/НЕДЕЛЮ*\n\n"
+        f"📅 *День 1 из {freq}*\n"
+        "Напишите упражнения для этого дня:",
+        kb_back_main(),
+    )
+
+
+# ── Goals ─────────────────────────────────────────────────────────────────────
+def cb_goals(ctx, period):
+    user_states[ctx.user_id] = GoalsViewState(period)
+    text, markup = build_goals_view(ctx.user_id, period)
+    ctx.edit(text, markup)
+
+
+callbacks.add_exact("goals", cb_goals, "day")
+for _period_key in PERIOD_BONUS:
+    callbacks.add_exact(f"goals_{_period_key}", cb_goals, _period_key)
+
+
+@callbacks.on_route("goal_add", _period)
+def cb_goal_add(ctx, period):
+    lbl = {"day": "на день", "week": "на неделю", "month": "на месяц"}[period]
+    ctx.edit(
+        f"➕ *Новая цель {lbl}*\n\n"
+        "Выберите направление, к которому относится цель:",
+        kb_goal_direction(period),
+    )
+
+
+@callbacks.on_route("goal_dir", _period, _direction)
+def cb_goal_dir(ctx, period, direction):
+    user_states[ctx.user_id] = GoalAddState(period, direction)
+    meta = DIRECTION_META[direction]
+    lbl  = {"day": "на день", "week": "на неделю", "month": "на месяц"}[period]
+    ctx.edit(
+        f"➕ *Новая цель {lbl}*\n"
+        f"Направление: {meta['emoji']} *{direction} — {meta['name']}*\n\n"
+        "Напишите текст цели одним сообщением:",
+        kb_back(cb=cb_data("goal_add", period)),
+    )
+
+
+@callbacks.on_route("goal_manage", int, _period)
+def cb_goal_manage(ctx, goal_id, period):
+    goal = get_goal_by_id(goal_id, ctx.user_id)
+    if not goal:
+        ctx.edit("❌ Цель не найдена.", kb_back(cb=f"goals_{period}"))
+    else:
+        d      = goal["direction"]
+        meta   = DIRECTION_META[d]
+        bonus  = PERIOD_BONUS[period]
+        status = "✅ выполнена" if goal["done"] else "⬜ активна"
+        ctx.edit(
+            f"🎯 *Цель #{goal_id}*\n\n"
+            f"{meta['emoji']} *{d} — {meta['name']}*\n\n"
+            f"_{goal['title']}_\n\n"
+            f"Статус: {status}\n"
+            f"💡 За выполнение: *+{bonus}* к {d}",
+            kb_goal_manage(goal_id, period),
+        )
+
+
+@callbacks.on_route("goal_done", int, _period)
+def cb_goal_done(ctx, goal_id, period):
+    user_id = ctx.user_id
+    goal    = get_goal_by_id(goal_id, user_id)
+    if not goal:
+        ctx.edit("❌ Цель не найдена.", kb_back(cb=f"goals_{period}"))
+    elif goal["done"]:
+        ctx.answer("Цель уже отмечена выполненной!")
+    else:
+        complete_goal(goal_id)
+        direction = goal["direction"]
+        bonus     = PERIOD_BONUS[period]
+        u         = get_user(user_id)
+        old_val   = u[direction]
+        new_val   = clamp(old_val + bonus)
+        update_direction(user_id, direction, new_val, "goal")
+        meta    = DIRECTION_META[direction]
+        leveled = check_and_level_up(ctx.cid, user_id, direction, new_val)
+        text, markup = build_goals_view(user_id, period)
+        if leveled:
+            ctx.edit(text, markup)
+        else:
+            ctx.edit(
+                f"🎉 *Выполнено!* {meta['emoji']} {direction}: "
+                f"`{old_val:.1f}` → `{new_val:.1f}` *(+{bonus})*\n\n" + text,
+                markup,
             )
 
-        elif data.startswith("goal_manage_"):
-            parts   = data.split("_")
-            goal_id = int(parts[2])
-            period  = parts[3]
-            goal    = get_goal_by_id(goal_id, user_id)
-            if not goal:
-                edit("❌ Цель не найдена.", kb_back(cb=f"goals_{period}"))
-            else:
-                d      = goal["direction"]
-                meta   = DIRECTION_META[d]
-                bonus  = PERIOD_BONUS[period]
-                status = "✅ выполнена" if goal["done"] else "⬜ активна"
-                edit(
-                    f"🎯 *Цель #{goal_id}*\n\n"
-                    f"{meta['emoji']} *{d} — {meta['name']}*\n\n"
-                    f"_{goal['title']}_\n\n"
-                    f"Статус: {status}\n"
-                    f"💡 За выполнение: *+{bonus}* к {d}",
-                    kb_goal_manage(goal_id, period),
-                )
 
-        elif data.startswith("goal_done_"):
-            parts   = data.split("_")
-            goal_id = int(parts[2])
-            period  = parts[3]
-            goal    = get_goal_by_id(goal_id, user_id)
-            if not goal:
-                edit("❌ Цель не найдена.", kb_back(cb=f"goals_{period}"))
-            elif goal["done"]:
-                bot.answer_callback_query(call.id, "Цель уже отмечена выполненной!")
-                return
-            else:
-                complete_goal(goal_id)
-                direction = goal["direction"]
-                bonus     = PERIOD_BONUS[period]
-                u         = get_user(user_id)
-                old_val   = u[direction]
-                new_val   = clamp(old_val + bonus)
-                update_direction(user_id, direction, new_val)
-                meta    = DIRECTION_META[direction]
-                leveled = check_and_level_up(cid, user_id, direction, new_val)
-                text, markup = build_goals_view(user_id, period)
-                if leveled:
-                    edit(text, markup)
-                else:
-                    edit(
-                        f"🎉 *Выполнено!* {meta['emoji']} {direction}: "
-                        f"`{old_val:.1f}` → `{new_val:.1f}` *(+{bonus})*\n\n" + text,
-                        markup,
-                    )
-
-        elif data.startswith("goal_undo_"):
-            parts   = data.split("_")
-            goal_id = int(parts[2])
-            period  = parts[3]
-            goal    = get_goal_by_id(goal_id, user_id)
-            if goal and goal["done"]:
-                uncomplete_goal(goal_id)
-                u         = get_user(user_id)
-                direction = goal["direction"]
-                new_val   = clamp(u[direction] - PERIOD_BONUS[period])
-                update_direction(user_id, direction, new_val)
-            text, markup = build_goals_view(user_id, period)
-            edit(text, markup)
-
-        elif data.startswith("goal_del_"):
-            parts   = data.split("_")
-            goal_id = int(parts[2])
-            period  = parts[3]
-            delete_goal(goal_id)
-            text, markup = build_goals_view(user_id, period)
-            edit(f"🗑 *Цель удалена*\n\n{text}", markup)
+@callbacks.on_route("goal_undo", int, _period)
+def cb_goal_undo(ctx, goal_id, period):
+    user_id = ctx.user_id
+    goal    = get_goal_by_id(goal_id, user_id)
+    if goal and goal["done"]:
+        uncomplete_goal(goal_id)
+        u         = get_user(user_id)
+        direction = goal["direction"]
+        new_val   = clamp(u[direction] - PERIOD_BONUS[period])
+        update_direction(user_id, direction, new_val, "undo")
+    text, markup = build_goals_view(user_id, period)
+    ctx.edit(text, markup)
 
+
+@callbacks.on_route("goal_del", int, _period)
+def cb_goal_del(ctx, goal_id, period):
+    delete_goal(goal_id)
+    text, markup = build_goals_view(ctx.user_id, period)
+    ctx.edit(f"🗑 *Цель удалена*\n\n{text}", markup)
+
+
+
+# ── Ranking ───────────────────────────────────────────────────────────────────
+def _board(value: str) -> str:
+    if value not in LEADERBOARD_BOARDS:
+        raise ValueError(f"Недопустимый рейтинг: {value}")
+    return value
+
+
+@callbacks.on_route("lb", _board)
+def cb_leaderboard(ctx, board="level"):
+    text, markup = build_leaderboard(ctx.user_id, board)
+    ctx.edit(text, markup)
+
+
+callbacks.add_exact("leaderboard", cb_leaderboard)
+
+
+# ── Broadcast ─────────────────────────────────────────────────────────────────
+def _broadcast_screen(ctx, broadcast_id: int) -> None:
+    row = broadcaster.get(broadcast_id)
+    ctx.edit(build_broadcast_status(row), kb_broadcast(broadcast_id, row["status"]))
+
+
+@callbacks.on_route("bc_go", int)
+def cb_broadcast_go(ctx, broadcast_id):
+    if not is_admin(ctx.user_id):
+        return
+    if not broadcaster.start(broadcast_id):
+        ctx.answer("⏳ Уже идёт другая рассылка.")
+        return
+    _broadcast_screen(ctx, broadcast_id)
+
+
+@callbacks.on_route("bc_status", int)
+def cb_broadcast_status(ctx, broadcast_id):
+    if is_admin(ctx.user_id):
+        _broadcast_screen(ctx, broadcast_id)
+
+
+@callbacks.on_route("bc_cancel", int)
+def cb_broadcast_cancel(ctx, broadcast_id):
+    if not is_admin(ctx.user_id):
+        return
+    broadcaster.cancel(broadcast_id)
+    _broadcast_screen(ctx, broadcast_id)
+
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_handler(call):
+    data = call.data
+    ctx  = CallbackContext(call)
+
+    try:
+        route = callbacks.resolve(data)
+        if route is None:
+            log.warning("Неизвестный callback: %s от %s", data, ctx.user_id)
         else:
-            log.warning("Неизвестный callback: %s", data)
+            handler, args = route
+            with observe_handler("callback", handler.__name__, ctx.user_id):
+                handler(ctx, *args)
 
     except Exception as e:
-        log.exception("Ошибка в callback_handler: %s", e)
-        bot.answer_callback_query(call.id, "⚠️ Произошла ошибка, попробуйте снова.")
+        log.exception("Ошибка в callback_handler (%s): %s", data, e,
+                      extra={"user_id": ctx.user_id, "kind": "callback"})
+        answer_callback(call.id, "⚠️ Произошла ошибка, попробуйте снова.")
         return
 
-    bot.answer_callback_query(call.id)
+    if not ctx.answered:
+        answer_callback(call.id)
 
 
 @bot.message_handler(content_types=["text"])
 def handle_text(message):
+    mark_activity()
+    user_id = str(message.from_user.id)
+    state   = user_states.get(user_id)
+    with observe_handler("text", state.type if state else "none", user_id):
+        handle_state(message, state)
+
+
+def handle_state(message, state: DialogState | None):
     user_id = str(message.from_user.id)
     text    = message.text.strip()
 
-    if user_id not in user_states:
+    if state is None:
         bot.reply_to(message, "🔙 Используйте меню кнопок.", reply_markup=kb_main())
         return
 
-    state = user_states[user_id]
-    stype = state["type"]
+    stype = state.type
 
     # ── Registration ──────────────────────────────────────────────────────────
     if stype == "reg_name":
         name = text[:50]
         update_user_fields(user_id, name=name)
-        user_states[user_id] = {"type": "reg_age"}
+        user_states[user_id] = RegAgeState()
         bot.reply_to(
             message,
             f"✅ Приятно познакомиться, *{name}*!\n\n"
@@ -1113,7 +3746,7 @@ def handle_text(message):
             bot.reply_to(message, "❌ Введи корректный возраст (число).",
                          reply_markup=kb_skip(next_cb="reg_age_skip"))
             return
-        user_states[user_id] = {"type": "reg_gender_wait"}
+        user_states[user_id] = RegGenderState()
         bot.reply_to(message, "3️⃣ *Укажи пол:*", reply_markup=kb_gender(), parse_mode="Markdown")
 
     elif stype == "reg_tg":
@@ -1128,15 +3761,14 @@ def handle_text(message):
         )
 
     elif stype == "reg_week_goals":
-        state["goals"].append(text[:200])
-        count = len(state["goals"])
+        state.goals.append(text[:200])
+        user_states[user_id] = state
+        count = len(state.goals)
         bot.reply_to(
             message,
             f"✅ *Цель {count} добавлена!*\n_{text[:60]}_\n\n"
             "Напиши следующую или нажми *«Готово»*:",
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("✅ Готово", callback_data="reg_goals_done")
-            ),
+            reply_markup=kb_reg_goals_done(),
             parse_mode="Markdown",
         )
 
@@ -1152,7 +3784,7 @@ def handle_text(message):
             parse_mode="Markdown",
         )
     elif stype == "pv_input":
-        cat_key = state["cat_key"]
+        cat_key = state.cat_key
         cat = PV_CATEGORIES[cat_key]
         try:
             raw = float(text.replace(",", "."))
@@ -1167,7 +3799,7 @@ def handle_text(message):
         u = get_user(user_id)
         old_val = u["PV"]
         new_val = pv_convert(raw, cat_key)
-        update_direction(user_id, "PV", new_val)
+        update_direction(user_id, "PV", new_val, "test")
         change = "📈" if new_val >= old_val else "📉"
         bot.reply_to(
             message,
@@ -1182,8 +3814,8 @@ def handle_text(message):
         del user_states[user_id]
         check_and_level_up(message.chat.id, user_id, "PV", new_val)
     elif stype == "test_input":
-        test_key = state["test_key"]
-        direction = state["direction"]
+        test_key = state.test_key
+        direction = state.direction
         cfg = TESTS_CONFIG[test_key]
 
         # Парсим число (поддерживаем и дробные для XQ)
@@ -1212,7 +3844,7 @@ def handle_text(message):
         u = get_user(user_id)
         old_val = u[direction]
         new_val = cfg["convert"](value)
-        update_direction(user_id, direction, new_val)
+        update_direction(user_id, direction, new_val, "test")
 
         meta = DIRECTION_META[direction]
         change = "📈" if new_val >= old_val else "📉"
@@ -1247,13 +3879,19 @@ def handle_text(message):
         )
         del user_states[user_id]
 
+    elif stype == "journal_search":
+        del user_states[user_id]
+        text, m = build_search_results(user_id, text)
+        bot.reply_to(message, text, reply_markup=m, parse_mode="Markdown")
+
     # ── Workout ───────────────────────────────────────────────────────────────
     elif stype == "workout":
-        day   = state["current_day"]
-        total = state["days"]
-        state["entries"].append(f"День {day}: {text}")
+        day   = state.current_day
+        total = state.days
+        state.entries.append(f"День {day}: {text}")
         if day < total:
-            state["current_day"] += 1
+            state.current_day += 1
+            user_states[user_id] = state
             bot.reply_to(
                 message,
                 f"✅ *День {day} записан*\n\n"
@@ -1263,12 +3901,12 @@ def handle_text(message):
             )
         else:
             ts      = datetime.now().strftime("%d.%m.%Y %H:%M")
-            content = f"{ts}\n\nПлан {total} дней:\n" + "\n".join(state["entries"])
+            content = f"{ts}\n\nПлан {total} дней:\n" + "\n".join(state.entries)
             save_journal(user_id, "workout", content)
             bot.reply_to(
                 message,
                 f"🎉 *ПЛАН НА {total} ДНЕЙ ГОТОВ!*\n\n"
-                + "\n".join(f"• {e}" for e in state["entries"])
+                + "\n".join(f"• {e}" for e in state.entries)
                 + "\n\n💾 Сохранено в журнале",
                 reply_markup=kb_main(),
                 parse_mode="Markdown",
@@ -1277,11 +3915,11 @@ def handle_text(message):
 
     # ── Goal add ──────────────────────────────────────────────────────────────
     elif stype == "goal_add":
-        period    = state["period"]
-        direction = state["direction"]
+        period    = state.period
+        direction = state.direction
         add_goal(user_id, period, direction, text)
         del user_states[user_id]
-        user_states[user_id] = {"type": "goals_view", "period": period}
+        user_states[user_id] = GoalsViewState(period)
         meta = DIRECTION_META[direction]
         goal_text, markup = build_goals_view(user_id, period)
         bot.reply_to(
@@ -1295,8 +3933,697 @@ def handle_text(message):
         bot.reply_to(message, "🔙 Используйте меню кнопок.", reply_markup=kb_main())
 
 
+# ── Dispatcher ────────────────────────────────────────────────────────────────
+# Апдейты одного пользователя всегда попадают в один и тот же шард и
+# обрабатываются строго по очереди — без гонок на user_states и на
+# get_user → clamp → update_direction. Разные пользователи расходятся по
+# шардам и не ждут друг друга.
+def update_user_id(upd) -> int:
+    for obj in (upd.message, upd.callback_query, upd.edited_message):
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return upd.update_id
+
+
+class ShardedDispatcher:
+    def __init__(self, shards: int):
+        self.queues  = [queue.Queue() for _ in range(shards)]
+        self.done    = [0] * shards
+        self.wait_total = [0.0] * shards
+        self.wait_max   = [0.0] * shards
+        self.threads = [
+            threading.Thread(target=self._worker, args=(i,), name=f"shard-{i}", daemon=True)
+            for i in range(shards)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, user_id: int, fn, *args) -> None:
+        self.queues[user_id % len(self.queues)].put((time.monotonic(), fn, args))
+
+    def _worker(self, i: int) -> None:
+        q = self.queues[i]
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            enqueued, fn, args = item
+            waited = time.monotonic() - enqueued
+            self.wait_total[i] += waited
+            self.wait_max[i]    = max(self.wait_max[i], waited)
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("Ошибка в шарде %s", i)
+            self.done[i] += 1
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "shard":     i,
+                "depth":     q.qsize(),
+                "done":      self.done[i],
+                "wait_avg":  self.wait_total[i] / self.done[i] if self.done[i] else 0.0,
+                "wait_max":  self.wait_max[i],
+            }
+            for i, q in enumerate(self.queues)
+        ]
+
+    def stop(self) -> None:
+        """Дорабатывает всё, что уже в очередях, и останавливает потоки."""
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        for st in self.stats():
+            log.info("Шард %(shard)s: %(done)s апдейтов, ожидание avg %(wait_avg).3f с, "
+                     "max %(wait_max).3f с", st)
+
+
+def _shard_stat(key: str):
+    return lambda: {} if bot.dispatcher is None else {
+        (str(st["shard"]),): st[key] for st in bot.dispatcher.stats()}
+
+
+metrics.gauge("risehunt_dispatcher_queue_depth", "Апдейты в очереди шарда", _shard_stat("depth"), ("shard",))
+metrics.gauge("risehunt_dispatcher_updates_total", "Апдейты, обработанные шардом",
+              _shard_stat("done"), ("shard",), kind="counter")
+metrics.gauge("risehunt_dispatcher_wait_max_seconds", "Самое долгое ожидание апдейта в очереди шарда",
+              _shard_stat("wait_max"), ("shard",))
+
+
+# ── Outbox ────────────────────────────────────────────────────────────────────
+# Все исходящие send_message / reply_to / edit_message_text при SEND_QUEUE=1
+# проходят через единый планировщик: общий token bucket на весь бот
+# (TG_GLOBAL_RATE сообщений/с) и по bucket'у на каждый чат (TG_CHAT_RATE).
+# Ответы на действия пользователя (PRIO_INTERACTIVE) уходят раньше фоновых
+# рассылок (PRIO_BACKGROUND). Сообщения одного чата — строго по порядку.
+# На 429 ждём retry_after из ответа Telegram и повторяем.
+SEND_QUEUE         = os.getenv("SEND_QUEUE", "0") == "1"
+SEND_WORKERS       = int(os.getenv("SEND_WORKERS", "4"))
+SEND_MAX_RETRIES   = int(os.getenv("SEND_MAX_RETRIES", "5"))
+TG_GLOBAL_RATE     = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE       = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST      = float(os.getenv("TG_CHAT_BURST", "3"))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.stamp  = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp  = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до свободного токена (0 — можно сейчас)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def retry_after_of(e: ApiTelegramException) -> float:
+    """Пауза из ответа 429 (parameters.retry_after), по умолчанию 1 с."""
+    return float(((e.result_json or {}).get("parameters") or {}).get("retry_after", 1))
+
+
+class _SendJob:
+    __slots__ = ("chat_id", "priority", "fn", "args", "kwargs", "on_done", "enqueued", "attempts")
+
+    def __init__(self, chat_id, priority, fn, args, kwargs, on_done=None):
+        self.chat_id  = chat_id
+        self.priority = priority
+        self.fn       = fn
+        self.args     = args
+        self.kwargs   = kwargs
+        self.on_done  = on_done
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate     = chat_rate
+        self.chat_burst    = chat_burst
+        self._chats: dict = {}                      # chat_id -> deque[_SendJob]
+        self._buckets: dict = {}                    # chat_id -> TokenBucket
+        self._not_before: dict = {}                 # chat_id -> monotonic (после 429)
+        self._ready = ([], [])                      # по приоритетам: очереди chat_id
+        self._delayed: list = []                    # heap (когда, seq, chat_id)
+        self._seq      = 0
+        self._busy: set = set()                     # чаты, у которых запрос уже в полёте
+        self._cond     = threading.Condition()
+        self._stopping = False
+        self.sent = self.failed = self.retried = self.rate_limited = 0
+        self.wait_total = self.wait_max = 0.0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, chat_id, priority: int, fn, *args, on_done=None, **kwargs) -> None:
+        """
+        on_done(error) вызывается в потоке Outbox, когда с сообщением покончено:
+        error=None — отправлено, иначе последнее исключение (повторы исчерпаны).
+        """
+        job = _SendJob(chat_id, priority, fn, args, kwargs, on_done)
+        with self._cond:
+            jobs = self._chats.get(chat_id)
+            if jobs is None:
+                jobs = self._chats[chat_id] = deque()
+            jobs.append(job)
+            if len(jobs) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id, time.monotonic())
+            self._cond.notify()
+
+    def _schedule(self, chat_id, now: float) -> None:
+        """Ставит чат в готовые (или в отложенные, если он упёрся в лимит)."""
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        wait = max(bucket.delay(now), self._not_before.get(chat_id, 0) - now)
+        if wait > 0:
+            self._seq += 1
+            heapq.heappush(self._delayed, (now + wait, self._seq, chat_id))
+        else:
+            self._ready[self._chats[chat_id][0].priority].append(chat_id)
+
+    def _next(self) -> _SendJob | None:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._delayed)
+                    self._schedule(chat_id, now)
+                queue_ = self._ready[0] or self._ready[1]
+                if queue_:
+                    wait = self.global_bucket.delay(now)
+                    if wait <= 0:
+                        chat_id = queue_.pop(0)
+                        job     = self._chats[chat_id].popleft()
+                        self._busy.add(chat_id)
+                        self._buckets[chat_id].take()
+                        self.global_bucket.take()
+                        return job
+                elif self._stopping and not self._delayed and not self._busy:
+                    return None
+                else:
+                    wait = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(wait)
+
+    def _finish(self, job: _SendJob, outcome: str, retry_after: float | None = None) -> None:
+        with self._cond:
+            if outcome == "sent":
+                waited = time.monotonic() - job.enqueued
+                self.sent      += 1
+                self.wait_total += waited
+                self.wait_max   = max(self.wait_max, waited)
+            elif outcome == "failed":
+                self.failed += 1
+            else:
+                self.retried += 1
+                if outcome == "429":
+                    self.rate_limited += 1
+            chat_id = job.chat_id
+            self._busy.discard(chat_id)
+            jobs = self._chats[chat_id]
+            now  = time.monotonic()
+            if retry_after is not None:
+                jobs.appendleft(job)
+                self._not_before[chat_id] = now + retry_after
+            else:
+                self._not_before.pop(chat_id, None)
+            if jobs:
+                self._schedule(chat_id, now)
+            else:
+                del self._chats[chat_id]
+                if self._buckets[chat_id].full(now):
+                    del self._buckets[chat_id]
+            self._cond.notify_all()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            job.attempts += 1
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and job.attempts <= SEND_MAX_RETRIES:
+                    retry_after = retry_after_of(e)
+                    log.warning("429 для чата %s, повтор через %.1f с", job.chat_id, retry_after)
+                    self._finish(job, "429", retry_after)
+                else:
+                    log.warning("Сообщение в чат %s не отправлено: %s", job.chat_id, e.description)
+                    self._notify(job, e)
+                    self._finish(job, "failed")
+            except Exception as e:
+                if job.attempts <= SEND_MAX_RETRIES:
+                    retry_after = min(30.0, 0.5 * 2 ** job.attempts)
+                    log.warning("Сбой отправки в чат %s, повтор через %.1f с", job.chat_id, retry_after,
+                                exc_info=True)
+                    self._finish(job, "retry", retry_after)
+                else:
+                    log.exception("Сообщение в чат %s не отправлено", job.chat_id)
+                    self._notify(job, e)
+                    self._finish(job, "failed")
+            else:
+                self._notify(job, None)
+                self._finish(job, "sent")
+
+    @staticmethod
+    def _notify(job: _SendJob, error: Exception | None) -> None:
+        if job.on_done is not None:
+            try:
+                job.on_done(error)
+            except Exception:
+                log.exception("Ошибка в on_done для чата %s", job.chat_id)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued_interactive": sum(1 for j in self._iter_jobs() if j.priority == PRIO_INTERACTIVE),
+                "queued_background":  sum(1 for j in self._iter_jobs() if j.priority == PRIO_BACKGROUND),
+                "chats":        len(self._chats),
+                "sent":         self.sent,
+                "failed":       self.failed,
+                "retried":      self.retried,
+                "rate_limited": self.rate_limited,
+                "wait_avg":     self.wait_total / self.sent if self.sent else 0.0,
+                "wait_max":     self.wait_max,
+            }
+
+    def _iter_jobs(self):
+        for jobs in self._chats.values():
+            yield from jobs
+
+    def stop(self) -> None:
+        """Досылает всё, что в очереди, и останавливает потоки."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        log.info("Outbox: %s", self.stats())
+
+
+def _outbox_stat(fn):
+    return lambda: {} if bot.outbox is None else fn(bot.outbox.stats())
+
+
+metrics.gauge("risehunt_outbox_queued", "Сообщения в очереди Outbox",
+              _outbox_stat(lambda st: {("interactive",): st["queued_interactive"],
+                                       ("background",):  st["queued_background"]}), ("priority",))
+metrics.gauge("risehunt_outbox_chats", "Чаты с сообщениями в очереди Outbox",
+              _outbox_stat(lambda st: {(): st["chats"]}), ())
+metrics.gauge("risehunt_outbox_messages_total", "Исходы отправки через Outbox (failed — отброшены)",
+              _outbox_stat(lambda st: {(k,): st[k] for k in ("sent", "failed", "retried", "rate_limited")}),
+              ("outcome",), kind="counter")
+metrics.gauge("risehunt_outbox_wait_max_seconds", "Самое долгое ожидание сообщения в очереди",
+              _outbox_stat(lambda st: {(): st["wait_max"]}), ())
+
+
+# ── Broadcast ─────────────────────────────────────────────────────────────────
+# Рассылка всем пользователям от администратора (/broadcast). Получатели
+# читаются из users пачками по BROADCAST_BATCH по первичному ключу, темп
+# задаёт свой token bucket (BROADCAST_RATE/с). При SEND_QUEUE=1 сообщения
+# идут через Outbox с фоновым приоритетом — под общий лимит бота
+# TG_GLOBAL_RATE, живые ответы обгоняют рассылку; без Outbox — напрямую,
+# и BROADCAST_RATE оставляет запас до лимита Telegram ~30/с. После каждой пачки прогресс
+# фиксируется в broadcasts: после падения рассылка продолжится с того же
+# места при старте бота, повторно сообщение получат не больше одной пачки.
+# Кто заблокировал бота (403), помечается в users.blocked_at и дальше пропускается.
+BROADCAST_RATE  = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "50"))
+
+# Ответы Telegram, после которых писать пользователю бессмысленно
+_UNREACHABLE = ("bot was blocked", "user is deactivated", "chat not found", "bot was kicked")
+
+
+class Broadcaster:
+    def __init__(self, rate: float, batch: int):
+        self.bucket    = TokenBucket(rate, 1.0)
+        self.batch     = batch
+        self.current: int | None = None
+        self.stopping  = threading.Event()
+        self.cancelled = threading.Event()
+        self._lock     = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def create(self, admin_id: str, text: str) -> int:
+        with get_conn() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL").fetchone()[0]
+            cur = conn.execute(
+                "INSERT INTO broadcasts (admin_id, text, total, created_at) VALUES (?, ?, ?, ?)",
+                (admin_id, text, total, datetime.now(timezone.utc).strftime(TS_FORMAT)),
+            )
+        return cur.lastrowid
+
+    def get(self, broadcast_id: int | None = None):
+        """Рассылка по id, без id — текущая или последняя."""
+        with get_conn() as conn:
+            if broadcast_id is not None:
+                return conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            return conn.execute(
+                "SELECT * FROM broadcasts ORDER BY status = 'running' DESC, id DESC LIMIT 1"
+            ).fetchone()
+
+    def start(self, broadcast_id: int) -> bool:
+        """Запускает черновик; False — если уже идёт другая рассылка или черновик не найден."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            with get_conn() as conn:
+                cur = conn.execute(
+                    "UPDATE broadcasts SET status = 'running' WHERE id = ? AND status = 'draft'",
+                    (broadcast_id,),
+                )
+            if not cur.rowcount:
+                return False
+            self._spawn(broadcast_id)
+            return True
+
+    def resume(self) -> int | None:
+        """Продолжает рассылку, прерванную остановкой или падением бота."""
+        row = self.get()
+        if row is None or row["status"] != "running":
+            return None
+        with self._lock:
+            self._spawn(row["id"])
+        log.info("Рассылка #%s продолжается с user_id > %r", row["id"], row["cursor"])
+        return row["id"]
+
+    def cancel(self, broadcast_id: int) -> bool:
+        with get_conn() as conn:
+            cur = conn.execute(
+                "UPDATE broadcasts SET status = 'cancelled', finished_at = ? "
+                "WHERE id = ? AND status IN ('draft', 'running')",
+                (datetime.now(timezone.utc).strftime(TS_FORMAT), broadcast_id),
+            )
+        if self.current == broadcast_id:
+            self.cancelled.set()
+        return cur.rowcount > 0
+
+    def stop(self) -> None:
+        """Останавливает поток; рассылка остаётся running и продолжится при следующем старте."""
+        self.stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _spawn(self, broadcast_id: int) -> None:
+        self.current = broadcast_id
+        self.cancelled.clear()
+        self._thread = threading.Thread(target=self._run, args=(broadcast_id,), name="broadcast", daemon=True)
+        self._thread.start()
+
+    def _interrupted(self) -> bool:
+        return self.stopping.is_set() or self.cancelled.is_set()
+
+    def _run(self, broadcast_id: int) -> None:
+        try:
+            self._send_all(broadcast_id)
+        except Exception:
+            log.exception("Рассылка #%s прервана ошибкой", broadcast_id)
+        finally:
+            self.current = None
+
+    def _send_all(self, broadcast_id: int) -> None:
+        row    = self.get(broadcast_id)
+        text   = row["text"]
+        cursor = row["cursor"]
+        while not self._interrupted():
+            with get_conn() as conn:
+                ids = [r[0] for r in conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL "
+                    "ORDER BY user_id LIMIT ?",
+                    (cursor, self.batch),
+                )]
+            if not ids:
+                self._finish(broadcast_id)
+                return
+            started = time.monotonic()
+            counts  = {"sent": 0, "blocked": 0, "failed": 0}
+            blocked = []
+            send    = self._send_queued if bot.outbox is not None else self._send_direct
+            for user_id, outcome in send(ids, text):
+                counts[outcome] += 1
+                if outcome == "blocked":
+                    blocked.append(user_id)
+                cursor = user_id
+            self._checkpoint(broadcast_id, cursor, counts, blocked, time.monotonic() - started)
+
+    def _pace(self) -> bool:
+        """Ждёт токен рассылки; False — остановка посреди ожидания."""
+        while (wait := self.bucket.delay(time.monotonic())) > 0:
+            if self.stopping.wait(wait):
+                return False
+        self.bucket.take()
+        return True
+
+    @staticmethod
+    def _outcome(user_id: str, error: Exception | None) -> str:
+        if error is None:
+            return "sent"
+        if isinstance(error, ApiTelegramException):
+            description = (error.description or "").lower()
+            if error.error_code == 403 or any(s in description for s in _UNREACHABLE):
+                return "blocked"
+        log.warning("Рассылка: сообщение %s не отправлено: %s", user_id, error)
+        return "failed"
+
+    def _send_queued(self, ids: list, text: str) -> list[tuple[str, str]]:
+        """
+        Пачка через Outbox: общий лимит с живыми ответами, повторы на 429 —
+        его. Ответ Telegram по каждому получателю приходит в on_done; ждём,
+        пока придут все, чтобы курсор не обогнал недоставленные сообщения.
+        """
+        outcomes: dict = {}
+        done      = threading.Condition()
+        submitted = []
+
+        def on_done(user_id, error):
+            with done:
+                outcomes[user_id] = self._outcome(user_id, error)
+                done.notify()
+
+        for user_id in ids:
+            if self._interrupted() or not self._pace():
+                break
+            bot.outbox.submit(int(user_id), PRIO_BACKGROUND, TeleBot.send_message, bot, int(user_id), text,
+                              on_done=functools.partial(on_done, user_id))
+            submitted.append(user_id)
+        with done:
+            done.wait_for(lambda: len(outcomes) == len(submitted))
+        return [(user_id, outcomes[user_id]) for user_id in submitted]
+
+    def _send_direct(self, ids: list, text: str) -> list[tuple[str, str]]:
+        results = []
+        for user_id in ids:
+            if self._interrupted():
+                break
+            outcome = self._send(user_id, text)
+            if outcome is None:        # остановка посреди ожидания — этот user_id не обработан
+                break
+            results.append((user_id, outcome))
+        return results
+
+    def _send(self, user_id: str, text: str) -> str | None:
+        """Доставка одному пользователю с повторами: "sent" / "blocked" / "failed", None — прервано."""
+        for attempt in range(1, SEND_MAX_RETRIES + 2):
+            if not self._pace():
+                return None
+            try:
+                TeleBot.send_message(bot, int(user_id), text)
+                return "sent"
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    return self._outcome(user_id, e)
+                retry_after = retry_after_of(e)
+                log.warning("Рассылка: 429, пауза %.1f с", retry_after)
+            except Exception:
+                retry_after = min(30.0, 0.5 * 2 ** attempt)
+                log.warning("Рассылка: сбой отправки %s, повтор через %.1f с", user_id, retry_after,
+                            exc_info=True)
+            if self.stopping.wait(retry_after):
+                return None
+        return "failed"
+
+    def _checkpoint(self, broadcast_id: int, cursor: str, counts: dict, blocked: list, elapsed: float) -> None:
+        now = datetime.now(timezone.utc).strftime(TS_FORMAT)
+        with get_conn() as conn:
+            conn.executemany("UPDATE users SET blocked_at = ? WHERE user_id = ?", [(now, uid) for uid in blocked])
+            conn.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = sent + ?, blocked = blocked + ?, "
+                "failed = failed + ?, active_sec = active_sec + ? WHERE id = ?",
+                (cursor, counts["sent"], counts["blocked"], counts["failed"], elapsed, broadcast_id),
+            )
+        for uid in blocked:
+            user_cache.invalidate(uid)
+
+    def _finish(self, broadcast_id: int) -> None:
+        with get_conn() as conn:
+            conn.execute(
+                "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'",
+                (datetime.now(timezone.utc).strftime(TS_FORMAT), broadcast_id),
+            )
+        row = self.get(broadcast_id)
+        log.info("Рассылка #%s завершена: отправлено %s, заблокировали %s, ошибок %s за %.0f с",
+                 broadcast_id, row["sent"], row["blocked"], row["failed"], row["active_sec"])
+        bot.send_message(int(row["admin_id"]), build_broadcast_status(row),
+                         parse_mode="Markdown", priority=PRIO_BACKGROUND)
+
+
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_BATCH)
+
+
+# ── Webhook ───────────────────────────────────────────────────────────────────
+WEBHOOK_HOST       = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT       = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH       = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL        = os.getenv("WEBHOOK_URL")          # публичный адрес; если пусто — setWebhook не вызываем
+WEBHOOK_SECRET     = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS    = int(os.getenv("WEBHOOK_WORKERS", "8"))
+
+
+def run_webhook() -> None:
+    """
+    Режим webhook: апдейты приходят POST-запросами на WEBHOOK_PATH.
+    Запрос проверяется по заголовку X-Telegram-Bot-Api-Secret-Token, апдейт
+    кладётся в очередь на WEBHOOK_QUEUE_SIZE мест, и Telegram сразу получает
+    200 — хендлеры отрабатывают в WEBHOOK_WORKERS потоках. Если очередь
+    полна, отвечаем 503 с Retry-After, и Telegram доставит апдейт позже.
+
+    Локальная проверка — отправить записанный Update:
+        curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+             --data @update.json http://localhost:8443/webhook
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from telebot.types import Update
+
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан — без него webhook принимал бы апдейты от кого угодно")
+
+    updates: queue.Queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != WEBHOOK_PATH:
+                return self._reply(404)
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+                return self._reply(403)
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                upd = Update.de_json(self.rfile.read(length).decode("utf-8"))
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400)
+            try:
+                updates.put_nowait(upd)
+            except queue.Full:
+                log.warning("Webhook: очередь заполнена (%s), апдейт %s отклонён",
+                            WEBHOOK_QUEUE_SIZE, upd.update_id)
+                return self._reply(503, retry_after=1)
+            self._reply(200)
+
+        def _reply(self, code: int, retry_after: int | None = None):
+            self.send_response(code)
+            if retry_after is not None:
+                self.send_header("Retry-After", str(retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, fmt, *args):
+            log.debug("Webhook: " + fmt, *args)
+
+    def worker():
+        while True:
+            upd = updates.get()
+            if upd is None:
+                return
+            try:
+                bot.process_new_updates([upd])
+            except Exception:
+                log.exception("Ошибка обработки апдейта %s", upd.update_id)
+
+    workers = [threading.Thread(target=worker, name=f"webhook-{i}", daemon=True)
+               for i in range(WEBHOOK_WORKERS)]
+    for t in workers:
+        t.start()
+
+    class WebhookServer(ThreadingHTTPServer):
+        # Очередь listen() по умолчанию — 5 соединений: при всплеске ядро
+        # сбрасывало бы их раньше, чем обработчик успеет ответить 503
+        request_queue_size = max(64, WEBHOOK_WORKERS + WEBHOOK_QUEUE_SIZE)
+
+    server = WebhookServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    # shutdown() ждёт выхода из serve_forever, поэтому зовём его из другого потока
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    log.info("Webhook слушает %s:%s%s, очередь %s, потоков %s",
+             WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for _ in workers:
+            updates.put(None)
+        for t in workers:
+            t.join()
+
+
 # ── Run ───────────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
     init_db()
-    log.info("🤖 RiseHunt Bot v2.0 запущен")
-    bot.infinity_polling(skip_pending=True)
+    if DB_WRITE_BEHIND:
+        write_queue.start()
+    if DISPATCH_SHARDS:
+        bot.dispatcher = ShardedDispatcher(DISPATCH_SHARDS)
+    warm_keyboards()
+    log.info("Рейтинг: %s участников", leaderboard.load())
+    if SEND_QUEUE:
+        bot.outbox = Outbox(SEND_WORKERS, TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
+    maintenance.start()
+    broadcaster.resume()
+    if METRICS_ENABLED:
+        run_metrics_server()
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> — профиль на PROFILE_SECONDS без участия бота
+        signal.signal(signal.SIGUSR1, lambda *_: profiler.start(PROFILE_SECONDS))
+    log.info("🤖 RiseHunt Bot v2.0 запущен (%s)", BOT_RUNTIME)
+    try:
+        if BOT_RUNTIME == "webhook":
+            run_webhook()
+        else:
+            # SIGTERM (рестарт воркера) — мягкая остановка, чтобы очередь записи успела сброситься
+            signal.signal(signal.SIGTERM, lambda *_: bot.stop_polling())
+            bot.infinity_polling(skip_pending=True)
+    finally:
+        maintenance.stop()
+        broadcaster.stop()
+        if bot.dispatcher is not None:
+            bot.dispatcher.stop()
+        if bot.outbox is not None:
+            bot.outbox.stop()
+        write_queue.stop()
+        close_all_conns()
+        log.info("Кэш пользователей: %s попаданий, %s промахов", user_cache.hits, user_cache.misses)
+        log.info("Кэш экранов: %s правок, %s пропущено без изменений",
+                 render_cache.edits, render_cache.skipped)
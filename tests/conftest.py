@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("LOG_CONSOLE", "0")
+os.chdir(tempfile.mkdtemp(prefix="risehunt-test-"))   # лог и БД бота — во временной папке
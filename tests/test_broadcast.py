@@ -0,0 +1,40 @@
+import threading
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+def test_broadcast_goes_through_outbox(monkeypatch):
+    bot.init_db()
+    with bot.get_conn() as conn:
+        conn.execute("DELETE FROM users")
+        conn.executemany("INSERT INTO users (user_id) VALUES (?)", [("9001",), ("9002",), ("9003",)])
+
+    threads = []
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        if chat_id == 9002:
+            raise ApiTelegramException("sendMessage", None, {
+                "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+
+    monkeypatch.setattr(TeleBot, "send_message", send_message)
+    outbox = bot.Outbox(1, 1000, 1000, 1000)
+    monkeypatch.setattr(bot.bot, "outbox", outbox)
+    broadcaster = bot.Broadcaster(1000, 2)
+    try:
+        broadcast_id = broadcaster.create("1", "новости")
+        assert broadcaster.start(broadcast_id)
+        broadcaster._thread.join(5)
+    finally:
+        broadcaster.stop()
+        outbox.stop()
+
+    row = broadcaster.get(broadcast_id)
+    assert (row["status"], row["sent"], row["blocked"], row["failed"]) == ("done", 2, 1, 0)
+    assert all(name.startswith("outbox-") for name in threads)   # под общий лимит Outbox
+    assert outbox.stats()["sent"] >= 2
+    with bot.get_conn() as conn:
+        assert conn.execute("SELECT blocked_at FROM users WHERE user_id = '9002'").fetchone()[0]
@@ -0,0 +1,58 @@
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+def api_error(code: int, description: str, **parameters) -> ApiTelegramException:
+    return ApiTelegramException("answerCallbackQuery", None, {
+        "error_code": code, "description": description, "parameters": parameters})
+
+
+def test_answer_callback_retries_short_429_once(monkeypatch):
+    attempts, sleeps = [], []
+
+    def answer(call_id, text=None):
+        attempts.append(call_id)
+        raise api_error(429, "Too Many Requests", retry_after=1)
+
+    monkeypatch.setattr(bot.bot, "answer_callback_query", answer)
+    monkeypatch.setattr(bot.time, "sleep", sleeps.append)
+    bot.answer_callback("q1")
+    assert attempts == ["q1"] * 2
+    assert sleeps == [1.0]
+
+
+def test_answer_callback_does_not_wait_long_429(monkeypatch):
+    attempts, sleeps = [], []
+
+    def answer(call_id, text=None):
+        attempts.append(call_id)
+        raise api_error(429, "Too Many Requests", retry_after=5)
+
+    monkeypatch.setattr(bot.bot, "answer_callback_query", answer)
+    monkeypatch.setattr(bot.time, "sleep", sleeps.append)
+    bot.answer_callback("q1")
+    assert attempts == ["q1"]
+    assert sleeps == []
+
+
+def test_answer_callback_retries_network_error_once(monkeypatch):
+    attempts, sleeps = [], []
+
+    def answer(call_id, text=None):
+        attempts.append(call_id)
+        raise ConnectionError("reset")
+
+    monkeypatch.setattr(bot.bot, "answer_callback_query", answer)
+    monkeypatch.setattr(bot.time, "sleep", sleeps.append)
+    bot.answer_callback("q1")
+    assert attempts == ["q1"] * 2
+    assert sum(sleeps) <= 1
+
+
+def test_answer_callback_gives_up_without_raising(monkeypatch):
+    def answer(call_id, text=None):
+        raise api_error(400, "Bad Request: query is too old")
+
+    monkeypatch.setattr(bot.bot, "answer_callback_query", answer)
+    bot.answer_callback("q1")   # не бросает
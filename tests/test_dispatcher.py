@@ -0,0 +1,57 @@
+import threading
+import time
+
+from telebot import types
+
+import bot
+
+
+def make_update(update_id: int, user_id: int) -> types.Update:
+    return types.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "hi",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        },
+    })
+
+
+def test_sharded_polling_does_not_refetch_pending_updates():
+    pending = [make_update(i, 100 + i % 3) for i in range(1, 7)]
+    offsets, processed = [], []
+    lock = threading.Lock()
+
+    tb = bot.RiseBot("123456:TEST", threaded=False)
+
+    def get_updates(offset=None, **kwargs):
+        offsets.append(offset)
+        return [u for u in pending if u.update_id >= offset]
+
+    def process_new_messages(messages):
+        time.sleep(0.05)   # шард ещё занят, когда приходит следующий getUpdates
+        with lock:
+            processed.extend(m.message_id for m in messages)
+
+    tb.get_updates          = get_updates
+    tb.process_new_messages = process_new_messages
+    tb.dispatcher           = bot.ShardedDispatcher(2)
+    try:
+        tb._TeleBot__retrieve_updates(timeout=0)
+        tb._TeleBot__retrieve_updates(timeout=0)
+    finally:
+        tb.dispatcher.stop()
+
+    assert offsets == [1, 7]
+    assert sorted(processed) == [1, 2, 3, 4, 5, 6]
+
+
+def test_shard_backlog_is_exported(monkeypatch):
+    dispatcher = bot.ShardedDispatcher(2)
+    monkeypatch.setattr(bot.bot, "dispatcher", dispatcher)
+    try:
+        text = bot.metrics.render()
+    finally:
+        dispatcher.stop()
+    assert 'risehunt_dispatcher_queue_depth{shard="0"} 0' in text
+    assert 'risehunt_dispatcher_queue_depth{shard="1"} 0' in text
@@ -0,0 +1,54 @@
+import bot
+
+
+def test_maintenance_jobs_are_exported():
+    text = bot.metrics.render()
+    assert '# TYPE risehunt_maintenance_runs_total counter' in text
+    assert 'risehunt_maintenance_runs_total{job="prune_journal"} 0' in text
+    assert 'risehunt_maintenance_last_seconds{job="analyze"} 0' in text
+
+
+def test_outbox_queue_is_exported(monkeypatch):
+    assert "risehunt_outbox_queued{" not in bot.metrics.render()   # outbox выключен — без значений
+    outbox = bot.Outbox(1, 30, 1, 3)
+    monkeypatch.setattr(bot.bot, "outbox", outbox)
+    try:
+        text = bot.metrics.render()
+    finally:
+        outbox.stop()
+    assert 'risehunt_outbox_queued{priority="interactive"} 0' in text
+    assert 'risehunt_outbox_messages_total{outcome="failed"} 0' in text
+    assert "risehunt_outbox_chats 0" in text
+
+
+def test_user_cache_is_exported():
+    bot.init_db()
+    bot.get_user("4242")
+    bot.get_user("4242")
+    text = bot.metrics.render()
+    assert '# TYPE risehunt_user_cache_lookups_total counter' in text
+    assert f'risehunt_user_cache_lookups_total{{result="hit"}} {bot.user_cache.hits}' in text
+    assert f'risehunt_user_cache_lookups_total{{result="miss"}} {bot.user_cache.misses}' in text
+    assert bot.user_cache.hits >= 1
+    assert f"risehunt_user_cache_entries {len(bot.user_cache)}" in text
+
+
+def test_render_cache_is_exported():
+    text = bot.metrics.render()
+    assert '# TYPE risehunt_render_cache_edits_total counter' in text
+    assert f'risehunt_render_cache_edits_total{{result="skipped"}} {bot.render_cache.skipped}' in text
+    assert "risehunt_render_cache_pending 0" in text
+
+
+def test_write_queue_is_exported():
+    text = bot.metrics.render()
+    assert "# TYPE risehunt_write_queue_written_total counter" in text
+    assert f"risehunt_write_queue_batches_total {bot.write_queue.batches}" in text
+    assert "risehunt_write_queue_pending 0" in text
+
+
+def test_state_store_drops_are_exported():
+    text = bot.metrics.render()
+    assert "# TYPE risehunt_user_states_dropped_total counter" in text
+    assert f'risehunt_user_states_dropped_total{{reason="evicted"}} {bot.user_states.evicted}' in text
+    assert f'risehunt_user_states_dropped_total{{reason="expired"}} {bot.user_states.expired}' in text
@@ -0,0 +1,43 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture(scope="module", autouse=True)
+def fresh_db():
+    bot.init_db()
+
+
+def plan_of(fn, *args, prefix: str) -> str:
+    """Выполняет fn, ловит её запрос с подставленными параметрами и возвращает его план."""
+    conn = bot.get_conn()
+    seen = []
+    conn.set_trace_callback(seen.append)
+    try:
+        fn(*args)
+    finally:
+        conn.set_trace_callback(None)
+    sql = next(s for s in seen if s.startswith(prefix))
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    return "\n".join(r["detail"] for r in rows)
+
+
+def test_get_goals_uses_user_period_index():
+    plan = plan_of(bot.get_goals, "1", "week", prefix="SELECT * FROM goals")
+    assert "idx_goals_user_period" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.parametrize("journal_type, index", [
+    (None,       "idx_journal_user_created"),
+    ("emotions", "idx_journal_user_type_created"),
+])
+@pytest.mark.parametrize("cursor, older", [
+    (None,                         True),
+    (("2026-01-01 00:00:00", 10), True),
+    (("2026-01-01 00:00:00", 10), False),
+])
+def test_journal_page_uses_keyset_index(journal_type, index, cursor, older):
+    plan = plan_of(bot.get_journal_page, "1", journal_type, cursor, older, prefix="SELECT id, type")
+    assert index in plan
+    assert "TEMP B-TREE" not in plan
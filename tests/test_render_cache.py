@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+from telebot import TeleBot, types
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+def make_ctx(chat_id: int, message_id: int) -> bot.CallbackContext:
+    return bot.CallbackContext(types.CallbackQuery.de_json({
+        "id": "1", "chat_instance": "test", "data": "profile",
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+        "message": {"message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "x"},
+    }))
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    outbox = bot.Outbox(1, 1000, 1000, 1000)
+    monkeypatch.setattr(bot.bot, "outbox", outbox)
+    yield outbox
+    outbox.stop()
+
+
+def shown(ctx, text: str) -> bool:
+    key = (ctx.cid, ctx.mid)
+    return bot.render_cache._shown.get(key) == bot.render_cache.digest(text, None, "Markdown")
+
+
+def test_queued_edit_is_remembered_after_send(monkeypatch, outbox):
+    monkeypatch.setattr(TeleBot, "edit_message_text", lambda self, *a, **k: None)
+    ctx = make_ctx(501, 1)
+    ctx.edit("экран")
+    outbox.stop()
+    assert shown(ctx, "экран")
+
+
+def test_failed_edit_is_not_remembered(monkeypatch, outbox):
+    def fail(self, *a, **k):
+        raise ApiTelegramException("editMessageText", None, {"error_code": 400, "description": "Bad Request"})
+
+    ctx = make_ctx(502, 1)
+    monkeypatch.setattr(TeleBot, "edit_message_text", lambda self, *a, **k: None)
+    ctx.edit("старый")
+    outbox.stop()
+    assert shown(ctx, "старый")
+
+    outbox2 = bot.Outbox(1, 1000, 1000, 1000)
+    monkeypatch.setattr(bot.bot, "outbox", outbox2)
+    monkeypatch.setattr(TeleBot, "edit_message_text", fail)
+    ctx.edit("новый")
+    outbox2.stop()
+    assert not shown(ctx, "новый")
+    assert not shown(ctx, "старый")   # что на экране — неизвестно, следующая правка уйдёт
+
+
+def test_overlapping_edits_keep_last_screen(monkeypatch, outbox):
+    sent, released = [], threading.Semaphore(0)
+
+    def slow_edit(self, text, *a, **k):
+        released.acquire()
+        sent.append(text)
+
+    monkeypatch.setattr(TeleBot, "edit_message_text", slow_edit)
+    ctx = make_ctx(503, 1)
+    ctx.edit("A")
+    ctx.edit("B")
+    released.release()                       # A дошла, B ещё в очереди
+    while not sent:
+        time.sleep(0.001)
+    assert not shown(ctx, "A")
+    ctx.edit("A")                            # экран сейчас — B (в пути), правку не пропускаем
+    released.release()
+    released.release()
+    outbox.stop()
+    assert sent == ["A", "B", "A"]
+    assert shown(ctx, "A")
+    assert bot.render_cache._pending == {}
@@ -0,0 +1,50 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture(scope="module", autouse=True)
+def journal():
+    bot.init_db()
+    with bot.get_conn() as conn:
+        conn.execute("DELETE FROM journal WHERE user_id IN ('701', '702')")
+    for user_id, content in [
+        ("701", "Нарядили ёлку во дворе"),
+        ("701", "Ёлка стоит до Рождества"),
+        ("701", "Купил к ёлке игрушки"),
+        ("701", "Тревожная ночь, плохо спал"),
+        ("702", "У соседа тоже ёлка"),
+    ]:
+        bot.save_journal(user_id, "emotions", content)
+
+
+@pytest.mark.parametrize("word, stem", [
+    ("ёлки", "елк"), ("тревожный", "тревожн"), ("радостью", "радост"), ("дня", "дня"), ("сон", "сон"),
+])
+def test_stem_drops_inflection(word, stem):
+    assert bot.fts_query(word) == f'"{stem}"*'
+
+
+def test_search_finds_inflected_forms_with_yo():
+    found = [row["snippet"] for row in bot.search_journal("701", "ёлки")]
+    assert len(found) == 3
+    assert all("\x02" in s for s in found)
+
+
+def test_search_is_limited_to_user_inside_fts():
+    with bot.get_conn() as conn:
+        rowids = [r[0] for r in conn.execute(
+            "SELECT rowid FROM journal_fts WHERE journal_fts MATCH ?",
+            ('user_id:"702" AND content:("елк"*)',),
+        )]
+        owners = {r[0] for r in conn.execute(
+            f"SELECT user_id FROM journal WHERE id IN ({','.join('?' * len(rowids))})", rowids)}
+    assert owners == {"702"}
+    assert [row["id"] for row in bot.search_journal("702", "тревожная")] == []
+
+
+def test_deleted_entry_leaves_index():
+    assert len(bot.search_journal("701", "тревожный")) == 1
+    with bot.get_conn() as conn:
+        conn.execute("DELETE FROM journal WHERE user_id = '701' AND content LIKE 'Тревожная%'")
+    assert bot.search_journal("701", "тревожный") == []
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def durable_store():
+    bot.init_db()
+    return bot.StateStore(max_entries=10, ttl=3600, durable=True)
+
+
+def test_state_survives_restart(durable_store):
+    durable_store["1"] = bot.WorkoutState(days=3, current_day=2, entries=["День 1: бег"])
+    durable_store._entries.clear()   # как после рестарта: в памяти пусто
+    assert durable_store["1"] == bot.WorkoutState(days=3, current_day=2, entries=["День 1: бег"])
+
+
+def test_state_json_keeps_type_key():
+    raw = bot.GoalAddState("week", "IQ").to_json()
+    assert json.loads(raw) == {"type": "goal_add", "period": "week", "direction": "IQ"}
+    assert bot.DialogState.from_json(raw) == bot.GoalAddState("week", "IQ")
+
+
+@pytest.mark.parametrize("raw", [
+    '{"type": "no_such_state"}',
+    '{"type": "pv_input"}',                             # нет обязательного поля
+    '{"type": "reg_name", "unexpected": 1}',
+])
+def test_unknown_or_broken_state_is_dropped(raw):
+    assert bot.DialogState.from_json(raw) is None
+
+
+def test_wrong_field_fails_loudly():
+    with pytest.raises(TypeError):
+        bot.GoalAddState(period="week", dirction="IQ")
+
+
+def test_pop_without_state_skips_sqlite(durable_store):
+    durable_store.get("0")   # первое обращение читает список user_id из таблицы
+    statements = []
+    bot.get_conn().set_trace_callback(statements.append)
+    try:
+        assert durable_store.pop("2") is None
+        assert durable_store.get("2") is None
+    finally:
+        bot.get_conn().set_trace_callback(None)
+    assert statements == []
+
+
+def test_pop_returns_state_persisted_before_restart(durable_store):
+    durable_store["3"] = bot.GoalsViewState("month")
+    restarted = bot.StateStore(max_entries=10, ttl=3600, durable=True)
+    assert restarted.pop("3") == bot.GoalsViewState("month")
+    assert bot.StateStore(max_entries=10, ttl=3600, durable=True).get("3") is None